@@ -1,11 +1,17 @@
+import os
 from typing import AsyncGenerator
 
+from dotenv import load_dotenv
 from fastapi import Depends
 from fastapi_users.db import SQLAlchemyBaseUserTableUUID, SQLAlchemyUserDatabase
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import DeclarativeBase
 
-DATABASE_URL = "sqlite+aiosqlite:///./user.db"
+load_dotenv()
+
+DATABASE_URL = os.getenv("user_database_url", "sqlite+aiosqlite:///./user.db")
 
 
 class Base(DeclarativeBase):
@@ -16,7 +22,48 @@ class User(SQLAlchemyBaseUserTableUUID, Base):
     pass
 
 
-engine = create_async_engine(DATABASE_URL)
+def create_engine(url=DATABASE_URL):
+    """
+    Async engine for the user database, with its connection pool sized by user_db_pool_size,
+    user_db_max_overflow and user_db_pool_timeout. SQLite databases are switched to WAL (readers no longer
+    block the writer) and wait up to user_db_busy_timeout_ms for a lock instead of failing with "database is
+    locked".
+    """
+    options = {
+        "pool_size": int(os.getenv("user_db_pool_size", 5)),
+        "max_overflow": int(os.getenv("user_db_max_overflow", 10)),
+        "pool_timeout": float(os.getenv("user_db_pool_timeout", 30)),
+        "pool_pre_ping": os.getenv("user_db_pool_pre_ping") == "True",
+    }
+    sqlite = make_url(url).get_backend_name() == "sqlite"
+    if sqlite:
+        if make_url(url).database in (None, "", ":memory:"):
+            # One in-memory database per connection, the pool settings do not apply
+            options = {}
+        else:
+            options["connect_args"] = {"timeout": int(os.getenv("user_db_busy_timeout_ms", 5000)) / 1000}
+    engine = create_async_engine(url, **options)
+
+    if sqlite:
+        pragmas = {
+            "journal_mode": os.getenv("user_db_journal_mode", "WAL"),
+            # NORMAL is durable with WAL except for the last transactions on a power loss
+            "synchronous": os.getenv("user_db_synchronous", "NORMAL"),
+            "busy_timeout": int(os.getenv("user_db_busy_timeout_ms", 5000)),
+        }
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                if value:
+                    cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+
+    return engine
+
+
+engine = create_engine()
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
 
 
@@ -31,4 +78,4 @@ async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
 
 
 async def get_user_db(session: AsyncSession = Depends(get_async_session)):
-    yield SQLAlchemyUserDatabase(session, User)
\ No newline at end of file
+    yield SQLAlchemyUserDatabase(session, User)
@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+
+class UserCache:
+    """
+    Thread-safe LRU cache of the users of verified access tokens, so authenticating a request does not load the
+    user from the database. An entry lives until ttl or the token expires, whichever comes first, and all entries
+    of a user are dropped when the user changes (see UserManager). Invalidation only reaches this process, other
+    workers pick up a change after ttl at the latest.
+    """
+
+    def __init__(self, max_entries=10000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # token -> (expires, user ID, column values)
+        self.entries = OrderedDict()
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.db_loads = 0
+        self.db_seconds = 0.0
+
+    def get(self, token, user_class):
+        """Return a detached copy of the cached user of token, or None."""
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None or time.time() >= entry[0]:
+                if entry is not None:
+                    self._remove(token)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(token)
+            self.hits += 1
+        # Every request gets its own instance, like one loaded by its own session
+        user = user_class(**entry[2])
+        make_transient_to_detached(user)
+        return user
+
+    def put(self, token, user, expires=None):
+        expires = min(time.time() + self.ttl, expires or float("inf"))
+        values = {column.key: getattr(user, column.key) for column in inspect(type(user)).column_attrs}
+        with self.lock:
+            if token in self.entries:
+                self._remove(token)
+            self.entries[token] = (expires, user.id, values)
+            self.tokens.setdefault(user.id, set()).add(token)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, token):
+        _, user_id, _ = self.entries.pop(token)
+        tokens = self.tokens[user_id]
+        tokens.discard(token)
+        if not tokens:
+            del self.tokens[user_id]
+
+    def invalidate(self, user_id):
+        with self.lock:
+            for token in list(self.tokens.get(user_id, ())):
+                self._remove(token)
+            self.invalidations += 1
+
+    def record_load(self, seconds):
+        with self.lock:
+            self.db_loads += 1
+            self.db_seconds += seconds
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "db_loads": self.db_loads,
+                "db_seconds": self.db_seconds,
+                "db_mean_ms": 1000 * self.db_seconds / self.db_loads if self.db_loads else 0.0,
+            }
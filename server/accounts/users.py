@@ -1,26 +1,90 @@
 import os
+import time
 import uuid
-from typing import Optional
+from contextvars import ContextVar
+from typing import Optional, Tuple
 
+import jwt
 from fastapi import Depends, Request
-from fastapi_users import BaseUserManager, FastAPIUsers, UUIDIDMixin
+from fastapi.concurrency import run_in_threadpool
+from fastapi.security import OAuth2PasswordRequestForm
+from fastapi_users import BaseUserManager, FastAPIUsers, UUIDIDMixin, exceptions
 from fastapi_users.authentication import (
     AuthenticationBackend,
     BearerTransport,
     JWTStrategy,
 )
 from fastapi_users.db import SQLAlchemyUserDatabase
+from fastapi_users.jwt import decode_jwt
+from fastapi_users.password import PasswordHelper
 from dotenv import load_dotenv
 from .db import User, get_user_db
+from .schemas import UserCreate
+from .user_cache import UserCache
 load_dotenv()
 
 SECRET = os.getenv("jwt_key")
 
+# Users of verified tokens, so authenticated requests skip the user lookup in the database
+user_cache = UserCache(max_entries=int(os.getenv("auth_cache_size", 10000)),
+                       ttl=float(os.getenv("auth_cache_ttl", 60)))
+
+
+class ThreadedPasswordHelper(PasswordHelper):
+    """
+    PasswordHelper that can hash and verify on a worker thread. BaseUserManager calls hash and verify_and_update
+    on the event loop, where their ~100 ms of CPU would stall every other request, including ones holding a
+    SQLite write lock; computed ahead with hash_ahead and verify_ahead, the manager's calls get the result of the
+    same request instead. Calls that were not computed ahead hash in place.
+    """
+
+    _ahead: ContextVar[Optional[dict]] = ContextVar("password_results", default=None)
+
+    async def _compute_ahead(self, key, function, *args):
+        results = self._ahead.get()
+        if results is None:
+            results = {}
+            self._ahead.set(results)
+        results[key] = await run_in_threadpool(function, *args)
+
+    async def hash_ahead(self, password: str) -> None:
+        await self._compute_ahead(("hash", password), super().hash, password)
+
+    async def verify_ahead(self, plain_password: str, hashed_password: str) -> None:
+        await self._compute_ahead(("verify", plain_password, hashed_password), super().verify_and_update,
+                                  plain_password, hashed_password)
+
+    def hash(self, password: str) -> str:
+        results = self._ahead.get() or {}
+        return results.pop(("hash", password)) if ("hash", password) in results else super().hash(password)
+
+    def verify_and_update(self, plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        key = ("verify", plain_password, hashed_password)
+        results = self._ahead.get() or {}
+        return results.pop(key) if key in results else super().verify_and_update(plain_password, hashed_password)
+
 
 class UserManager(UUIDIDMixin, BaseUserManager[User, uuid.UUID]):
     reset_password_token_secret = SECRET
     verification_token_secret = SECRET
 
+    def __init__(self, user_db, password_helper=None):
+        super().__init__(user_db, password_helper or ThreadedPasswordHelper())
+
+    # Registration and login are BaseUserManager's, with their hashing done on a worker thread beforehand
+    async def create(self, user_create: UserCreate, safe: bool = False, request: Optional[Request] = None) -> User:
+        await self.password_helper.hash_ahead(user_create.password)
+        return await super().create(user_create, safe, request)
+
+    async def authenticate(self, credentials: OAuth2PasswordRequestForm) -> Optional[User]:
+        try:
+            user = await self.get_by_email(credentials.username)
+            await self.password_helper.verify_ahead(credentials.password, user.hashed_password)
+        except exceptions.UserNotExists:
+            # BaseUserManager hashes anyway, so unknown e-mails take as long as wrong passwords
+            await self.password_helper.hash_ahead(credentials.password)
+        return await super().authenticate(credentials)
+
     async def on_after_register(self, user: User, request: Optional[Request] = None):
         print(f"User {user.id} has registered.")
 
@@ -34,6 +98,22 @@ class UserManager(UUIDIDMixin, BaseUserManager[User, uuid.UUID]):
     ):
         print(f"Verification requested for user {user.id}. Verification token: {token}")
 
+    # Cached users of a changed, deactivated or deleted account are dropped
+    async def on_after_update(self, user: User, update_dict: dict, request: Optional[Request] = None):
+        user_cache.invalidate(user.id)
+
+    async def on_after_verify(self, user: User, request: Optional[Request] = None):
+        user_cache.invalidate(user.id)
+
+    async def on_after_reset_password(self, user: User, request: Optional[Request] = None):
+        user_cache.invalidate(user.id)
+
+    async def on_before_delete(self, user: User, request: Optional[Request] = None):
+        user_cache.invalidate(user.id)
+
+    async def on_after_delete(self, user: User, request: Optional[Request] = None):
+        user_cache.invalidate(user.id)
+
 
 async def get_user_manager(user_db: SQLAlchemyUserDatabase = Depends(get_user_db)):
     yield UserManager(user_db)
@@ -42,7 +122,39 @@ async def get_user_manager(user_db: SQLAlchemyUserDatabase = Depends(get_user_db
 bearer_transport = BearerTransport(tokenUrl="auth/jwt/login")
 
 
+class CachedJWTStrategy(JWTStrategy):
+    """JWTStrategy that looks the user of a token up in user_cache first, and caches users it loads."""
+
+    async def read_token(self, token: Optional[str], user_manager: BaseUserManager[User, uuid.UUID]) -> Optional[User]:
+        if token is None:
+            return None
+        # Only tokens that were verified are cached, and never past their expiry
+        user = user_cache.get(token, User)
+        if user is not None:
+            return user
+
+        try:
+            data = decode_jwt(token, self.decode_key, self.token_audience, algorithms=[self.algorithm])
+            user_id = data.get("sub")
+            if user_id is None:
+                return None
+        except jwt.PyJWTError:
+            return None
+
+        start = time.perf_counter()
+        try:
+            user = await user_manager.get(user_manager.parse_id(user_id))
+        except (exceptions.UserNotExists, exceptions.InvalidID):
+            return None
+        finally:
+            user_cache.record_load(time.perf_counter() - start)
+        user_cache.put(token, user, expires=data.get("exp"))
+        return user
+
+
 def get_jwt_strategy() -> JWTStrategy:
+    if user_cache.ttl > 0:
+        return CachedJWTStrategy(secret=SECRET, lifetime_seconds=3600)
     return JWTStrategy(secret=SECRET, lifetime_seconds=3600)
 
 
@@ -0,0 +1,192 @@
+import asyncio
+import math
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+
+import anyio
+
+
+class Rejected(Exception):
+    """A request turned away by AdmissionController, to answer with status_code and a Retry-After header."""
+
+    def __init__(self, status_code, reason, retry_after):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take a token, return 0 if there was one, else the seconds until there is."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """
+    Limits the requests of one kind (e.g. /chat pipelines) running at once. Each user has a token bucket of
+    user_rate requests per second with bursts of user_burst, and at most user_concurrency requests running or
+    waiting; going over either is answered 429. Beyond max_concurrent running requests, others wait in a FIFO
+    queue of at most max_queue for up to queue_timeout seconds; a full queue or a wait that times out is answered
+    503. Runs on the event loop, the limits apply per worker process.
+    """
+
+    def __init__(self, max_concurrent=8, max_queue=32, queue_timeout=10, user_rate=0.5, user_burst=10,
+                 user_concurrency=2, max_users=10000):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.user_concurrency = user_concurrency
+        self.max_users = max_users
+        self.buckets = OrderedDict()
+        self.user_requests = Counter()
+        self.active = 0
+        self.waiters = deque()
+        # Mean run time of admitted requests, to tell rejected clients when to come back
+        self.service_time = 1.0
+        self.admitted = 0
+        self.rejected = Counter()
+        self.max_queue_depth = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+
+    def _bucket(self, user_id):
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = TokenBucket(self.user_rate, self.user_burst)
+            if len(self.buckets) > self.max_users:
+                # A full bucket is the same as none, drop the one idle the longest
+                self.buckets.popitem(last=False)
+        self.buckets.move_to_end(user_id)
+        return bucket
+
+    def _reject(self, status_code, reason, retry_after):
+        self.rejected[reason] += 1
+        raise Rejected(status_code, reason, retry_after)
+
+    def _expected_wait(self):
+        return (len(self.waiters) + 1) * self.service_time / self.max_concurrent
+
+    def _queue_full(self):
+        return (self.active >= self.max_concurrent or self.waiters) and len(self.waiters) >= self.max_queue
+
+    async def _acquire(self):
+        if self.active < self.max_concurrent and not self.waiters:
+            self.active += 1
+            return 0.0
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.max_queue_depth = max(self.max_queue_depth, len(self.waiters))
+        start = time.monotonic()
+        try:
+            # _release hands its slot over by resolving the future, active stays counted
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # Handed a slot just as the wait ended, pass it on
+                self._release()
+            else:
+                waiter.cancel()
+                self.waiters.remove(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self._reject(503, "queue_timeout", self._expected_wait())
+        return time.monotonic() - start
+
+    def _release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    async def _enter(self, user_id):
+        if self.user_requests[user_id] >= self.user_concurrency:
+            self._reject(429, "user_concurrency", self.service_time)
+        # Checked before taking a token, a request turned away for a full queue does not count against the user
+        if self._queue_full():
+            self._reject(503, "queue_full", self._expected_wait())
+        retry_after = self._bucket(user_id).take()
+        if retry_after:
+            self._reject(429, "user_rate", retry_after)
+
+        self.user_requests[user_id] += 1
+        try:
+            waited = await self._acquire()
+        except BaseException:
+            self._forget(user_id)
+            raise
+        self.admitted += 1
+        self.wait_seconds += waited
+        self.max_wait = max(self.max_wait, waited)
+        return time.monotonic()
+
+    def _leave(self, user_id, start):
+        self.service_time = 0.9 * self.service_time + 0.1 * (time.monotonic() - start)
+        self._release()
+        self._forget(user_id)
+
+    def _forget(self, user_id):
+        self.user_requests[user_id] -= 1
+        if not self.user_requests[user_id]:
+            del self.user_requests[user_id]
+
+    @asynccontextmanager
+    async def admit(self, user_id):
+        """Run the body as one admitted request of user_id, or raise Rejected."""
+        start = await self._enter(user_id)
+        try:
+            yield
+        finally:
+            self._leave(user_id, start)
+
+    async def run_sync(self, user_id, function, *args):
+        """
+        Run function on a worker thread as one admitted request of user_id, or raise Rejected. A cancelled request
+        (e.g. timed out) returns at once, but its slot stays taken until the thread finishes, so threads that are
+        still winding down never outnumber max_concurrent.
+        """
+        start = await self._enter(user_id)
+        try:
+            task = asyncio.ensure_future(anyio.to_thread.run_sync(function, *args))
+        except BaseException:
+            self._leave(user_id, start)
+            raise
+
+        def finished(task):
+            self._leave(user_id, start)
+            if not task.cancelled():
+                # Retrieved so an abandoned run that failed is not logged as never retrieved
+                task.exception()
+
+        task.add_done_callback(finished)
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "queue_depth": len(self.waiters),
+            "max_queue_depth": self.max_queue_depth,
+            "admitted": self.admitted,
+            "mean_wait_ms": 1000 * self.wait_seconds / self.admitted if self.admitted else 0.0,
+            "max_wait_ms": 1000 * self.max_wait,
+            "mean_service_ms": 1000 * self.service_time,
+            "rejected": dict(self.rejected),
+        }
@@ -0,0 +1,77 @@
+"""
+Query embedding throughput and latency with and without the micro-batcher, against local stub providers that
+cost a fixed overhead plus a small amount per text. The "api" stub serves any number of calls in parallel, like
+an HTTP embedding API (where batching mostly saves calls against the rate limit); the "local" stub runs one
+forward pass at a time, like an in-process model.
+
+Run from the server folder: python benchmarks/embedding_batching.py
+"""
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, ".")
+
+from langchain_core.embeddings import Embeddings
+
+from rag.batching import BatchedEmbeddings
+
+ROUND_TRIP = 0.030
+PER_TEXT = 0.0005
+QUERIES_PER_CLIENT = 20
+
+
+class StubEmbeddings(Embeddings):
+    def __init__(self, parallel):
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.model = threading.Semaphore(1000 if parallel else 1)
+
+    def embed_documents(self, texts):
+        with self.lock:
+            self.calls += 1
+        with self.model:
+            time.sleep(ROUND_TRIP + PER_TEXT * len(texts))
+        return [[float(len(text))] * 8 for text in texts]
+
+    def embed_queries(self, texts):
+        return self.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.embed_queries([text])[0]
+
+
+def run(embeddings, clients):
+    latencies = []
+
+    def client(i):
+        for j in range(QUERIES_PER_CLIENT):
+            start = time.perf_counter()
+            embeddings.embed_query(f"client {i} query {j}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(client, range(clients)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "qps": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+if __name__ == "__main__":
+    for provider, parallel, workers in [("api", True, 4), ("local", False, 1)]:
+        for clients in [1, 16, 64]:
+            for name in ["direct", "batched"]:
+                stub = StubEmbeddings(parallel)
+                embeddings = stub
+                if name == "batched":
+                    embeddings = BatchedEmbeddings(stub, max_batch_size=64, max_wait=0.005, workers=workers)
+                result = run(embeddings, clients)
+                print(f"{provider:>5} {clients:>3} clients {name:>8}: {result['qps']:8.1f} q/s, "
+                      f"p50 {result['p50_ms']:7.1f} ms, p99 {result['p99_ms']:7.1f} ms, {stub.calls:>5} provider calls")
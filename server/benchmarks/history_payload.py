@@ -0,0 +1,85 @@
+"""
+Compare /chat request and response sizes over a 10-turn conversation for the old history format, which
+carried the rendered system prompt and retrieved documents, and the compact format with chunk IDs.
+
+Run from the server folder: python benchmarks/history_payload.py
+The first turn fetches documents, the following turns are follow-ups on the same documents.
+"""
+import glob
+import hashlib
+import json
+import os
+import re
+
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path="rag/.env")
+
+TURNS = 10
+ANSWER = "根據仿單，建議依照醫師指示服用，" * 20
+
+
+def sample_chunks(k, chunk_size):
+    chunks = []
+    for filename in sorted(glob.glob(os.path.join(os.getenv("data_directory"), "*.md"))):
+        with open(filename, encoding="utf-8") as f:
+            paragraphs = [p for p in re.split(r"\n\s*\n", f.read()) if p.strip()]
+        for paragraph in paragraphs:
+            chunks.append({"content": paragraph[:chunk_size],
+                           "metadata": {"source": filename,
+                                        "id": hashlib.md5(paragraph[:chunk_size].encode()).hexdigest()}})
+    return chunks[:k]
+
+
+# Same layout as formatDocuments in rag/RAGHelper.py
+def format_documents(chunks):
+    doc_strings = []
+    for i, chunk in enumerate(chunks):
+        metadata_string = ", ".join([f"{md}: {chunk['metadata'][md]}" for md in chunk["metadata"].keys()])
+        doc_strings.append(f"Document {i} content: {chunk['content']}\nDocument {i} metadata: {metadata_string}")
+    return "\n\n<NEWDOC>\n\n".join(doc_strings)
+
+
+def size(payload):
+    return len(json.dumps(payload, ensure_ascii=False).encode())
+
+
+def run(compact):
+    chunks = sample_chunks(int(os.getenv("rerank_k", 8)), int(os.getenv("chunk_size", 512)))
+    documents = [{"s": c["metadata"]["source"], "c": c["content"]} for c in chunks]
+    context = format_documents(chunks)
+    history = []
+    totals = []
+    for turn in range(TURNS):
+        prompt = f"第 {turn} 個問題：這個藥可以和其他藥一起吃嗎？"
+        request = {"prompt": prompt, "history": history, "docs": documents if turn > 0 else []}
+        if compact:
+            if turn == 0:
+                history = []
+            history = history + [
+                {"role": "human", "content": prompt},
+                {"role": "assistant", "content": ANSWER, "chunk_ids": [c["metadata"]["id"] for c in chunks]},
+            ]
+        else:
+            # The old server rendered its prompt thread into the history
+            if turn == 0:
+                history = [
+                    {"role": "system", "content": os.getenv("rag_instruction").format_map({"context": context})},
+                    {"role": "human", "content": os.getenv("rag_question_initial").format_map({"question": prompt})},
+                ]
+            else:
+                history = history + [
+                    {"role": "human", "content": os.getenv("rag_question_followup").format_map({"question": prompt})}
+                ]
+            history = history + [{"role": "assistant", "content": ANSWER}]
+        response = {"reply": ANSWER, "history": history, "documents": documents, "rewritten": False,
+                    "question": prompt}
+        totals.append((size(request), size(response)))
+    return totals
+
+
+if __name__ == "__main__":
+    for name, compact in [("rendered", False), ("compact", True)]:
+        totals = run(compact)
+        print(f"{name:>8}: turn 10 request {totals[-1][0]:>7} B, response {totals[-1][1]:>7} B, "
+              f"10-turn total {sum(r + s for r, s in totals):>8} B")
@@ -0,0 +1,40 @@
+"""
+Import time and resident memory of the server modules, each imported in a fresh process (best of --repeat).
+Importing main is what a worker does before it can answer /healthz; the indexes load after that.
+
+Run from the server folder: python benchmarks/import_time.py
+"""
+import argparse
+import subprocess
+import sys
+
+MEASURE = """
+import platform, resource, sys, time
+sys.path.insert(0, ".")
+if platform.system() == "Linux":
+    __import__('pysqlite3')
+    sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs="*", default=["rag.ingest", "rag.RAGHelper", "rag.RAGHelper_cloud", "main"])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        runs = []
+        for _ in range(args.repeat):
+            output = subprocess.run([sys.executable, "-c", MEASURE.format(module=module)],
+                                    capture_output=True, text=True, check=True).stdout.split()
+            runs.append((float(output[-2]), float(output[-1])))
+        seconds, rss = min(runs)
+        print(f"{module:>20}: {seconds:5.2f} s, RSS {rss:5.0f} MiB")
+
+
+if __name__ == "__main__":
+    main()
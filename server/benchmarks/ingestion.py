@@ -0,0 +1,76 @@
+"""
+Peak memory and throughput of ingesting a synthetic corpus of text labels with the streaming pipeline, against
+loading every file before splitting them all (how loadData used to work). Vectorizing is left out, so the
+numbers are about loading, splitting and writing the chunks.
+
+Run from the server folder: python benchmarks/ingestion.py --files 500 2000 8000
+Every measurement runs in its own process, so peak RSS is not carried over.
+"""
+import argparse
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, ".")
+
+WORDS = ["藥品", "劑量", "副作用", "警語", "病人", "治療", "臨床", "試驗", "肝功能", "腎功能", "兒童", "孕婦"]
+
+
+def write_corpus(directory, files, paragraphs=40):
+    rng = random.Random(0)
+    for i in range(files):
+        text = "\n\n".join(f"{n} 段落\n" + "".join(rng.choice(WORDS) for _ in range(150))
+                           for n in range(1, paragraphs + 1))
+        with open(os.path.join(directory, f"衛署藥製字第{i:06d}號_測試藥.txt"), "w") as f:
+            f.write(text)
+
+
+def measure(directory, mode):
+    os.environ.update({"splitter": "RecursiveCharacterTextSplitter", "chunk_size": "512", "chunk_overlap": "20",
+                       "vector_store": "chroma"})
+    from rag.RAGHelper import RAGHelper, identify_chunks
+    from rag.ingest import discover, load_file
+    from rag.pipeline import peak_rss_mib
+
+    helper = RAGHelper()
+    helper.text_splitter = helper.buildSplitter()
+    chunks_file = os.path.join(directory, f"{mode}.pickle")
+    start = time.perf_counter()
+    if mode == "pipeline":
+        helper.ingest(discover(directory, ["txt"]), chunks_file=chunks_file, vectorize=False)
+    else:
+        docs = []
+        for path in discover(directory, ["txt"]):
+            docs = docs + load_file(path)
+        with open(chunks_file, "wb") as f:
+            pickle.dump(identify_chunks(helper.text_splitter.split_documents(docs)), f)
+    print(f"{time.perf_counter() - start:.2f} {peak_rss_mib():.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, nargs="+", default=[500, 2000])
+    parser.add_argument("--measure", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(*args.measure)
+        return
+
+    for files in args.files:
+        with tempfile.TemporaryDirectory() as directory:
+            write_corpus(directory, files)
+            size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+            for mode in ["eager", "pipeline"]:
+                output = subprocess.run([sys.executable, __file__, "--measure", directory, mode],
+                                        capture_output=True, text=True, check=True).stdout.split()
+                seconds, rss = float(output[-2]), float(output[-1])
+                print(f"{files:>6} files ({size / 2 ** 20:6.1f} MiB) {mode:>8}: {seconds:6.1f} s, "
+                      f"{files / seconds:7.1f} files/s, peak RSS {rss:6.0f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Latency of LLM calls through rag.llm_router against local stub OpenAI-compatible servers that inject latency: most
+answers take --llm-ms, one in --tail-every takes --tail-ms (a slow provider's tail). Compares one provider, as the
+server used to call its LLM, with two providers and hedging. Then the first provider fails every call for a while
+and recovers, to show its circuit opening, the calls failing over and the trial call closing it again.
+
+Run from the server folder: python benchmarks/llm_router.py --requests 400 --concurrency 8
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def stub_llm(behaviour):
+    # behaviour is read on every request, so latency and failures can be changed while the server runs
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            slow = random.random() < 1 / behaviour["tail_every"]
+            time.sleep((behaviour["tail_ms"] if slow else behaviour["llm_ms"]) / 1000)
+            if behaviour["fail"]:
+                status, body = 500, json.dumps({"error": {"message": "stub failure"}}).encode()
+            else:
+                status, body = 200, json.dumps({
+                    "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": "stub",
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": "no, see the label documents."}}],
+                    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+                }).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def load(router, requests, concurrency):
+    from rag.llm_router import LLMUnavailable
+
+    def one(i):
+        start = time.perf_counter()
+        try:
+            router.invoke(f"question {i}")
+            return time.perf_counter() - start, False
+        except LLMUnavailable:
+            return time.perf_counter() - start, True
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    latencies = sorted(seconds for seconds, _ in results)
+    return {"p50_ms": 1000 * statistics.median(latencies),
+            "p95_ms": 1000 * latencies[int(0.95 * (len(latencies) - 1))],
+            "p99_ms": 1000 * latencies[int(0.99 * (len(latencies) - 1))],
+            "errors": sum(error for _, error in results)}
+
+
+def report(name, result, router):
+    stats = router.stats()
+    print(f"{name:>10}: p50 {result['p50_ms']:7.1f} ms, p95 {result['p95_ms']:7.1f} ms, "
+          f"p99 {result['p99_ms']:7.1f} ms, {result['errors']} errors, {stats['hedged']} hedged, "
+          f"{stats['hedge_wins']} won by the hedge, {stats['failovers']} failovers, "
+          f"{stats['failover_wins']} won by the failover")
+    for provider, provider_stats in stats["providers"].items():
+        print(f"{'':>12}{provider}: {provider_stats['state']}, {provider_stats['calls']} calls, "
+              f"{provider_stats['errors']} errors, {provider_stats['wins']} answers, {provider_stats['trips']} trips")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--llm-ms", type=float, default=50)
+    parser.add_argument("--tail-ms", type=float, default=1000)
+    parser.add_argument("--tail-every", type=int, default=20)
+    parser.add_argument("--outage-s", type=float, default=1.0, help="How long the first provider fails")
+    args = parser.parse_args()
+
+    sys.path.insert(0, ".")
+    behaviours = [{"llm_ms": args.llm_ms, "tail_ms": args.tail_ms, "tail_every": args.tail_every, "fail": False}
+                  for _ in range(2)]
+    urls = [f"http://127.0.0.1:{stub_llm(behaviour)}/v1" for behaviour in behaviours]
+    os.environ.update({"OPENAI_API_KEY": "stub", "openai_model_name": "stub", "llm_threads": str(4 * args.concurrency),
+                       "llm_hedge_delay_ms": str(4 * args.llm_ms), "llm_breaker_cooldown": "0.5"})
+    from rag.llm_router import router_from_env
+
+    os.environ["llm_providers"], os.environ["llm_max_hedges"] = f"openai={urls[0]}", "0"
+    router = router_from_env()
+    report("single", load(router, args.requests, args.concurrency), router)
+
+    os.environ["llm_providers"], os.environ["llm_max_hedges"] = ",".join(f"openai={url}" for url in urls), "1"
+    router = router_from_env()
+    report("hedged", load(router, args.requests, args.concurrency), router)
+
+    # The first provider goes down and comes back while requests keep coming
+    router = router_from_env()
+    behaviours[0]["fail"] = True
+    threading.Timer(args.outage_s, lambda: behaviours[0].update(fail=False)).start()
+    report("outage", load(router, args.requests, args.concurrency), router)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Build time, query latency and recall@k of the memory-mapped IVF index (for several nprobe settings) against a
+persistent Chroma collection queried the way the MMR retriever does, on synthetic 1024-d vectors. Then the cost of
+adding the vectors of one uploaded label (--add) to the built index, against building it again with them.
+
+Run from the server folder: python benchmarks/local_index.py
+"""
+import argparse
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+if platform.system() == "Linux":
+    __import__('pysqlite3')
+    sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+
+sys.path.insert(0, ".")
+
+import chromadb
+
+from rag.local_index import IVFIndex
+from vector_compression import synthetic
+
+
+def evaluate(search, queries, truth, k):
+    start = time.perf_counter()
+    found = [set(search(q)[:k]) for q in queries]
+    latency = (time.perf_counter() - start) / len(queries)
+    return latency, np.mean([len(a & b) / k for a, b in zip(truth, found)])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=20000)
+    parser.add_argument("--dims", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--fetch-k", type=int, default=20)
+    parser.add_argument("--add", type=int, default=100)
+    args = parser.parse_args()
+
+    # Broad, overlapping clusters, so neighbours often sit in clusters other than the query's
+    vectors = synthetic(args.n, args.dims, cluster_size=1000, noise=1.5)
+    ids = [str(i) for i in range(len(vectors))]
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.choice(len(vectors), args.queries, replace=False)]
+    queries = queries + 0.05 * rng.normal(size=queries.shape).astype(np.float32)
+    truth = [set(np.argsort(-(vectors @ q))[:args.k]) for q in queries]
+    directory = tempfile.mkdtemp()
+
+    start = time.perf_counter()
+    client = chromadb.PersistentClient(path=os.path.join(directory, "chroma"))
+    collection = client.create_collection("benchmark")
+    for offset in range(0, len(vectors), 5000):
+        collection.add(ids=ids[offset:offset + 5000], embeddings=vectors[offset:offset + 5000].tolist(),
+                       documents=ids[offset:offset + 5000])
+    print(f"chroma build {time.perf_counter() - start:6.1f} s")
+
+    def chroma_search(q):
+        result = collection.query(query_embeddings=[q.tolist()], n_results=args.fetch_k,
+                                  include=["metadatas", "documents", "distances", "embeddings"])
+        return [int(i) for i in result["ids"][0]]
+
+    latency, recall = evaluate(chroma_search, queries, truth, args.k)
+    print(f"chroma            {latency * 1000:7.2f} ms/query, recall@{args.k} {recall:.3f}")
+
+    path = os.path.join(directory, "index.ivf")
+    start = time.perf_counter()
+    IVFIndex.build(ids, vectors, path)
+    print(f"local_ivf build {time.perf_counter() - start:6.1f} s, file {os.path.getsize(path) / 2 ** 20:.1f} MiB")
+    for nprobe in [1, 4, 8, 16, 32]:
+        start = time.perf_counter()
+        index = IVFIndex(path, nprobe=nprobe)
+        open_ms = (time.perf_counter() - start) * 1000
+
+        def ivf_search(q):
+            rows, _ = index.search(q, args.fetch_k)
+            return [int(index.ids[row]) for row in rows]
+
+        latency, recall = evaluate(ivf_search, queries, truth, args.k)
+        print(f"local_ivf nprobe {nprobe:>2} {latency * 1000:7.2f} ms/query, recall@{args.k} {recall:.3f}, "
+              f"open {open_ms:.1f} ms")
+
+    # Like the stored vectors, as the paragraphs of another label are
+    noise = 0.1 / np.sqrt(args.dims) * rng.normal(size=(args.add, args.dims)).astype(np.float32)
+    added = vectors[rng.choice(len(vectors), args.add)] + noise
+    added_ids = [f"added-{i}" for i in range(len(added))]
+    start = time.perf_counter()
+    IVFIndex.build(ids + added_ids, np.concatenate([vectors, added]), os.path.join(directory, "rebuilt.ivf"))
+    print(f"local_ivf rebuild with {args.add} vectors {time.perf_counter() - start:6.2f} s")
+    start = time.perf_counter()
+    IVFIndex.add(added_ids, added, path)
+    print(f"local_ivf add {args.add} vectors       {time.perf_counter() - start:6.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Throughput of the ONNX embedding provider (fp32 and int8, per thread count) on the label chunks, and how well
+its retrieval agrees with a reference embedding model: the mean overlap of the top-k chunks per query.
+
+Run from the server folder, with the chunk pickle in place:
+    python benchmarks/onnx_embeddings.py <onnx model dir> --threads 1 4 --reference api
+--reference api compares against the provider configured in rag/.env (e.g. jina), --reference fp32 against
+the unquantized ONNX model, which isolates the effect of quantization.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+sys.path.insert(0, ".")
+load_dotenv(dotenv_path="rag/.env")
+
+from rag.get_embeddings import get_embedding_function
+from rag.ingest import read_chunks
+from rag.onnx_embeddings import OnnxEmbeddings
+
+QUERIES = [
+    "頭痛吃什麼藥?", "感冒藥可以和胃藥一起吃嗎?", "孕婦可以服用這個藥嗎?", "這個藥有什麼副作用?",
+    "Venlafaxine 的建議劑量是多少?", "藥品應該如何保存?", "肝功能不全的病人要調整劑量嗎?", "兒童可以使用嗎?",
+]
+
+
+def top_k(query_vectors, chunk_vectors, k):
+    scores = np.asarray(query_vectors) @ np.asarray(chunk_vectors).T
+    return [set(np.argsort(-row)[:k]) for row in scores]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_path")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--sample", type=int, default=512)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--reference", choices=["api", "fp32"], default="fp32")
+    args = parser.parse_args()
+
+    chunks = [doc.page_content for doc in read_chunks(os.getenv("document_chunks_pickle"))]
+    texts = random.Random(0).sample(chunks, min(args.sample, len(chunks)))
+
+    prefixes = {"query_prefix": os.getenv("onnx_query_prefix", ""),
+                "document_prefix": os.getenv("onnx_document_prefix", "")}
+    results = {}
+    for quantize in [False, True]:
+        for threads in args.threads:
+            model = OnnxEmbeddings(args.model_path, quantize=quantize, threads=threads,
+                                   batch_size=args.batch_size, **prefixes)
+            start = time.perf_counter()
+            vectors = model.embed_documents(texts)
+            elapsed = time.perf_counter() - start
+            print(f"{'int8' if quantize else 'fp32'} {threads:>2} threads: {len(texts) / elapsed:8.1f} texts/s")
+        results[quantize] = ([model.embed_query(query) for query in QUERIES], vectors)
+
+    if args.reference == "api":
+        reference = get_embedding_function()
+        reference_results = ([reference.embed_query(q) for q in QUERIES], reference.embed_documents(texts))
+    else:
+        reference_results = results[False]
+    expected = top_k(*reference_results, args.k)
+    for quantize in [False, True] if args.reference == "api" else [True]:
+        found = top_k(*results[quantize], args.k)
+        overlap = np.mean([len(a & b) / args.k for a, b in zip(expected, found)])
+        print(f"{'int8' if quantize else 'fp32'} top-{args.k} agreement with {args.reference}: {overlap:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Cross-encoder throughput (pairs/sec) and per-request p99 latency under concurrency, with every request scoring
+its own pairs versus the shared batching worker. The stub model runs one forward pass at a time and costs a
+fixed overhead per call plus an amount proportional to the padded batch (batch size x longest pair).
+
+Run from the server folder: python benchmarks/rerank_batching.py
+"""
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, ".")
+
+from langchain.retrievers.document_compressors.cross_encoder import BaseCrossEncoder
+
+from rag.batching import BatchedCrossEncoder
+
+CALL_OVERHEAD = 0.004
+PER_PADDED_CHAR = 0.000002
+PAIRS_PER_REQUEST = 20
+REQUESTS_PER_CLIENT = 10
+
+
+class StubCrossEncoder(BaseCrossEncoder):
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def score(self, text_pairs):
+        longest = max(len(query) + len(doc) for query, doc in text_pairs)
+        with self.lock:
+            time.sleep(CALL_OVERHEAD + PER_PADDED_CHAR * longest * len(text_pairs))
+        return [float(len(doc)) for _, doc in text_pairs]
+
+
+def run(model, clients):
+    rng = random.Random(0)
+    requests = [[("頭痛吃什麼藥?", "藥" * rng.randint(50, 520)) for _ in range(PAIRS_PER_REQUEST)]
+                for _ in range(clients * REQUESTS_PER_CLIENT)]
+    latencies = []
+
+    def client(i):
+        for pairs in requests[i::clients]:
+            start = time.perf_counter()
+            model.score(pairs)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(client, range(clients)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "pairs_per_second": len(requests) * PAIRS_PER_REQUEST / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000,
+    }
+
+
+if __name__ == "__main__":
+    for clients in [1, 8, 32]:
+        for name in ["per-request", "batched"]:
+            model = StubCrossEncoder()
+            if name == "batched":
+                model = BatchedCrossEncoder(model, batch_size=32, max_wait=0.005)
+            result = run(model, clients)
+            print(f"{clients:>3} clients {name:>12}: {result['pairs_per_second']:8.1f} pairs/s, "
+                  f"p50 {result['p50_ms']:7.1f} ms, p99 {result['p99_ms']:7.1f} ms")
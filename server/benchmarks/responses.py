@@ -0,0 +1,92 @@
+"""
+Serialization time and size of a typical /chat reply: 8 label sections of chunk_size characters, an answer and a
+two-turn compact history. "fastapi" is how the reply used to be sent (response_model validation and serialization,
+then JSONResponse's json.dumps), "orjson" how /chat sends it now (validated model dumped by orjson). Then the
+bytes on the wire and the time to compress them with gzip and brotli at the levels of CompressionMiddleware.
+
+Run from the server folder: python benchmarks/responses.py --documents 8
+"""
+import argparse
+import asyncio
+import glob
+import hashlib
+import os
+import re
+import statistics
+import sys
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path="rag/.env")
+
+ANSWER = "根據仿單，建議依照醫師指示服用，" * 20
+
+
+def sample_reply(documents, chunk_size):
+    chunks = []
+    for filename in sorted(glob.glob(os.path.join(os.getenv("data_directory"), "*.md"))):
+        with open(filename, encoding="utf-8") as f:
+            chunks += [(filename, p[:chunk_size]) for p in re.split(r"\n\s*\n", f.read()) if len(p) >= chunk_size]
+        if len(chunks) >= documents:
+            break
+    chunk_ids = [hashlib.md5(content.encode()).hexdigest() for _, content in chunks[:documents]]
+    return {
+        "reply": ANSWER,
+        "history": [{"role": "human", "content": "這個藥可以和其他藥一起吃嗎？"},
+                    {"role": "assistant", "content": ANSWER, "chunk_ids": chunk_ids}],
+        "documents": [{"s": source, "c": content, "provenance": 0.5} for source, content in chunks[:documents]],
+        "rewritten": False,
+        "question": "這個藥可以和其他藥一起吃嗎？",
+        "conversation_id": None,
+        "mode": "full",
+    }
+
+
+def timed(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return 1e6 * statistics.median(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    sys.path.insert(0, ".")
+    from fastapi.responses import JSONResponse, ORJSONResponse
+    from fastapi.routing import serialize_response
+    import main as server
+    from middleware import CompressionMiddleware, brotli
+
+    reply = sample_reply(args.documents, int(os.getenv("chunk_size", 512)))
+    field = next(route for route in server.app.routes if getattr(route, "path", None) == "/chat").response_field
+    loop = asyncio.new_event_loop()
+    serializers = {
+        "fastapi": lambda: JSONResponse(loop.run_until_complete(
+            serialize_response(field=field, response_content=reply))).body,
+        "orjson": lambda: ORJSONResponse(server.ChatResponse.model_validate(reply).model_dump()).body,
+    }
+    bodies = {}
+    for name, serialize in serializers.items():
+        microseconds, bodies[name] = timed(serialize, args.repeat)
+        print(f"{name:>8}: {microseconds:7.1f} us per reply, {len(bodies[name])} bytes")
+
+    middleware = CompressionMiddleware(None)
+    body = bodies["orjson"]
+    encodings = ["gzip"] + (["br"] if brotli is not None else [])
+    for encoding in encodings:
+        microseconds, compressed = timed(lambda: middleware.compress(encoding, body), args.repeat // 10)
+        print(f"{encoding:>8}: {microseconds:7.1f} us per reply, {len(compressed)} bytes "
+              f"({len(compressed) / len(body):.0%})")
+    if brotli is None:
+        print("brotli is not installed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Time to a ready index per startup phase, on a synthetic chunk pickle: building everything from the pickle (no
+bundle), the first start that also writes the index bundle, and starts from the bundle. The vector store is an
+empty Chroma collection and the reranker is off unless --rerank is given, so the numbers are about the chunks
+and BM25.
+
+Run from the server folder: python benchmarks/startup.py --chunks 20000 100000
+Every start runs in its own process, like a new worker.
+"""
+import argparse
+import json
+import os
+import pickle
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, ".")
+
+WORDS = ["venlafaxine", "dose", "mg", "tablet", "hepatic", "renal", "impairment", "adverse", "reactions",
+         "pregnancy", "children", "contraindicated", "warnings", "precautions", "clinical", "trials", "patients",
+         "藥品", "劑量", "副作用", "警語", "治療", "臨床", "肝功能", "腎功能"]
+
+
+def write_chunks(path, chunks, words=120):
+    from langchain_core.documents.base import Document
+    from rag.RAGHelper import identify_chunks
+
+    rng = random.Random(0)
+    docs = []
+    for i in range(chunks):
+        # 40 chunks per label, with a new section every 8
+        text = f"{i % 40 // 8 + 1} 段落\n" if i % 8 == 0 else ""
+        text += " ".join(rng.choice(WORDS) for _ in range(words)) + f" {i}"
+        docs.append(Document(page_content=text, metadata={"source": f"衛署藥製字第{i // 40:06d}號_測試藥.md"}))
+    with open(path, "wb") as f:
+        pickle.dump(identify_chunks(docs), f)
+
+
+def start(directory, bundle, rerank):
+    os.environ.update({"vector_store": "chroma", "persist_directory": os.path.join(directory, "chroma"),
+                       "vector_store_collection": "startup", "vector_store_initial_load": "False",
+                       "vector_store_k": "10", "vector_quantization": "none", "vector_truncate_dims": "",
+                       "document_chunks_pickle": os.path.join(directory, "chunks.pickle"),
+                       "index_bundle_directory": os.path.join(directory, "bundle") if bundle else "",
+                       "use_retrieval_cache": "False", "rerank": "True" if rerank else "False"})
+    begin = time.perf_counter()
+    if platform.system() == "Linux":
+        __import__('pysqlite3')
+        sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+    from langchain_community.embeddings import FakeEmbeddings
+    from rag.RAGHelper import RAGHelper
+    from rag.pipeline import peak_rss_mib
+    imported = time.perf_counter() - begin
+
+    helper = RAGHelper()
+    helper.embeddings = FakeEmbeddings(size=64)
+    helper.loadData()
+    print(json.dumps({"import": imported, **helper.startup_timings, "peak_rss_mib": peak_rss_mib()}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, nargs="+", default=[20000, 100000])
+    parser.add_argument("--rerank", action="store_true", help="Also load the reranker configured in rag/.env")
+    parser.add_argument("--start", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.start:
+        directory, bundle, rerank = args.start
+        start(directory, bundle == "bundle", rerank == "rerank")
+        return
+
+    if args.rerank:
+        from dotenv import load_dotenv
+        load_dotenv(dotenv_path="rag/.env")
+    for chunks in args.chunks:
+        with tempfile.TemporaryDirectory() as directory:
+            write_chunks(os.path.join(directory, "chunks.pickle"), chunks)
+            print(f"{chunks} chunks, {os.path.getsize(os.path.join(directory, 'chunks.pickle')) / 2 ** 20:.1f} MiB")
+            for label, bundle in [("no bundle", "none"), ("write bundle", "bundle"), ("from bundle", "bundle")]:
+                output = subprocess.run(
+                    [sys.executable, __file__, "--start", directory, bundle, "rerank" if args.rerank else "none"],
+                    capture_output=True, text=True, check=True).stdout
+                timings = json.loads(output.strip().splitlines()[-1])
+                rss = timings.pop("peak_rss_mib")
+                phases = "  ".join(f"{phase} {seconds:5.2f}" for phase, seconds in timings.items())
+                print(f"  {label:>12}: {sum(timings.values()):6.2f} s  ({phases})  peak RSS {rss:.0f} MiB")
+
+
+if __name__ == "__main__":
+    main()
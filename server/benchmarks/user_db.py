@@ -0,0 +1,117 @@
+"""
+Load test of the user database: concurrent registrations, logins, and user reads (GET /users/me with the
+authentication cache off, so every request loads the user) while other clients keep updating their accounts.
+Runs the account routes in process against a fresh SQLite file per engine configuration: "rollback" is the SQLite
+default the server used before (rollback journal, synchronous=FULL), "wal" the default now.
+
+Run from the server folder: python benchmarks/user_db.py --users 200 --concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+CONFIGS = {
+    "rollback": {"user_db_journal_mode": "DELETE", "user_db_synchronous": "FULL"},
+    "wal": {},
+}
+
+
+async def phase(requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(request):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                ok = (await request()).status_code < 300
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            errors += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(request) for request in requests))
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return {"req/s": len(requests) / seconds, "p50_ms": 1000 * statistics.median(latencies),
+                  "p99_ms": 1000 * latencies[int(0.99 * (len(latencies) - 1))], "errors": errors}
+
+
+async def load_test(users, concurrency, reads):
+    import httpx
+    from fastapi import FastAPI
+    from accounts.db import create_db_and_tables
+    from accounts.schemas import UserCreate, UserRead, UserUpdate
+    from accounts.users import auth_backend, fastapi_users
+
+    await create_db_and_tables()
+    app = FastAPI()
+    app.include_router(fastapi_users.get_auth_router(auth_backend), prefix="/auth/jwt")
+    app.include_router(fastapi_users.get_register_router(UserRead, UserCreate), prefix="/auth")
+    app.include_router(fastapi_users.get_users_router(UserRead, UserUpdate), prefix="/users")
+
+    results = {}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        emails = [f"load{i}@example.com" for i in range(users)]
+        results["register"] = await phase([
+            lambda email=email: client.post("/auth/register", json={"email": email, "password": "password"})
+            for email in emails], concurrency)
+
+        tokens = []
+
+        async def login(email):
+            response = await client.post("/auth/jwt/login", data={"username": email, "password": "password"})
+            if response.status_code == 200:
+                tokens.append(response.json()["access_token"])
+            return response
+
+        results["login"] = await phase([lambda email=email: login(email) for email in emails], concurrency)
+
+        # One in eight requests updates the account, the rest read it
+        def request(i):
+            headers = {"Authorization": f"Bearer {tokens[i % len(tokens)]}"}
+            if i % 8 == 0:
+                return lambda: client.patch("/users/me", json={"email": f"moved{i}@example.com"}, headers=headers)
+            return lambda: client.get("/users/me", headers=headers)
+
+        results["read/update"] = await phase([request(i) for i in range(reads)], concurrency)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--reads", type=int, default=2000)
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGS), choices=list(CONFIGS))
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        sys.path.insert(0, ".")
+        print(json.dumps(asyncio.run(load_test(args.users, args.concurrency, args.reads))))
+        return
+
+    for config in args.configs:
+        with tempfile.TemporaryDirectory() as directory:
+            env = {**os.environ, **CONFIGS[config], "auth_cache_ttl": "0", "jwt_key": "load-test",
+                   "user_database_url": f"sqlite+aiosqlite:///{os.path.join(directory, 'user.db')}"}
+            output = subprocess.run(
+                [sys.executable, __file__, "--run", "--users", str(args.users), "--concurrency",
+                 str(args.concurrency), "--reads", str(args.reads)],
+                env=env, capture_output=True, text=True, check=True).stdout
+            results = json.loads(output.strip().splitlines()[-1])
+        for name, result in results.items():
+            print(f"{config:>8} {name:>11}: {result['req/s']:7.1f} req/s, p50 {result['p50_ms']:6.1f} ms, "
+                  f"p99 {result['p99_ms']:7.1f} ms, {result['errors']} errors")
+
+
+if __name__ == "__main__":
+    main()
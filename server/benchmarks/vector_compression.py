@@ -0,0 +1,65 @@
+"""
+Memory footprint of the first-stage codes, query latency and recall@k of the compressed vector index for each
+truncation/quantization setting, against exact full-precision search.
+
+Run from the server folder:
+    python benchmarks/vector_compression.py                      # synthetic 1024-d vectors
+    python benchmarks/vector_compression.py --vectors rag/chroma/vectors
+The synthetic vectors are clustered and have most of their variance in the leading components, like
+Matryoshka-trained embeddings; use exported vectors for numbers that hold for a real model.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, ".")
+
+from rag.vector_index import CompressedVectorIndex, load_vectors
+
+SETTINGS = [(None, "none"), (512, "none"), (256, "none"), (None, "int8"), (256, "int8"), (None, "binary"),
+            (512, "binary")]
+
+
+def synthetic(n, dims, seed=0, cluster_size=50, noise=0.5):
+    rng = np.random.default_rng(seed)
+    decay = 1 / np.sqrt(1 + np.arange(dims) / 64)
+    centers = rng.normal(size=(max(n // cluster_size, 1), dims)) * decay
+    vectors = centers[rng.integers(0, len(centers), n)] + noise * rng.normal(size=(n, dims)) * decay
+    vectors = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+    return vectors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vectors")
+    parser.add_argument("--n", type=int, default=50000)
+    parser.add_argument("--dims", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--fetch-k", type=int, default=40)
+    args = parser.parse_args()
+
+    if args.vectors:
+        _, vectors = load_vectors(args.vectors)
+    else:
+        vectors = synthetic(args.n, args.dims)
+    rng = np.random.default_rng(1)
+    queries = np.asarray(vectors[rng.choice(len(vectors), args.queries, replace=False)])
+    queries = queries + 0.05 * rng.normal(size=queries.shape).astype(np.float32)
+    truth = [set(np.argsort(-(np.asarray(vectors) @ q))[:args.k]) for q in queries]
+
+    print(f"{len(vectors)} vectors of {vectors.shape[1]} dims, full precision {vectors.nbytes / 2 ** 20:.1f} MiB")
+    for dims, quantization in SETTINGS:
+        index = CompressedVectorIndex(vectors, dims=dims, quantization=quantization)
+        start = time.perf_counter()
+        found = [set(index.search(q, args.fetch_k)[0][:args.k]) for q in queries]
+        latency = (time.perf_counter() - start) / len(queries)
+        recall = np.mean([len(a & b) / args.k for a, b in zip(truth, found)])
+        print(f"dims {dims or vectors.shape[1]:>4} {quantization:>6}: {index.nbytes / 2 ** 20:7.1f} MiB, "
+              f"{latency * 1000:6.2f} ms/query, recall@{args.k} {recall:.3f}")
+
+
+if __name__ == "__main__":
+    main()
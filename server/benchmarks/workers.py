@@ -0,0 +1,175 @@
+"""
+Requests per second on /chat and total memory of the server for 1, 2, 4 and 8 gunicorn workers, with the index
+loaded once in the master and shared by forked workers (gunicorn.conf.py) against every worker loading its own.
+Total RSS counts pages shared between processes once per process, PSS splits them among the processes sharing
+them, so it is the memory the server actually uses.
+
+The LLM is replaced by a stub OpenAI-compatible endpoint answering after --llm-ms, everything else is configured
+by rag/.env (load the vector store first, vector_store_initial_load is turned off) and --set key=value. Logs in
+with the test account. Linux only (reads /proc).
+
+Run from the server folder: python benchmarks/workers.py --workers 1 2 4 8
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+QUESTIONS = [
+    "頭痛吃什麼藥?", "感冒藥可以和胃藥一起吃嗎?", "孕婦可以服用這個藥嗎?", "這個藥有什麼副作用?",
+    "Venlafaxine 的建議劑量是多少?", "藥品應該如何保存?", "肝功能不全的病人要調整劑量嗎?", "兒童可以使用嗎?",
+]
+
+
+def stub_llm(delay):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            time.sleep(delay)
+            # Starts with "no", so the rewrite loop does not rewrite
+            body = json.dumps({
+                "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": "stub",
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "no, see the label documents."}}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def memory(pid):
+    # RSS and PSS in MiB of a process and its children
+    pids = [pid] + [int(p) for p in os.listdir("/proc") if p.isdigit() and ppid(int(p)) == pid]
+    rss = pss = 0
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Rss:"):
+                        rss += int(line.split()[1])
+                    elif line.startswith("Pss:"):
+                        pss += int(line.split()[1])
+        except OSError:
+            pass
+    return rss / 1024, pss / 1024
+
+
+def ppid(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return int(f.read().rsplit(")", 1)[1].split()[1])
+    except OSError:
+        return None
+
+
+def wait_ready(url, workers, timeout):
+    # Every worker has to answer, requests land on any of them
+    deadline, consecutive = time.time() + timeout, 0
+    while consecutive < 4 * workers:
+        if time.time() > deadline:
+            raise TimeoutError("The server did not get ready")
+        try:
+            consecutive = consecutive + 1 if httpx.get(f"{url}/readyz").status_code == 200 else 0
+        except httpx.TransportError:
+            consecutive = 0
+        if consecutive == 0:
+            time.sleep(0.5)
+
+
+def run(workers, shared, args, env):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    command = [sys.executable, "-m", "gunicorn", "main:app"]
+    if shared:
+        command += ["-c", "gunicorn.conf.py"]
+    else:
+        # gunicorn reads ./gunicorn.conf.py unless given another config file
+        command += ["-c", args.empty_config, "-k", "uvicorn.workers.UvicornWorker", "-w", str(workers),
+                    "-b", f"127.0.0.1:{port}", "-t", "600"]
+    server = subprocess.Popen(command, env={**env, "web_workers": str(workers), "web_bind": f"127.0.0.1:{port}"},
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        start = time.perf_counter()
+        wait_ready(url, workers, timeout=600)
+        ready = time.perf_counter() - start
+
+        token = httpx.post(f"{url}/auth/jwt/login",
+                           data={"username": args.user, "password": args.password}).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        rng = random.Random(0)
+        prompts = [rng.choice(QUESTIONS) + f" ({i})" for i in range(args.requests)]
+
+        def chat(prompt):
+            response = httpx.post(f"{url}/chat", json={"prompt": prompt}, headers=headers, timeout=120)
+            return response.status_code == 200
+
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            # Warm every worker up first
+            list(pool.map(chat, prompts[:2 * workers]))
+            start = time.perf_counter()
+            ok = sum(pool.map(chat, prompts))
+            seconds = time.perf_counter() - start
+        rss, pss = memory(server.pid)
+        print(f"{workers} workers, {'shared index' if shared else 'own index  '}: {ok / seconds:6.1f} req/s "
+              f"({args.requests - ok} failed), total RSS {rss:6.0f} MiB, PSS {pss:6.0f} MiB, ready after {ready:.1f} s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--llm-ms", type=float, default=50, help="Latency of the stub LLM")
+    parser.add_argument("--user", default="user@gmail.com")
+    parser.add_argument("--password", default="1111")
+    parser.add_argument("--set", nargs="*", default=[], metavar="KEY=VALUE", help="Override rag/.env settings")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path="rag/.env")
+    llm_port = stub_llm(args.llm_ms / 1000)
+    env = {**os.environ, "use_openai": "True", "use_gemini": "False", "use_azure": "False", "use_ollama": "False",
+           "OPENAI_API_BASE": f"http://127.0.0.1:{llm_port}/v1", "OPENAI_API_KEY": "stub",
+           "vector_store_initial_load": "False", **dict(setting.split("=", 1) for setting in args.set)}
+    if env.get("index_bundle_directory"):
+        # Build the bundle first, else the first start builds the index in memory and writes it
+        subprocess.run([sys.executable, "-m", "rag.index_bundle"], env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with tempfile.NamedTemporaryFile(suffix=".py") as empty_config:
+        args.empty_config = empty_config.name
+        for workers in args.workers:
+            for shared in [True, False]:
+                run(workers, shared, args, env)
+
+
+if __name__ == "__main__":
+    main()
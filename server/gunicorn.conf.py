@@ -0,0 +1,38 @@
+"""
+Multi-worker deployment: the master process loads the indexes once (chunks, BM25, memory-mapped vectors and
+models) and forks the workers, which share them copy-on-write instead of each building their own copy.
+
+Run from the server folder:
+    gunicorn -c gunicorn.conf.py main:app
+"""
+import gc
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path="rag/.env")
+
+bind = os.getenv("web_bind", "0.0.0.0:8000")
+workers = int(os.getenv("web_workers", 4))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Import main in the master, so load_rag can run there before forking
+preload_app = True
+# Loading happens before the workers start, a request may still take up to the middleware's timeout
+timeout = 180
+
+
+def when_ready(server):
+    import main
+    main.load_rag()
+    if not main.ready.is_set():
+        raise RuntimeError(f"Loading the RAG helper failed: {main.load_state['error']}")
+    # Objects that exist now are never collected, so collections in the workers don't write to their pages
+    # and copy them
+    gc.collect()
+    gc.freeze()
+    server.log.info(f"Index loaded in {main.load_state['seconds']:.1f} s, forking {workers} workers")
+
+
+def post_fork(server, worker):
+    import main
+    main.after_fork(workers)
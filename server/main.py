@@ -1,19 +1,25 @@
-from fastapi.responses import FileResponse
-from rag.RAGHelper_cloud import RAGHelperCloud
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse
+from rag.sessions import SessionStore
 from fastapi import FastAPI, HTTPException, Depends
+import anyio
 import platform
 from accounts.db import User, create_db_and_tables
 from accounts.schemas import UserCreate, UserRead, UserUpdate
-from accounts.users import auth_backend, current_active_user, fastapi_users
+from accounts.users import auth_backend, current_active_user, fastapi_users, user_cache
 from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
-from middleware import TimeoutMiddleware
+from admission import AdmissionController, Rejected
+from middleware import CompressionMiddleware, TimeoutMiddleware
+from rag import deadline
 from pydantic import BaseModel
 import logging
 import os
+import threading
+import time
+import uuid
 from dotenv import load_dotenv
 import uvicorn
-from typing import List, Optional, Dict
+from typing import List, Optional
 
 if platform.system() == "Linux":
     __import__('pysqlite3')
@@ -27,6 +33,8 @@ if platform.system() == "Linux":
 async def lifespan(app: FastAPI):
     # Not needed if you setup a migration system like Alembic
     await create_db_and_tables()
+    # Serve /healthz and /readyz while the indexes load
+    threading.Thread(target=load_rag, name="load-rag", daemon=True).start()
     yield
 
 
@@ -80,26 +88,155 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 # Load environment variables from .env file
 load_dotenv(dotenv_path="rag/.env")
 
-# Instantiate the RAG Helper class based on the environment configuration
-if any(os.getenv(key) == "True" for key in ["use_openai", "use_gemini", "use_azure", "use_ollama"]):
-    logger.info("Instantiating the cloud RAG helper.")
-    raghelper = RAGHelperCloud(logger)
+# Set by load_rag once the indexes are loaded, the RAG endpoints answer 503 until then
+raghelper = None
+sessions = None
+ingestion_jobs = None
+ready = threading.Event()
+load_state = {"started": None, "seconds": None, "error": None}
+load_lock = threading.Lock()
+# Worker processes serving the app, set by after_fork; only a single one can add documents
+web_workers = 1
+
+# Bounds the /chat pipelines running at once and how many each user can start, so a burst from one client
+# neither starves the others nor exhausts the LLM quota
+admission = None
+if os.getenv("use_admission_control") == "True":
+    admission = AdmissionController(
+        max_concurrent=int(os.getenv("admission_max_concurrent", 8)),
+        max_queue=int(os.getenv("admission_queue_size", 32)),
+        queue_timeout=float(os.getenv("admission_queue_timeout", 10)),
+        user_rate=float(os.getenv("user_requests_per_minute", 30)) / 60,
+        user_burst=int(os.getenv("user_request_burst", 10)),
+        user_concurrency=int(os.getenv("user_max_concurrent", 2)),
+    )
+
+# Chat replies carry the full text of every document, compress them for clients that accept it
+if os.getenv("use_response_compression", "True") == "True":
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=int(os.getenv("response_compression_min_bytes", 1024)),
+        gzip_level=int(os.getenv("response_gzip_level", 6)),
+        brotli_quality=int(os.getenv("response_brotli_quality", 5)),
+    )
+
+
+def load_rag():
+    """
+    Build the RAG helper, which loads the indexes and models, and the components that depend on it. Runs once,
+    on a background thread from the lifespan handler, or before that (e.g. in a preloading server process).
+    """
+    global raghelper, sessions, ingestion_jobs
+    with load_lock:
+        if load_state["started"] is not None:
+            return
+        load_state["started"] = time.time()
+    start = time.perf_counter()
+    try:
+        # Imported here, so the LangChain and provider modules are not loaded on the import path of the app
+        from rag.RAGHelper_cloud import RAGHelperCloud
+        from rag.ingest_jobs import IngestionJobs
+
+        # Instantiate the RAG Helper class based on the environment configuration
+        if not any(os.getenv(key) == "True" for key in ["use_openai", "use_gemini", "use_azure", "use_ollama"]):
+            raise ValueError("No LLM provider configured, set one of use_openai, use_gemini, use_azure or use_ollama")
+        logger.info("Instantiating the cloud RAG helper.")
+        helper = RAGHelperCloud(logger)
+
+        # Keep conversations server-side so clients don't have to send the whole history with every request
+        if os.getenv("use_sessions") == "True":
+            sessions = SessionStore(
+                helper.summarize_history,
+                max_turns=int(os.getenv("session_max_turns", 4)),
+                ttl=int(os.getenv("session_ttl", 3600)),
+                max_sessions=int(os.getenv("session_max_sessions", 1000)),
+            )
+
+        # Documents are added on a background worker, several uploads at a time
+        ingestion_jobs = IngestionJobs(
+            helper.addDocuments,
+            max_batch_size=int(os.getenv("ingest_batch_size", 16)),
+            max_wait=float(os.getenv("ingest_batch_max_wait_ms", 2000)) / 1000,
+            max_jobs=int(os.getenv("ingest_jobs_kept", 1000)),
+        )
+
+        # Optionally run one query through retrieval, so the first request does not pay for lazy initialization
+        if os.getenv("warmup_query"):
+            helper.context_retriever.invoke(os.getenv("warmup_query"))
+        raghelper = helper
+    except Exception as e:
+        logger.exception("Loading the RAG helper failed")
+        load_state["error"] = repr(e)
+        return
+    load_state["seconds"] = time.perf_counter() - start
+    logger.info(f"Ready after {load_state['seconds']:.1f} s")
+    ready.set()
+
+
+def after_fork(workers=1):
+    """Prepare one of workers processes forked from a process that already ran load_rag (see gunicorn.conf.py)."""
+    global web_workers
+    web_workers = workers
+    if raghelper is not None:
+        raghelper.afterFork()
+        ingestion_jobs.after_fork()
+
+
+@app.exception_handler(deadline.DeadlineExceeded)
+async def deadline_exceeded(request, exc):
+    # A stage noticed the timeout before TimeoutMiddleware did
+    return JSONResponse(status_code=504, content={"detail": str(exc)})
+
+
+@app.exception_handler(Rejected)
+async def rejected(request, exc):
+    return JSONResponse(status_code=exc.status_code, content={"detail": f"Too many requests ({exc.reason})"},
+                        headers={"Retry-After": str(exc.retry_after)})
+
+
+def require_ready():
+    if not ready.is_set():
+        raise HTTPException(status_code=503, detail="The index is still loading", headers={"Retry-After": "5"})
+
+
+@app.get("/healthz", tags=['health'])
+async def healthz():
+    """
+    Liveness: the process serves requests, also while the indexes are still loading.
+    """
+    return {"status": "ok"}
+
+
+@app.get("/readyz", tags=['health'])
+async def readyz():
+    """
+    Readiness: whether the indexes are loaded and the RAG endpoints can be used.
+
+    Returns:
+        JSON response with the status (loading, ready or failed) and the seconds per startup phase once ready,
+        HTTP status code 503 unless ready.
+    """
+    if ready.is_set():
+        return {"status": "ready", "seconds": load_state["seconds"], "phases": raghelper.startup_timings}
+    status = "failed" if load_state["error"] is not None else "loading"
+    return JSONResponse({"status": status, "error": load_state["error"]}, status_code=503)
 
 
 class Document(BaseModel):
     filename: str
 
 
-@app.post("/add_local_document", tags=['RAG'])
+@app.post("/add_local_document", tags=['RAG'], dependencies=[Depends(require_ready)])
 async def add_document(doc: Document, user: User = Depends(current_active_user)):
     """
     Add a document to the RAG helper.
 
     This endpoint expects a JSON payload containing the filename of the document to be added.
-    It then invokes the addDocument method of the RAG helper to store the document.
+    The document is queued for the background ingestion worker, which adds queued documents in batches.
+    Refused with 409 when several worker processes serve the app.
 
     Returns:
-        JSON response with the filename.
+        JSON response with the filename and the ID of the ingestion job, see /ingest_jobs/{job_id}.
     """
     filename = doc.filename
 
@@ -110,35 +247,68 @@ async def add_document(doc: Document, user: User = Depends(current_active_user))
     if not any(filename.endswith(ext) for ext in file_types):
         raise HTTPException(status_code=400, detail="invalid filetype")
 
-    logger.info(f"Adding document {filename}")
-    raghelper.addDocument(filename)
+    # Every worker has its own index and Chroma does not support writes from several processes, so a document
+    # added by one worker would be missing from the others
+    if web_workers > 1:
+        raise HTTPException(status_code=409, detail="Documents cannot be added while several workers serve, "
+                                                    "run the server with web_workers=1 to add them")
+
+    # Loading, embedding and rebuilding the indexes happen on the background ingestion worker
+    job = ingestion_jobs.submit([filename])
+    logger.info(f"Queued document {filename} as ingestion job {job['id']}")
+
+    return {"filename": filename, "job_id": job["id"], "status": job["status"]}
+
+
+@app.get("/ingest_jobs/{job_id}", tags=['RAG'], dependencies=[Depends(require_ready)])
+async def ingest_job(job_id: str, user: User = Depends(current_active_user)):
+    """
+    Report the status of an ingestion job queued by /add_local_document.
 
-    return {"filename": filename}
+    Returns:
+        JSON response with the status (queued, loading, embedding, indexing, done or failed), the files, the
+        timestamps, the number of files in the index update it was part of, the seconds per phase and the
+        error per file that could not be loaded.
+    """
+    job = ingestion_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Ingestion job not found")
+    return job
 
 
 class ChatRequest(BaseModel):
     prompt: str
     history: list = []
     docs: list = []
+    conversation_id: Optional[str] = None  # server-side session, history is ignored when set
 
 
 # Response models
+class HistoryMessage(BaseModel):
+    role: str
+    content: str
+    chunk_ids: Optional[List[str]] = None  # chunks the answer was based on (assistant turns only)
+
+
 class DocumentResponse(BaseModel):
     s: str  # source
     c: str  # content
     pk: Optional[str] = None  # primary key (if present)
     provenance: Optional[float] = None  # provenance score (if present)
+    highlights: Optional[List[str]] = None  # sentences matching the question (extractive answers only)
 
 
 class ChatResponse(BaseModel):
     reply: str
-    history: List[Dict[str, str]]
+    history: List[HistoryMessage]
     documents: List[DocumentResponse]
     rewritten: bool
     question: str
+    conversation_id: Optional[str] = None
+    mode: str = "full"  # full, degraded (optional stages skipped to stay in time) or extractive (no LLM answer)
 
 
-@app.post("/chat", response_model=ChatResponse, tags=['RAG'])
+@app.post("/chat", response_model=ChatResponse, tags=['RAG'], dependencies=[Depends(require_ready)])
 async def chat(request: ChatRequest, user: User = Depends(current_active_user)):
     """
     Handle chat interactions with the RAG system.
@@ -153,15 +323,40 @@ async def chat(request: ChatRequest, user: User = Depends(current_active_user)):
     history = request.history
     original_docs = request.docs
     docs = original_docs
+    summary = None
+    conversation_id = request.conversation_id
+    if sessions is not None:
+        conversation_id = conversation_id or uuid.uuid4().hex
+        summary, history = sessions.get(user.id, conversation_id)
 
     # Get the LLM response
-    (new_history, response) = raghelper.handle_user_interaction(prompt, history)
+    # Run the pipeline in a worker thread so concurrent requests overlap instead of queueing on the event loop.
+    # On a timeout the request does not wait for the thread, which stops at its next deadline check; with admission
+    # control it keeps its slot until then
+    if admission is not None:
+        (_, response) = await admission.run_sync(user.id, raghelper.handle_user_interaction, prompt, history, summary)
+    else:
+        (_, response) = await anyio.to_thread.run_sync(raghelper.handle_user_interaction, prompt, history, summary,
+                                                       abandon_on_cancel=True)
     if not docs or 'docs' in response:
         docs = response['docs']
-    # Populate history for other LLMs
-    new_history = [{"role": msg[0], "content": msg[1].format_map(response)} for msg in new_history]
-    new_history.append({"role": "assistant", "content": response['answer']})
     reply = response['answer']
+    # Keep the history compact: only the turns and the IDs of the chunks the answer used, the server
+    # re-fetches the context from its chunk store when a follow-up needs it
+    if 'docs' in response:
+        chunk_ids = [doc.metadata['id'] for doc in response['docs'] if 'id' in doc.metadata]
+    else:
+        chunk_ids = raghelper.history_chunk_ids(history)
+    turn = [
+        {"role": "human", "content": prompt},
+        {"role": "assistant", "content": reply, "chunk_ids": chunk_ids},
+    ]
+    if sessions is not None:
+        new_history = sessions.append(user.id, conversation_id, turn)
+    elif 'docs' in response:
+        new_history = turn
+    else:
+        new_history = [msg for msg in history if msg['role'] != 'system' or not chunk_ids] + turn
 
     # Format documents
     if not original_docs or 'docs' in response:
@@ -169,7 +364,8 @@ async def chat(request: ChatRequest, user: User = Depends(current_active_user)):
             's': doc.metadata['source'],
             'c': doc.page_content,
             **({'pk': doc.metadata['pk']} if 'pk' in doc.metadata else {}),
-            **({'provenance': float(doc.metadata['provenance'])} if 'provenance' in doc.metadata else {})
+            **({'provenance': float(doc.metadata['provenance'])} if 'provenance' in doc.metadata else {}),
+            **({'highlights': doc.metadata['highlights']} if 'highlights' in doc.metadata else {})
         } for doc in docs if 'source' in doc.metadata]
     else:
         new_docs = docs
@@ -180,7 +376,9 @@ async def chat(request: ChatRequest, user: User = Depends(current_active_user)):
         "history": new_history,
         "documents": new_docs,
         "rewritten": False,
-        "question": prompt
+        "question": prompt,
+        "conversation_id": conversation_id,
+        "mode": response.get("mode", "full")
     }
 
     # Check for rewritten question
@@ -188,7 +386,37 @@ async def chat(request: ChatRequest, user: User = Depends(current_active_user)):
         response_dict["rewritten"] = True
         response_dict["question"] = response['question']
 
-    return response_dict
+    # Validated here and dumped by orjson, FastAPI's own serialization (jsonable_encoder, then json) of a reply
+    # with several full documents costs more than the validation
+    return ORJSONResponse(ChatResponse.model_validate(response_dict).model_dump())
+
+
+@app.get("/metrics", tags=['RAG'], dependencies=[Depends(require_ready)])
+async def metrics():
+    """
+    Report cache, batching, ingestion and LLM routing statistics of the RAG pipeline, and of the authentication cache.
+
+    Returns:
+        JSON response with one entry per enabled component.
+    """
+    stats = {}
+    if raghelper.answer_cache is not None:
+        stats["answer_cache"] = raghelper.answer_cache.stats()
+    if raghelper.retrieval_cache is not None:
+        stats["retrieval_cache"] = raghelper.retrieval_cache.stats()
+    if hasattr(raghelper.embeddings, "batcher"):
+        stats["embedding_batcher"] = raghelper.embeddings.batcher.stats()
+    if hasattr(getattr(raghelper, "cross_encoder", None), "batcher"):
+        stats["rerank_batcher"] = raghelper.cross_encoder.batcher.stats()
+    stats["ingestion"] = ingestion_jobs.stats()
+    stats["deadlines"] = deadline.stats()
+    stats["degradation"] = raghelper.degradationStats()
+    if hasattr(raghelper.llm, "providers"):
+        stats["llm_router"] = raghelper.llm.stats()
+    if admission is not None:
+        stats["admission"] = admission.stats()
+    stats["auth_cache"] = user_cache.stats()
+    return stats
 
 
 # Response model for list of document filenames
@@ -1,16 +1,118 @@
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
+import gzip
+import math
+
+import anyio
+from starlette.datastructures import Headers, MutableHeaders
 from starlette.responses import Response
-import asyncio
 
+from rag.deadline import reset_deadline, set_deadline
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class TimeoutMiddleware:
+    """
+    Answers 504 to requests that take more than timeout seconds to start their response, and sets that deadline
+    in rag.deadline so the RAG stages still running for a timed-out request stop at their next check. A response
+    that has started (a file download) is not cut off. Plain ASGI, so response bodies pass through unbuffered.
+    """
 
-class TimeoutMiddleware(BaseHTTPMiddleware):
     def __init__(self, app, timeout: int = 60):
-        super().__init__(app)
+        self.app = app
         self.timeout = timeout
 
-    async def dispatch(self, request: Request, call_next) -> Response:
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = False
+        token = set_deadline(self.timeout)
         try:
-            return await asyncio.wait_for(call_next(request), timeout=self.timeout)
-        except asyncio.TimeoutError:
-            return Response("Request timed out", status_code=504)
+            with anyio.CancelScope(deadline=anyio.current_time() + self.timeout) as cancel_scope:
+                async def send_started(message):
+                    nonlocal started
+                    if message["type"] == "http.response.start":
+                        started = True
+                        cancel_scope.deadline = math.inf
+                    await send(message)
+
+                await self.app(scope, receive, send_started)
+        finally:
+            reset_deadline(token)
+        if cancel_scope.cancelled_caught and not started:
+            await Response("Request timed out", status_code=504)(scope, receive, send)
+
+
+def accepted_encoding(accept_encoding, available):
+    """The first of available the client accepts (q > 0) in its Accept-Encoding header, or None."""
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        encoding, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[encoding.strip()] = q
+    for encoding in available:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+class CompressionMiddleware:
+    """
+    Compresses response bodies of at least minimum_size bytes with brotli if installed and accepted by the client,
+    else with gzip if accepted. Only responses sent in one piece are compressed, streamed ones (file downloads, mostly
+    PDFs that are compressed already) and ones with a Content-Encoding pass through as they are.
+    """
+
+    def __init__(self, app, minimum_size=1024, gzip_level=6, brotli_quality=5):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+    def compress(self, encoding, body):
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = accepted_encoding(Headers(scope=scope).get("accept-encoding", ""), self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                # Held back until the body shows whether it comes in one piece
+                start = message
+                return
+            if start is not None:
+                headers = MutableHeaders(scope=start)
+                body = message.get("body", b"")
+                if (not message.get("more_body", False) and len(body) >= self.minimum_size
+                        and "content-encoding" not in headers):
+                    body = self.compress(encoding, body)
+                    headers["Content-Encoding"] = encoding
+                    headers["Content-Length"] = str(len(body))
+                    headers.add_vary_header("Accept-Encoding")
+                    message = {**message, "body": body}
+                await send(start)
+                start = None
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
@@ -1,32 +1,32 @@
+import copy
+import logging
 import os
 import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from tqdm import tqdm
 import hashlib
 
-from .ScoredCrossEncoderReranker import ScoredCrossEncoderReranker
+from .ScoredCrossEncoderReranker import DeadlineCompressor, ScoredCrossEncoderReranker
+from .retrieval_cache import RetrievalCache, CachedRetriever
+from .batching import BatchedCrossEncoder
+from .vector_index import CompressedVectorIndex, VectorIndexRetriever, export_vectors, load_vectors
+from .local_index import IVFIndex
+from .ingest import discover, load_file, read_chunks, init_worker, load_and_split
+from .pipeline import Pipeline
+from .index_generation import IndexGeneration
+from .index_bundle import is_current, load_bundle, write_bundle
+from .sparse_index import BM25Index
 
 from langchain_core.documents.base import Document
+from langchain_core.runnables import RunnableLambda
 from langchain.retrievers import EnsembleRetriever
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_experimental.text_splitter import SemanticChunker
-from langchain_community.vectorstores import Chroma
 from langchain_community.retrievers import BM25Retriever
 from langchain.retrievers import ContextualCompressionRetriever
-from langchain.retrievers.document_compressors import FlashrankRerank
-from langchain_community.cross_encoders import HuggingFaceCrossEncoder
-
-from langchain_community.document_loaders import PyPDFLoader, UnstructuredMarkdownLoader
-from langchain_community.document_loaders import PyPDFDirectoryLoader
-from langchain_community.document_loaders import JSONLoader
-from langchain_community.document_loaders import DirectoryLoader
-from langchain_community.document_loaders import Docx2txtLoader
-from langchain_community.document_loaders import TextLoader
-from langchain_community.document_loaders import UnstructuredExcelLoader
-from langchain_community.document_loaders import UnstructuredPowerPointLoader
-from langchain_community.document_loaders.csv_loader import CSVLoader
-
-from lxml import etree
+
 import pickle
 
 
@@ -51,344 +51,593 @@ def extract_source(filename):
     return " ".join(parts)
 
 
+# Numbered section headings of a label, e.g. "5 警語及注意事項", a short line with a Chinese title (so
+# numbered lines such as "30 mg 每天一次" are not headings)
+SECTION_HEADING = re.compile(r"^(\d{1,2}) [\u4e00-\u9fff][^\n]{0,30}$", re.MULTILINE)
+
+
+def file_stem(source):
+    return os.path.splitext(os.path.basename(source.replace("\\", "/")))[0]
+
+
+# Label files are named after their license number, e.g. 衛署藥製字第048875號_康緒平緩釋膠囊 75 毫克.md
+def license_number(source):
+    return file_stem(source).split("_")[0]
+
+
+def identify_chunks(chunks, licenses=None):
+    """
+    Prefix split chunks with their source and give them two IDs: a stable chunk ID made of the license number,
+    section and position within the section (衛署藥製字第048875號/5/3), and a content ID, the hash of the text.
+    Labels that share a paragraph share its content ID, so it is only embedded and stored once.
+    All chunks of a file must be in one call; pass the same licenses dict to calls for different files.
+    """
+    identified, positions = [], {}
+    licenses = {} if licenses is None else licenses
+    for doc in chunks:
+        source = doc.metadata['source']
+        if source not in positions:
+            label = license_number(source)
+            # Two files with the same license number are told apart by their full name
+            if licenses.setdefault(label, source) != source:
+                label = file_stem(source)
+            positions[source] = (label, 0, 0)
+        label, section, position = positions[source]
+        # A chunk that starts with a heading is the first chunk of that section
+        heading = SECTION_HEADING.match(doc.page_content.lstrip())
+        if heading and int(heading.group(1)) > section:
+            section, position = int(heading.group(1)), 0
+
+        metadata = {**doc.metadata, 'id': f"{label}/{section}/{position}",
+                    'content_id': hashlib.md5(doc.page_content.encode()).hexdigest()}
+        identified.append(Document(page_content=extract_source(source) + doc.page_content, metadata=metadata))
+
+        # A heading further down starts numbering the following chunks from 0 again. Any later section does,
+        # labels skip sections they have nothing for
+        position += 1
+        for match in SECTION_HEADING.finditer(doc.page_content):
+            if int(match.group(1)) > section:
+                section, position = int(match.group(1)), 0
+        positions[source] = (label, section, position)
+    return identified
+
+
+# Chunk text without the source prefix that identify_chunks added
+def chunk_text(doc):
+    prefix = extract_source(doc.metadata['source'])
+    return doc.page_content[len(prefix):] if doc.page_content.startswith(prefix) else doc.page_content
+
+
+def load_chunks(path):
+    chunks = read_chunks(path)
+    # Chunks stored before they had stable IDs only have the hash of their text as ID
+    if len(chunks) > 0 and 'content_id' not in chunks[0].metadata:
+        chunks = identify_chunks([
+            Document(page_content=chunk_text(doc),
+                     metadata={key: value for key, value in doc.metadata.items() if key != 'id'})
+            for doc in chunks
+        ])
+        with open(path, 'wb') as f:
+            pickle.dump(chunks, f)
+    return chunks
+
+
+# HNSW settings of the Chroma collection, Chroma only applies them when the collection is created
+# (python -m rag.maintain_chroma rebuilds an existing collection with the current settings)
+def chromaMetadata():
+    settings = {
+        "hnsw:M": "chroma_hnsw_m",
+        "hnsw:construction_ef": "chroma_hnsw_construction_ef",
+        "hnsw:search_ef": "chroma_hnsw_search_ef",
+        "hnsw:batch_size": "chroma_hnsw_batch_size",
+        "hnsw:sync_threshold": "chroma_hnsw_sync_threshold",
+    }
+    metadata = {key: int(os.getenv(name)) for key, name in settings.items() if os.getenv(name)}
+    return metadata or None
+
+
+logger = logging.getLogger(__name__)
+
+
 class RAGHelper:
     # Loads the data and chunks it into an ensemble retriever
     def loadData(self):
-        persist_directory = f"{os.getenv('persist_directory')}"
         document_chunks_pickle = f"{os.getenv('document_chunks_pickle')}"
-
-        if os.path.exists(document_chunks_pickle):
-            with open(document_chunks_pickle, 'rb') as f:
-                self.chunked_documents = pickle.load(f)
+        initial_load = os.getenv("vector_store_initial_load") == "True"
+        bundle_directory = os.getenv("index_bundle_directory")
+
+        # Seconds per startup phase
+        self.startup_timings = {}
+        clock = [time.perf_counter()]
+
+        def lap(phase):
+            now = time.perf_counter()
+            self.startup_timings[phase] = now - clock[0]
+            clock[0] = now
+
+        self.openVectorStore()
+        if os.getenv("vector_store") == "local_ivf":
+            initial_load = initial_load or not os.path.exists(self.localIndexFile())
+        lap("vector_store")
+
+        # A prebuilt bundle of the chunk pickle has the chunks with their BM25 postings and field indexes
+        bundle, ingested = None, False
+        if bundle_directory and os.path.exists(document_chunks_pickle) and \
+                is_current(bundle_directory, document_chunks_pickle):
+            bundle = load_bundle(bundle_directory)
+
+        if bundle is not None:
+            chunks, vectorizer, content_index = bundle
+        elif os.path.exists(document_chunks_pickle):
+            chunks = load_chunks(document_chunks_pickle)
         else:
-            # Load PDF files if need be
-            docs = []
-            data_dir = os.getenv('data_directory')
-            file_types = os.getenv("file_types").split(",")
-            if "pdf" in file_types:
-                loader = PyPDFDirectoryLoader(data_dir)
-                docs = docs + loader.load()
-            # Load JSON
-            if "json" in file_types:
-                text_content = True
-                if os.getenv("json_text_content").lower() == 'false':
-                    text_content = False
-                loader_kwargs = {
-                    'jq_schema': os.getenv("json_schema"),
-                    'text_content': text_content
-                }
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.json",
-                    loader_cls=JSONLoader,
-                    loader_kwargs=loader_kwargs,
-                    recursive=True,
-                    show_progress=True,
-                )
-                docs = docs + loader.load()
-            # Load TXT
-            if "txt" in file_types:
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.txt",
-                    loader_cls=TextLoader,
-                    recursive=True,
-                    show_progress=True,
-                )
-                docs = docs + loader.load()
-            # Load CSV
-            if "csv" in file_types:
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.csv",
-                    loader_cls=CSVLoader,
-                    recursive=True,
-                    show_progress=True,
-                )
-                docs = docs + loader.load()
-            # Load MS Word
-            if "docx" in file_types:
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.docx",
-                    loader_cls=Docx2txtLoader,
-                    recursive=True,
-                    show_progress=True,
-                )
-                docs = docs + loader.load()
-            # Load MS Excel
-            if "xlsx" in file_types:
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.xlsx",
-                    loader_cls=UnstructuredExcelLoader,
-                    recursive=True,
-                    show_progress=True,
-                )
-                docs = docs + loader.load()
-            # load md
-            if "md" in file_types:
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.md",
-                    loader_cls=UnstructuredMarkdownLoader,
-                    recursive=True,
-                    show_progress=True,
-                )
-                docs = docs + loader.load()
-            # Load MS PPT
-            if "pptx" in file_types:
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.pptx",
-                    loader_cls=UnstructuredPowerPointLoader,
-                    recursive=True,
-                    show_progress=True,
-                )
-                docs = docs + loader.load()
-            # Load XML, which is nasty
-            if "xml" in file_types:
-                loader = DirectoryLoader(
-                    path=data_dir,
-                    glob="*.xml",
-                    loader_cls=TextLoader,
-                    recursive=True,
-                    show_progress=True,
-                )
-                xmldocs = loader.load()
-                newdocs = []
-                for index, doc in enumerate(xmldocs):
-                    xmltree = etree.fromstring(doc.page_content.encode('utf-8'))
-                    elements = xmltree.xpath(os.getenv("xml_xpath"))
-                    elements = [etree.tostring(element, pretty_print=True).decode() for element in elements]
-                    metadata = doc.metadata
-                    metadata['index'] = index
-                    newdocs = newdocs + [Document(page_content=doc, metadata=metadata) for doc in elements]
-                docs = docs + newdocs
-
-            if os.getenv('splitter') == 'RecursiveCharacterTextSplitter':
-                if os.getenv("use_blank_line_as_separator") == "True":
-                    self.text_splitter = RecursiveCharacterTextSplitter(
-                        chunk_size=int(os.getenv('chunk_size')),
-                        chunk_overlap=int(os.getenv('chunk_overlap')),
-                        length_function=len,
-                        keep_separator=True,
-                        separators=[
-                            r'\n\s*\n',
-                            r"\n \n",
-                            r"\n\n",
-                            r"\n",
-                            r" ",
-                        ],
-                        is_separator_regex=True
-                    )
-                else:
-                    self.text_splitter = RecursiveCharacterTextSplitter(
-                        chunk_size=int(os.getenv('chunk_size')),
-                        chunk_overlap=int(os.getenv('chunk_overlap')),
-                        length_function=len,
-                        keep_separator=True,
-                        separators=[
-                            "\n \n",
-                            "\n\n",
-                            "\n",
-                            ".",
-                            "!",
-                            "?",
-                            " ",
-                            ",",
-                            "\u200b",  # Zero-width space
-                            "\uff0c",  # Fullwidth comma
-                            "\u3001",  # Ideographic comma
-                            "\uff0e",  # Fullwidth full stop
-                            "\u3002",  # Ideographic full stop
-                            "",
-                        ],
-                    )
-            elif os.getenv('splitter') == 'SemanticChunker':
-                breakpoint_threshold_amount = None
-                number_of_chunks = None
-                if os.getenv('breakpoint_threshold_amount') != 'None':
-                    breakpoint_threshold_amount = float(os.getenv('breakpoint_threshold_amount'))
-                if os.getenv('number_of_chunks') != 'None':
-                    number_of_chunks = int(os.getenv('number_of_chunks'))
-                self.text_splitter = SemanticChunker(
-                    self.embeddings,
-                    breakpoint_threshold_type=os.getenv('breakpoint_threshold_type'),
-                    breakpoint_threshold_amount=breakpoint_threshold_amount,
-                    number_of_chunks=number_of_chunks
-                )
-
-            # Add a hash as ID to each document chunk's metadata and source to content
-            self.chunked_documents = [
-                Document(page_content=extract_source(doc.metadata['source']) + doc.page_content,
-                         metadata={**doc.metadata, 'id': hashlib.md5(doc.page_content.encode()).hexdigest()})
-                for doc in self.text_splitter.split_documents(docs)
-            ]
+            self.text_splitter = self.buildSplitter()
+            # Stream the files through loading, splitting and vectorizing, then read the chunks back
+            self.ingest(discover(os.getenv('data_directory'), os.getenv("file_types").split(",")),
+                        chunks_file=document_chunks_pickle, vectorize=initial_load)
+            chunks = read_chunks(document_chunks_pickle)
+            ingested = True
+        lap("chunks")
+
+        if initial_load and not ingested:
+            # Vectorize the paragraphs in batches, paragraphs already stored are overwritten
+            contents = self.contentDocuments(chunks)
+            batch_size = int(os.getenv("ingest_embedding_batch_size", 64))
+            self.ingest(contents[start:start + batch_size] for start in range(0, len(contents), batch_size))
+            lap("vectorize")
+
+        if bundle is not None:
+            generation = self.buildSparseGeneration(chunks, vectorizer=vectorizer, content_index=content_index)
+        else:
+            generation = self.buildSparseGeneration(chunks)
+        lap("sparse")
+        if bundle is None and bundle_directory:
+            write_bundle(bundle_directory, document_chunks_pickle, generation)
+            lap("write_bundle")
+
+        # Set up the reranker once, every index generation uses the same model
+        self.compressor = None
+        if os.getenv("rerank") == "True":
+            self.compressor = self.buildCompressor()
+        lap("reranker")
+
+        # Cache retrieval results of identical queries, shared by all requests of this worker
+        self.retrieval_cache = None
+        if os.getenv("use_retrieval_cache") == "True":
+            self.retrieval_cache = RetrievalCache(
+                max_bytes=int(os.getenv("retrieval_cache_max_bytes", 64 * 1024 * 1024)),
+                ttl=int(os.getenv("retrieval_cache_ttl", 600)),
+            )
 
-            # Store the chunks
-            with open(document_chunks_pickle, 'wb') as f:
-                pickle.dump(self.chunked_documents, f)
+        # Writers build the next generation under this lock, readers never take it
+        self.generation_lock = threading.Lock()
+        self.generation = self.completeGeneration(generation, refresh=initial_load)
+        lap("dense")
+        phases = ", ".join(f"{phase} {seconds:.2f} s" for phase, seconds in self.startup_timings.items())
+        logger.info(f"Index of {len(chunks)} chunks ready in {sum(self.startup_timings.values()):.1f} s "
+                    f"({'from the bundle, ' if bundle is not None else ''}{phases})")
 
+    def openVectorStore(self):
         if os.getenv("vector_store") == "chroma":
-            if os.getenv("vector_store_initial_load") == "True":
-                self.db = Chroma(
-                    embedding_function=self.embeddings,
-                    persist_directory=persist_directory,
-                    collection_name=os.getenv("vector_store_collection"),
-                )
-
-                # Add the documents 1 by 1 so we can track progress
-                with tqdm(total=len(self.chunked_documents), desc="Vectorizing documents") as pbar:
-                    for d in self.chunked_documents:
-                        self.db.add_documents([d])
-                        pbar.update(1)
-            else:
-                # Load chunked documents into the Milvus index
-                self.db = Chroma(
-                    embedding_function=self.embeddings,
-                    persist_directory=persist_directory,
-                    collection_name=os.getenv("vector_store_collection"),
-                )
-
-            # When we use Chroma, we have an in-memory BM25 retriever
-            self.sparse_retriever = BM25Retriever.from_texts(
-                [x.page_content for x in self.chunked_documents],
-                metadatas=[x.metadata for x in self.chunked_documents]
+            from langchain_community.vectorstores import Chroma
+            self.db = Chroma(
+                embedding_function=self.embeddings,
+                persist_directory=os.getenv('persist_directory'),
+                collection_name=os.getenv("vector_store_collection"),
+                collection_metadata=chromaMetadata(),
             )
+        elif os.getenv("vector_store") == "local_ivf":
+            # A single memory-mapped index file that all workers share
+            self.db = None
         else:
             raise Exception(
-                "Only chroma are supported as vector stores! Please set vector_store in your .env.en.postgres file.")
-
-        # Set up the vector retriever
-        retriever = self.db.as_retriever(
-            search_type="mmr", search_kwargs={'k': int(os.getenv("vector_store_k"))}
-        )
+                "Only chroma and local_ivf are supported as vector stores! Please set vector_store in your .env file.")
 
-        # Now combine them to do hybrid retrieval
-        self.ensemble_retriever = EnsembleRetriever(
-            retrievers=[self.sparse_retriever, retriever], weights=[0.5, 0.5]
-        )
-        # Set up the reranker
-        self.rerank_retriever = None
-        if os.getenv("rerank") == "True":
-            if os.getenv("rerank_model") == "flashrank":
-                model_name = os.getenv("flashrank_model", None)
-                self.compressor = FlashrankRerank(top_n=int(os.getenv("rerank_k")), model=model_name)
+    def buildSplitter(self):
+        if os.getenv('splitter') == 'RecursiveCharacterTextSplitter':
+            if os.getenv("use_blank_line_as_separator") == "True":
+                return RecursiveCharacterTextSplitter(
+                    chunk_size=int(os.getenv('chunk_size')),
+                    chunk_overlap=int(os.getenv('chunk_overlap')),
+                    length_function=len,
+                    keep_separator=True,
+                    separators=[
+                        r'\n\s*\n',
+                        r"\n \n",
+                        r"\n\n",
+                        r"\n",
+                        r" ",
+                    ],
+                    is_separator_regex=True
+                )
             else:
-                self.compressor = ScoredCrossEncoderReranker(
-                    model=HuggingFaceCrossEncoder(model_name=os.getenv("rerank_model")),
-                    top_n=int(os.getenv("rerank_k"))
+                return RecursiveCharacterTextSplitter(
+                    chunk_size=int(os.getenv('chunk_size')),
+                    chunk_overlap=int(os.getenv('chunk_overlap')),
+                    length_function=len,
+                    keep_separator=True,
+                    separators=[
+                        "\n \n",
+                        "\n\n",
+                        "\n",
+                        ".",
+                        "!",
+                        "?",
+                        " ",
+                        ",",
+                        "\u200b",  # Zero-width space
+                        "\uff0c",  # Fullwidth comma
+                        "\u3001",  # Ideographic comma
+                        "\uff0e",  # Fullwidth full stop
+                        "\u3002",  # Ideographic full stop
+                        "",
+                    ],
                 )
-
-            self.rerank_retriever = ContextualCompressionRetriever(
-                base_compressor=self.compressor, base_retriever=self.ensemble_retriever
-            )
-
-    # no use
-    def addDocument(self, filename):
-        if filename.lower().endswith('pdf'):
-            docs = PyPDFLoader(filename).load()
-        if filename.lower().endswith('json'):
-            docs = JSONLoader(
-                file_path=filename,
-                jq_schema=os.getenv("json_schema"),
-                text_content=os.getenv("json_text_content") == "True",
-            ).load()
-        if filename.lower().endswith('txt'):
-            docs = TextLoader(filename).load()
-        if filename.lower().endswith('csv'):
-            docs = CSVLoader(filename).load()
-        if filename.lower().endswith('docx'):
-            docs = Docx2txtLoader(filename).load()
-        if filename.lower().endswith('xlsx'):
-            docs = UnstructuredExcelLoader(filename).load()
-        if filename.lower().endswith('pptx'):
-            docs = UnstructuredPowerPointLoader(filename).load()
-
-        # Skills and personality are global and don't work on chunks, so do them first
-        new_docs = []
-
-        for doc in docs:
-            # Get the skills by using the LLM and attach to the doc
-            skills = self.parseCV(doc)
-            doc.metadata['skills'] = skills
-            # Also get the personality
-            doc.metadata['personality'] = self.personality_predictor.predict(doc)
-            new_docs.append(doc)
-
-        if os.getenv('splitter') == 'RecursiveCharacterTextSplitter':
-            self.text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=int(os.getenv('chunk_size')),
-                chunk_overlap=int(os.getenv('chunk_overlap')),
-                length_function=len,
-                keep_separator=True,
-                separators=[
-                    "\n \n",
-                    "\n\n",
-                    "\n",
-                    ".",
-                    "!",
-                    "?",
-                    " ",
-                    ",",
-                    "\u200b",  # Zero-width space
-                    "\uff0c",  # Fullwidth comma
-                    "\u3001",  # Ideographic comma
-                    "\uff0e",  # Fullwidth full stop
-                    "\u3002",  # Ideographic full stop
-                    "",
-                ],
-            )
         elif os.getenv('splitter') == 'SemanticChunker':
+            from langchain_experimental.text_splitter import SemanticChunker
             breakpoint_threshold_amount = None
             number_of_chunks = None
             if os.getenv('breakpoint_threshold_amount') != 'None':
                 breakpoint_threshold_amount = float(os.getenv('breakpoint_threshold_amount'))
             if os.getenv('number_of_chunks') != 'None':
                 number_of_chunks = int(os.getenv('number_of_chunks'))
-            self.text_splitter = SemanticChunker(
+            return SemanticChunker(
                 self.embeddings,
                 breakpoint_threshold_type=os.getenv('breakpoint_threshold_type'),
                 breakpoint_threshold_amount=breakpoint_threshold_amount,
                 number_of_chunks=number_of_chunks
             )
 
-        new_chunks = self.text_splitter.split_documents(new_docs)
-
-        self.chunked_documents = self.chunked_documents + new_chunks
-        # Store these too, for our sparse DB
-        with open(f"{os.getenv('vector_store_uri')}_sparse.pickle", 'wb') as f:
-            pickle.dump(self.chunked_documents, f)
-
-        # Add to vector DB
-        self.db.add_documents(new_chunks)
-
-        # For postgres, add to sparse db too
-        if os.getenv("vector_store") == "postgres":
-            self.sparse_retriever.add_documents(new_chunks)
+    def ingest(self, source, chunks_file=None, vectorize=True, processes=0, resume=False):
+        """
+        Run the ingestion pipeline. With chunks_file, source yields file paths that are loaded, split and given
+        IDs, and their chunks are written to chunks_file one file at a time; otherwise source yields batches of
+        paragraphs (see contentDocuments). With vectorize, new paragraphs are embedded and stored in the vector
+        store. Every stage runs on its own threads with bounded queues in between, so only a few files are in
+        memory at any time. Logs the throughput and peak memory use at the end.
+
+        With processes, files are loaded and split in that many worker processes. Finished files are recorded
+        in a journal next to chunks_file; with resume, an interrupted run continues after the last of them.
+        """
+        pipeline = Pipeline(queue_size=int(os.getenv("ingest_queue_size", 8)))
+        ids, vectors = [], []
+        pbar = tqdm(desc="Vectorizing documents")
+
+        def embed(item):
+            path, frame, contents = item
+            batch_size = int(os.getenv("ingest_embedding_batch_size", 64))
+            embedded = []
+            for start in range(0, len(contents), batch_size):
+                embedded.extend(self.embeddings.embed_documents(
+                    [doc.page_content for doc in contents[start:start + batch_size]]))
+            return [(path, frame, contents, embedded)]
+
+        def store(item):
+            path, frame, contents, embedded = item
+            if os.getenv("vector_store") == "local_ivf":
+                # The whole index is clustered at once at the end
+                ids.extend(doc.metadata['id'] for doc in contents)
+                vectors.extend(embedded)
+            else:
+                self.addToVectorStore(contents, embedded)
+            pbar.update(len(contents))
+            if path is not None:
+                settle(doc.metadata['id'] for doc in contents)
+
+        pool = None
+        if chunks_file is not None:
+            licenses, seen, restored = {}, set(), []
+            done = self.restoreChunks(chunks_file, licenses, seen, restored) if resume else {}
+            source = (path for path in source if path not in done)
+            f = open(chunks_file + ".tmp", 'ab' if resume else 'wb')
+            journal = open(chunks_file + ".journal", 'a' if resume else 'w')
+            frames = [len(done)]
+            lock = threading.Lock()
+            # A file is done once its chunks and every paragraph it refers to are stored, also the paragraphs it
+            # shares with an earlier file that may still be on their way to the vector store. Otherwise a resumed
+            # run would count them as seen without them ever being stored
+            stored, waiting = set(seen), []
+
+            def finish(path, frame):
+                journal.write(f"{frame}\t{path}\n")
+                journal.flush()
+
+            def settle(content_ids):
+                with lock:
+                    stored.update(content_ids)
+                    for entry in list(waiting):
+                        if entry[2] <= stored:
+                            waiting.remove(entry)
+                            finish(entry[0], entry[1])
+
+            def write(item):
+                path, chunks = item
+                pickle.dump(chunks, f)
+                f.flush()
+                frame = frames[0]
+                frames[0] += 1
+                contents = self.contentDocuments(chunks)
+                new = [doc for doc in contents if doc.metadata['id'] not in seen]
+                seen.update(doc.metadata['id'] for doc in new)
+                if not vectorize:
+                    with lock:
+                        finish(path, frame)
+                    return []
+                with lock:
+                    waiting.append((path, frame, {doc.metadata['id'] for doc in contents}))
+                if len(new) > 0:
+                    return [(path, frame, new)]
+                settle(())
+                return []
+
+            if processes > 0:
+                # Loading and splitting are CPU-bound, the worker processes send back (text, metadata) pairs
+                pool = ProcessPoolExecutor(processes, initializer=init_worker)
+                pipeline.add("load", lambda path: [(path, pool.submit(load_and_split, path).result())],
+                             workers=processes)
+                pipeline.add("split", lambda item: [(item[0], identify_chunks(
+                    [Document(page_content=text, metadata=metadata) for text, metadata in item[1]], licenses))])
+            else:
+                pipeline.add("load", lambda path: [(path, load_file(path))],
+                             workers=int(os.getenv("ingest_load_workers", 2)))
+                pipeline.add("split", lambda item: [(item[0], identify_chunks(
+                    self.text_splitter.split_documents(item[1]), licenses))])
+            pipeline.add("write", write)
+
+            # The local index is rebuilt from all vectors, also those of files done before the interruption
+            if vectorize and os.getenv("vector_store") == "local_ivf":
+                for contents in restored:
+                    store(embed((None, None, contents))[0])
         else:
-            # Recreate the in-memory store
-            self.sparse_retriever = BM25Retriever.from_texts(
-                [x.page_content for x in self.chunked_documents],
-                metadatas=[x.metadata for x in self.chunked_documents]
+            source = ((None, None, contents) for contents in source)
+
+        if vectorize:
+            pipeline.add("embed", embed, workers=int(os.getenv("ingest_embed_workers", 2)))
+            pipeline.add("store", store)
+
+        try:
+            stats = pipeline.run(source)
+        finally:
+            pbar.close()
+            if pool is not None:
+                pool.shutdown()
+            if chunks_file is not None:
+                f.close()
+                journal.close()
+        if chunks_file is not None:
+            os.replace(chunks_file + ".tmp", chunks_file)
+            os.remove(chunks_file + ".journal")
+        if vectorize and os.getenv("vector_store") == "local_ivf":
+            IVFIndex.build(ids, vectors, self.localIndexFile())
+
+        stages = ", ".join(f"{name} {stage['items']} items {stage['busy']:.1f} s busy on {stage['workers']} threads"
+                           for name, stage in stats["stages"].items())
+        logger.info(f"Ingestion took {stats['seconds']:.1f} s ({stages}), {pbar.n / stats['seconds']:.1f} "
+                    f"paragraphs/s vectorized, peak RSS {stats['peak_rss_mib'] or 0:.0f} MiB")
+        return stats
+
+    # Keep the chunks of the files an interrupted ingestion finished, and return those files with their frames
+    def restoreChunks(self, chunks_file, licenses, seen, restored):
+        if not os.path.exists(chunks_file + ".tmp") or not os.path.exists(chunks_file + ".journal"):
+            open(chunks_file + ".tmp", 'wb').close()
+            return {}
+        journaled = {}
+        with open(chunks_file + ".journal") as journal:
+            for line in journal:
+                if line.endswith("\n"):
+                    frame, path = line.rstrip("\n").split("\t", 1)
+                    journaled[int(frame)] = path
+
+        done = {}
+        with open(chunks_file + ".tmp", 'rb') as old, open(chunks_file + ".tmp.resume", 'wb') as new, \
+                open(chunks_file + ".journal.resume", 'w') as journal:
+            frame = 0
+            while True:
+                try:
+                    chunks = pickle.load(old)
+                except Exception:
+                    # The end, or a frame that was cut off when ingestion stopped
+                    break
+                if frame in journaled:
+                    pickle.dump(chunks, new)
+                    journal.write(f"{len(done)}\t{journaled[frame]}\n")
+                    done[journaled[frame]] = len(done)
+                    for doc in chunks:
+                        licenses.setdefault(license_number(doc.metadata['source']), doc.metadata['source'])
+                    contents = [doc for doc in self.contentDocuments(chunks) if doc.metadata['id'] not in seen]
+                    seen.update(doc.metadata['id'] for doc in contents)
+                    restored.append(contents)
+                frame += 1
+        os.replace(chunks_file + ".tmp.resume", chunks_file + ".tmp")
+        os.replace(chunks_file + ".journal.resume", chunks_file + ".journal")
+        logger.info(f"Resuming ingestion after {len(done)} finished files")
+        return done
+
+    # The dense half of the hybrid search: Chroma's own MMR search, or a compressed in-process index over the
+    # vectors exported from Chroma whose best candidates are re-scored at full precision. The vector stores
+    # hold one entry per paragraph, a hit is expanded by lookup to the label chunks that contain it.
+    def buildDenseRetriever(self, lookup, refresh=False):
+        k = int(os.getenv("vector_store_k"))
+        # A paragraph shared by several labels comes back as a chunk of each, the dense results stay at k chunks
+        def chunks(ids):
+            return lookup(ids)[:k]
+
+        if os.getenv("vector_store") == "local_ivf":
+            index = IVFIndex(self.localIndexFile(), nprobe=int(os.getenv("local_index_nprobe", 16)))
+            return VectorIndexRetriever(
+                index=index,
+                ids=index.ids,
+                embeddings=self.embeddings,
+                lookup=chunks,
+                k=k,
+                fetch_k=int(os.getenv("vector_store_fetch_k") or 4 * k),
             )
 
-            # Update full retriever too
-            retriever = self.db.as_retriever(search_type="mmr", search_kwargs={'k': int(os.getenv('vector_store_k'))})
-            self.ensemble_retriever = EnsembleRetriever(
-                retrievers=[self.sparse_retriever, retriever], weights=[0.5, 0.5]
+        quantization = os.getenv("vector_quantization", "none")
+        dims = int(os.getenv("vector_truncate_dims") or 0) or None
+        if quantization == "none" and dims is None:
+            return self.db.as_retriever(search_type="mmr", search_kwargs={'k': k}) | RunnableLambda(
+                lambda docs: chunks([doc.metadata['id'] for doc in docs]))
+
+        vector_directory = os.getenv("vector_index_directory") or os.path.join(os.getenv('persist_directory'), "vectors")
+        if refresh or not os.path.exists(os.path.join(vector_directory, "vectors.npy")):
+            export_vectors(self.db, vector_directory)
+        ids, vectors = load_vectors(vector_directory)
+        return VectorIndexRetriever(
+            index=CompressedVectorIndex(vectors, dims=dims, quantization=quantization),
+            ids=ids,
+            embeddings=self.embeddings,
+            lookup=chunks,
+            k=k,
+            fetch_k=int(os.getenv("vector_store_fetch_k") or 4 * k),
+        )
+
+    def localIndexFile(self):
+        return os.getenv("local_index_file") or os.path.join(os.getenv('persist_directory'), "index.ivf")
+
+    # Embed (unless their vectors are given) and store new paragraphs (see contentDocuments) in the configured
+    # vector store
+    def addToVectorStore(self, chunks, vectors=None):
+        if vectors is None:
+            vectors = self.embeddings.embed_documents([d.page_content for d in chunks])
+        if os.getenv("vector_store") == "local_ivf":
+            # The new vectors join the lists of their nearest clusters in a new file that is swapped in, readers
+            # keep the old mapping until then
+            IVFIndex.add([d.metadata['id'] for d in chunks], vectors, self.localIndexFile(),
+                         growth=float(os.getenv("local_index_recluster_growth", 0.5)),
+                         drift=float(os.getenv("local_index_recluster_drift", 0.05)))
+        else:
+            # The content ID is the Chroma ID, so storing a paragraph again replaces it instead of adding a duplicate
+            unique = {d.metadata['id']: (d, vector) for d, vector in zip(chunks, vectors)}
+            self.db._collection.upsert(
+                ids=list(unique),
+                embeddings=[vector for _, vector in unique.values()],
+                documents=[d.page_content for d, _ in unique.values()],
+                metadatas=[d.metadata for d, _ in unique.values()],
             )
 
-        if os.getenv("rerank") == "True":
-            if os.getenv("rerank_model") == "flashrank":
-                self.compressor = FlashrankRerank(top_n=int(os.getenv("rerank_k")))
-            else:
-                self.compressor = ScoredCrossEncoderReranker(
-                    model=HuggingFaceCrossEncoder(model_name=os.getenv("rerank_model")),
-                    top_n=int(os.getenv("rerank_k"))
+    # Create the reranker, a cross-encoder model is loaded once and reused if the reranker is created again.
+    # Only the configured reranker's libraries are imported
+    def buildCompressor(self):
+        if os.getenv("rerank_model") == "flashrank":
+            from langchain.retrievers.document_compressors import FlashrankRerank
+            model_name = os.getenv("flashrank_model", None)
+            return FlashrankRerank(top_n=int(os.getenv("rerank_k")), model=model_name)
+
+        if getattr(self, "cross_encoder", None) is None:
+            from langchain_community.cross_encoders import HuggingFaceCrossEncoder
+            self.cross_encoder = HuggingFaceCrossEncoder(model_name=os.getenv("rerank_model"))
+            # Score the pairs of concurrent requests together on one shared worker
+            if os.getenv("rerank_batching") == "True":
+                self.cross_encoder = BatchedCrossEncoder(
+                    self.cross_encoder,
+                    batch_size=int(os.getenv("rerank_batch_size", 32)),
+                    max_wait=float(os.getenv("rerank_batch_max_wait_ms", 5)) / 1000,
                 )
+        return ScoredCrossEncoderReranker(model=self.cross_encoder, top_n=int(os.getenv("rerank_k")))
+
+    # In a worker forked from the process that loaded the index: the chunks, BM25 and memory-mapped vectors
+    # stay shared copy-on-write, but connections, threads and ONNX Runtime sessions do not survive a fork
+    def afterFork(self):
+        if os.getenv("vector_store") == "chroma":
+            # Chroma keeps one client per path, with the parent's SQLite connections and HNSW index
+            from chromadb.api.client import SharedSystemClient
+            SharedSystemClient.clear_system_cache()
+        self.openVectorStore()
+
+        embeddings = self.embeddings
+        while hasattr(embeddings, "embeddings"):
+            embeddings = embeddings.embeddings
+        if hasattr(embeddings, "after_fork"):
+            embeddings.after_fork()
+        if hasattr(self.embeddings, "batcher"):
+            self.embeddings.batcher.after_fork()
+        if os.getenv("rerank") == "True" and os.getenv("rerank_model") == "flashrank":
+            self.compressor = self.buildCompressor()
+        if hasattr(getattr(self, "cross_encoder", None), "batcher"):
+            self.cross_encoder.batcher.after_fork()
+        self.generation_lock = threading.Lock()
+
+        # The same generation with this process's reranker. An in-process dense index only reads shared
+        # memory and is kept, Chroma's own search is rebuilt over this process's client
+        dense = self.generation.ensemble_retriever.retrievers[1]
+        self.generation = self.completeGeneration(copy.copy(self.generation),
+                                                  dense=dense if isinstance(dense, VectorIndexRetriever) else None)
+
+    # An index generation over chunks with its BM25 retriever, from the postings of an index bundle if given
+    def buildSparseGeneration(self, chunks, number=0, vectorizer=None, content_index=None):
+        generation = IndexGeneration(number, chunks, content_index)
+        if vectorizer is None:
+            # We have an in-memory BM25 index next to the vector store, scored like BM25Retriever.from_texts
+            vectorizer = BM25Index.from_corpus([x.page_content.split() for x in chunks])
+        # The chunks are the documents BM25Retriever.from_texts would create, and valid already
+        generation.sparse_retriever = BM25Retriever.construct(vectorizer=vectorizer, docs=chunks)
+        return generation
+
+    # Add the retrievers on top of BM25: the dense retriever for hybrid retrieval, then the shared reranker if
+    # enabled and the retrieval cache if enabled, which give the retriever supplying the LLM context. With
+    # refresh, the dense retriever reads the vector store again; with dense, that dense retriever is used.
+    def completeGeneration(self, generation, refresh=False, dense=None):
+        retriever = dense or self.buildDenseRetriever(generation.get_content_chunks, refresh=refresh)
+        generation.ensemble_retriever = EnsembleRetriever(
+            retrievers=[generation.sparse_retriever, retriever], weights=[0.5, 0.5]
+        )
 
-            self.rerank_retriever = ContextualCompressionRetriever(
-                base_compressor=self.compressor, base_retriever=self.ensemble_retriever
+        generation.context_retriever = generation.ensemble_retriever
+        generation.compressor = self.compressor
+        if self.compressor is not None:
+            generation.rerank_retriever = ContextualCompressionRetriever(
+                base_compressor=DeadlineCompressor(compressor=self.compressor),
+                base_retriever=generation.ensemble_retriever
+            )
+            generation.context_retriever = generation.rerank_retriever
+        if self.retrieval_cache is not None:
+            generation.context_retriever = CachedRetriever(
+                retriever=generation.context_retriever, cache=self.retrieval_cache, generation=generation.number
             )
+        return generation
+
+    def buildGeneration(self, number, chunks, refresh=False):
+        return self.completeGeneration(self.buildSparseGeneration(chunks, number), refresh=refresh)
+
+    # Replace the chunk pickle with the chunks of a generation, and the index bundle with its index, which is what
+    # the next start loads
+    def saveGeneration(self, generation):
+        chunks_file = os.getenv('document_chunks_pickle')
+        with open(f"{chunks_file}.{os.getpid()}.tmp", 'wb') as f:
+            pickle.dump(generation.chunked_documents, f)
+        os.replace(f"{chunks_file}.{os.getpid()}.tmp", chunks_file)
+        if os.getenv("index_bundle_directory"):
+            write_bundle(os.getenv("index_bundle_directory"), chunks_file, generation)
+
+    # Make a generation the one new requests search; requests that already took the previous one finish on it
+    def publishGeneration(self, generation):
+        self.generation = generation
+        if self.retrieval_cache is not None:
+            # Entries of older generations can no longer be hit
+            self.retrieval_cache.clear()
+
+    # The current generation's index, for code that does not need one consistent generation across calls
+    @property
+    def chunked_documents(self):
+        return self.generation.chunked_documents
+
+    @property
+    def index_generation(self):
+        return self.generation.number
+
+    @property
+    def context_retriever(self):
+        return self.generation.context_retriever
+
+    # The unique paragraphs of the given chunks, the unit that is embedded and stored in the vector store
+    def contentDocuments(self, chunks):
+        contents = {}
+        for doc in chunks:
+            if doc.metadata['content_id'] not in contents:
+                contents[doc.metadata['content_id']] = Document(page_content=chunk_text(doc),
+                                                                metadata={'id': doc.metadata['content_id']})
+        return list(contents.values())
+
+    def getChunks(self, chunk_ids):
+        return self.generation.get_chunks(chunk_ids)
@@ -2,37 +2,29 @@ import os
 
 from .provenance import compute_rerank_provenance
 # from .provenance import (compute_llm_provenance_cloud, compute_rerank_provenance, DocumentSimilarityAttribution)
-from .ScoredCrossEncoderReranker import ScoredCrossEncoderReranker
 from .RAGHelper import RAGHelper
 from .RAGHelper import formatDocuments
+from .RAGHelper import identify_chunks
+from .RAGHelper import license_number
+from .ingest import load_file
 
-from langchain.retrievers import EnsembleRetriever
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_experimental.text_splitter import SemanticChunker
 from .get_embeddings import get_embedding_function
+from .answer_cache import SemanticAnswerCache
+from .deadline import check_deadline, remaining
+from .extractive import extractive_answer
+from .query_vectors import remember_query_vectors
+from .llm_router import PROVIDERS, LLMRouter, LLMUnavailable, build_llm, router_from_env
 from langchain.prompts import ChatPromptTemplate
-from langchain.schema.runnable import RunnablePassthrough
-from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers import ContextualCompressionRetriever
-from langchain.retrievers.document_compressors import FlashrankRerank
+from langchain.schema.runnable import RunnableLambda, RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
-from langchain_community.cross_encoders import HuggingFaceCrossEncoder
-
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.document_loaders import JSONLoader
-from langchain_community.document_loaders import Docx2txtLoader
-from langchain_community.document_loaders import UnstructuredExcelLoader
-from langchain_community.document_loaders import UnstructuredPowerPointLoader
-from langchain_community.document_loaders import UnstructuredMarkdownLoader
-from langchain_community.document_loaders.csv_loader import CSVLoader
-
-from langchain_openai import ChatOpenAI
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_openai import AzureChatOpenAI
-from langchain_ollama.llms import OllamaLLM
 
+import contextvars
 import re
-import pickle
+from operator import itemgetter
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 
 
 def combine_results(inputs):
@@ -52,30 +44,34 @@ def combine_results(inputs):
 
 class RAGHelperCloud(RAGHelper):
     def __init__(self, logger):
-        if os.getenv("use_openai") == "True":
-            self.llm = ChatOpenAI(
-                model=os.getenv("openai_model_name"),
-                temperature=0,
-                max_tokens=None,
-                timeout=None,
-                max_retries=2,
-            )
-        elif os.getenv("use_gemini") == "True":
-            self.llm = ChatGoogleGenerativeAI(model=os.getenv("gemini_model_name"),
-                                              convert_system_message_to_human=True)
-        elif os.getenv("use_azure") == "True":
-            self.llm = AzureChatOpenAI(
-                openai_api_version=os.environ["AZURE_OPENAI_API_VERSION"],
-                azure_deployment=os.environ["AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"],
-            )
-        elif os.getenv("use_ollama") == "True":
-            self.llm = OllamaLLM(model=os.getenv("ollama_model"))
+        self.logger = logger
+        # Several providers (llm_providers) are raced by a router, else the one of the use_* settings is used
+        if os.getenv("llm_providers", "").strip():
+            self.llm = router_from_env()
+        else:
+            kind = next((kind for kind in PROVIDERS if os.getenv(f"use_{kind}") == "True"), None)
+            self.llm = build_llm(kind) if kind else None
 
         self.embeddings = get_embedding_function()
 
         # Load the data
         self.loadData()
 
+        # Latency budget of an answer in seconds (0 for none), LLM calls run on their own threads to be bounded by it
+        self.latency_budget = float(os.getenv("chat_latency_budget", 0))
+        self.llm_executor = ThreadPoolExecutor(max_workers=int(os.getenv("llm_threads", 16)), thread_name_prefix="llm")
+        self.modes = Counter()
+        self.skipped_stages = Counter()
+        self.modes_lock = threading.Lock()
+
+        # Reuse answers to first questions that are nearly the same as earlier ones
+        self.answer_cache = None
+        if os.getenv("use_answer_cache") == "True":
+            self.answer_cache = SemanticAnswerCache(
+                threshold=float(os.getenv("answer_cache_threshold", 0.95)),
+                capacity=int(os.getenv("answer_cache_size", 1024)),
+            )
+
         # Create the RAG chain for determining if we need to fetch new documents
         rag_thread = [
             ('system', os.getenv('rag_fetch_new_instruction')),
@@ -104,11 +100,12 @@ class RAGHelperCloud(RAGHelper):
             ]
             rewrite_ask_prompt = ChatPromptTemplate.from_messages(rewrite_ask_thread)
             rewrite_ask_llm_chain = rewrite_ask_prompt | self.llm
-            context_retriever = self.ensemble_retriever
-            if os.getenv("rerank") == "True":
-                context_retriever = self.rerank_retriever
+            # Takes the question with the retriever of the index generation the request answers from, addDocuments
+            # may publish a new one meanwhile
             self.rewrite_ask_chain = (
-                    {"context": context_retriever | formatDocuments, "question": RunnablePassthrough()} |
+                    {"context": RunnableLambda(lambda inputs: inputs["retriever"].invoke(inputs["question"])) |
+                                formatDocuments,
+                     "question": itemgetter("question")} |
                     rewrite_ask_llm_chain
             )
 
@@ -123,11 +120,14 @@ class RAGHelperCloud(RAGHelper):
                     rewrite_llm_chain
             )
 
-    def handle_rewrite(self, user_query):
+    def handle_rewrite(self, user_query, start=None, generation=None):
         # Check if we even need to rewrite or not
         if os.getenv("use_rewrite_loop") == "True":
             # Ask the LLM if we need to rewrite
-            response = self.rewrite_ask_chain.invoke(user_query)
+            check_deadline("rewrite")
+            generation = generation or self.generation
+            response = self.invokeLLM(self.rewrite_ask_chain,
+                                      {"question": user_query, "retriever": generation.context_retriever}, start)
             if hasattr(response, 'content'):
                 response = response.content
             elif hasattr(response, 'answer'):
@@ -137,7 +137,8 @@ class RAGHelperCloud(RAGHelper):
             response = re.sub(r'\W+ ', '', response)
             if response.lower().startswith('yes'):
                 # Start the rewriting into different alternatives
-                response = self.rewrite_chain.invoke(user_query)
+                check_deadline("rewrite")
+                response = self.invokeLLM(self.rewrite_chain, user_query, start)
 
                 if hasattr(response, 'content'):
                     response = response.content
@@ -154,13 +155,118 @@ class RAGHelperCloud(RAGHelper):
         else:
             return user_query
 
-    # Main function to handle user interaction
-    def handle_user_interaction(self, user_query, history):
-        if len(history) == 0:
+    # Chunk IDs of the documents the last answer in a compact history was based on
+    def history_chunk_ids(self, history):
+        for message in reversed(history):
+            if message.get("chunk_ids"):
+                return message["chunk_ids"]
+        return []
+
+    # Turn a compact history back into a prompt thread, re-fetching the referenced chunks as context
+    def rehydrate_history(self, history, summary=None):
+        thread = []
+        docs = self.getChunks(self.history_chunk_ids(history))
+        if len(docs) > 0:
+            thread.append(('system', os.getenv('rag_instruction').format_map({"context": formatDocuments(docs)})))
+        if summary:
+            summary_instruction = os.getenv('session_summary_instruction', "Summary of the earlier conversation:\n\n{summary}")
+            thread.append(('system', summary_instruction.format_map({"summary": summary})))
+        for message in history:
+            # Histories from older clients carry the rendered context as a system message
+            if message["role"] == "system" and len(docs) > 0:
+                continue
+            thread.append((message["role"], message["content"]))
+        return [(role, content.replace("{", "(").replace("}", ")")) for role, content in thread]
+
+    # Fold older turns of a conversation into its running summary
+    def summarize_history(self, summary, messages):
+        turns = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        prompt = ChatPromptTemplate.from_messages([
+            ('human', os.getenv('session_summary_prompt',
+                                "Update the summary of a conversation with the new turns below. Keep the drugs, "
+                                "conditions and facts the user asked about and answer with the summary only.\n\n"
+                                "Current summary:\n{summary}\n\nNew turns:\n{turns}"))
+        ])
+        return (prompt | self.llm | StrOutputParser()).invoke({"summary": summary, "turns": turns})
+
+    # Seconds left for the request started at start (time.monotonic()): the smaller of its latency budget and
+    # the request deadline, None without either
+    def timeLeft(self, start):
+        left = [seconds for seconds in [
+            remaining(), self.latency_budget - (time.monotonic() - start) if self.latency_budget and start else None
+        ] if seconds is not None]
+        return min(left) if left else None
+
+    # The optional stages to skip with the time left, in the order they are given up: provenance, then the rewrite
+    # loop and reranking, then the LLM answer. Skipping a stage skips the ones before it too, whatever the settings
+    def degradedStages(self, start):
+        left = self.timeLeft(start)
+        degraded = set()
+        if left is None:
+            return degraded
+        ladder = [(["provenance"], "degrade_provenance_below", 20), (["rewrite", "rerank"], "degrade_rewrite_below", 10),
+                  (["llm"], "degrade_llm_below", 4)]
+        for stages, setting, default in reversed(ladder):
+            if degraded or left < float(os.getenv(setting, default)):
+                degraded.update(stages)
+        return degraded
+
+    # Invoke a chain calling the LLM within the time left, keeping a second for the fallback. Raises the futures'
+    # TimeoutError (not yet the builtin one on Python 3.10) when the LLM is slower; the call itself runs on in the
+    # background until it returns.
+    def invokeLLM(self, chain, value, start):
+        left = self.timeLeft(start)
+        if left is None:
+            return chain.invoke(value)
+        future = self.llm_executor.submit(contextvars.copy_context().run, chain.invoke, value)
+        try:
+            return future.result(timeout=max(0.0, left - 1))
+        except FutureTimeout:
+            future.cancel()
+            raise
+
+    # The question as it is searched for and put to the LLM, with Re2 it is mentioned twice
+    def searchQuery(self, user_query):
+        if os.getenv("use_re2") == "True":
+            return f'{user_query}\n{os.getenv("re2_prompt")}{user_query}'
+        return user_query
+
+    # Retrieval without the reranker, keeping as many documents as it would
+    def unrankedDocuments(self, generation, query):
+        return generation.ensemble_retriever.invoke(query)[:int(os.getenv("rerank_k", 3))]
+
+    # Main function to handle user interaction. Under a latency budget (chat_latency_budget) the optional
+    # stages are given up as it runs low: provenance first, then the rewrite loop and reranking, and last the
+    # LLM answer itself, replaced by highlights of the retrieved documents. reply["mode"] says what answered:
+    # full, degraded (some stages skipped) or extractive. The answer cache lookup and the dense search share
+    # the question's vector.
+    @remember_query_vectors()
+    def handle_user_interaction(self, user_query, history, summary=None):
+        start = time.perf_counter()
+        began = time.monotonic()
+        skipped = []
+        # Answer from one index generation, even if documents are added meanwhile
+        generation = self.generation
+        query_vector = None
+        if len(history) == 0 and not summary:
             fetch_new_documents = True
+            # First questions don't depend on anything but the index, so they can be answered from cache
+            if self.answer_cache is not None:
+                query_vector = self.embeddings.embed_query(self.searchQuery(user_query))
+                cached_reply = self.answer_cache.lookup(query_vector, generation.number)
+                if cached_reply is not None:
+                    # The cached question is the searched one of whoever asked first
+                    cached_reply["question"] = user_query
+                    return ([], cached_reply)
         else:
             # Prompt for LLM
-            response = self.rag_fetch_new_chain.invoke(user_query)
+            check_deadline("llm")
+            try:
+                response = self.invokeLLM(self.rag_fetch_new_chain, user_query, began)
+            except (TimeoutError, FutureTimeout, LLMUnavailable):
+                # Without the LLM's say, fetching documents is the answer that needs no history
+                response = "yes"
+                skipped.append("history")
             if hasattr(response, 'content'):
                 response = response.content
             elif hasattr(response, 'answer'):
@@ -173,10 +279,10 @@ class RAGHelperCloud(RAGHelper):
             else:
                 fetch_new_documents = False
 
-        # Create prompt template based on whether we have history or not
-        thread = [(x["role"], x["content"].replace("{", "(").replace("}", ")")) for x in history]
-        if fetch_new_documents:
-            thread = []
+        # Create prompt template based on whether we have history or not, only follow-ups need the old context
+        thread = []
+        if not fetch_new_documents:
+            thread = self.rehydrate_history(history, summary)
         if len(thread) == 0:
             thread.append(('system', os.getenv('rag_instruction')))
             thread.append(('human', os.getenv('rag_question_initial')))
@@ -185,185 +291,179 @@ class RAGHelperCloud(RAGHelper):
 
         # Create prompt from prompt template
         prompt = ChatPromptTemplate.from_messages(thread)
+        llm_chain = prompt | self.llm | StrOutputParser()
 
-        # Create llm chain
-        llm_chain = prompt | self.llm
+        # One estimate of the time left decides the whole ladder
+        degraded = self.degradedStages(began)
+        rerank = generation.rerank_retriever is not None
         if fetch_new_documents:
-            # Rewrite the question if needed
-            user_query = self.handle_rewrite(user_query)
-            context_retriever = self.ensemble_retriever
-            if os.getenv("rerank") == "True":
-                context_retriever = self.rerank_retriever
-
-            retriever_chain = {
-                "docs": context_retriever,
-                "context": context_retriever | formatDocuments,
-                "question": RunnablePassthrough()
-            }
-            llm_chain = prompt | self.llm | StrOutputParser()
-            rag_chain = (
-                    retriever_chain
-                    | RunnablePassthrough.assign(
-                answer=lambda x: llm_chain.invoke(
-                    {"docs": x["docs"], "context": x["context"], "question": x["question"]}
-                ))
-                    | combine_results
-            )
-        else:
-            retriever_chain = {
-                "question": RunnablePassthrough()
-            }
-            llm_chain = prompt | self.llm | StrOutputParser()
-            rag_chain = (
-                    retriever_chain
-                    | RunnablePassthrough.assign(
-                answer=lambda x: llm_chain.invoke(
-                    {"question": x["question"]}
-                ))
-                    | combine_results
-            )
+            if "rewrite" in degraded:
+                skipped += ["rewrite", "rerank"] if rerank else ["rewrite"]
+            else:
+                # Rewrite the question if needed
+                try:
+                    user_query = self.handle_rewrite(user_query, began, generation)
+                except (TimeoutError, FutureTimeout, LLMUnavailable):
+                    skipped.append("rewrite")
 
         # Check if we need to apply Re2 to mention the question twice
-        if os.getenv("use_re2") == "True":
-            user_query = f'{user_query}\n{os.getenv("re2_prompt")}{user_query}'
+        user_query = self.searchQuery(user_query)
 
-        # Invoke RAG pipeline
-        reply = rag_chain.invoke(user_query)
+        # Retrieve once and use the same documents as context, every stage gives up once the request has timed out
+        docs = None
+        if fetch_new_documents:
+            check_deadline("retrieval")
+            if "rerank" in skipped:
+                docs = self.unrankedDocuments(generation, user_query)
+            else:
+                docs = generation.context_retriever.invoke(user_query)
+
+        reply = None
+        if "llm" in degraded:
+            skipped.append("llm")
+        else:
+            check_deadline("llm")
+            inputs = {"question": user_query}
+            if fetch_new_documents:
+                inputs = {"docs": docs, "context": formatDocuments(docs), "question": user_query}
+            try:
+                reply = combine_results({**inputs, "answer": self.invokeLLM(llm_chain, inputs, began)})
+            except (TimeoutError, FutureTimeout, LLMUnavailable):
+                skipped.append("llm")
+
+        if reply is None:
+            # Last resort: the best label sections for the question, without an answer
+            if docs is None:
+                docs = self.unrankedDocuments(generation, user_query)
+            intro = os.getenv("extractive_answer_intro", "目前無法及時產生回答，以下是與您的問題最相關的仿單段落：")
+            answer, docs = extractive_answer(user_query, docs, intro)
+            reply = {"answer": answer, "docs": docs, "question": user_query}
 
         # See if we need to track provenance
         if fetch_new_documents and os.getenv("provenance_method") in ['rerank', 'attention', 'similarity', 'llm']:
-            # Add the user question and the answer to our thread for provenance computation
-            answer = reply['answer']
-            context = reply['docs']
-
-            # Use the reranker but now on the answer (and potentially query too)
-            if os.getenv("provenance_method") == "rerank":
-                if not (os.getenv("rerank") == "True"):
-                    raise ValueError(
-                        "Provenance attribution is set to rerank but reranking is not enabled. Please choose another provenance method or turn on reranking.")
-                reranked_docs = compute_rerank_provenance(self.compressor, user_query, reply['docs'], answer)
-
-                # This is a bit of a hassle because reranked_docs is now reordered and we have no definitive key to use because of hybrid search.
-                # Note that we can't just return reranked_docs because the LLM may refer to "doc #1" in the order of the original scoring.
-                provenance_scores = []
-                for doc in context:
-                    # Find the document in reranked_docs
-                    reranked_score = \
-                        [d.metadata['relevance_score'] for d in reranked_docs if d.page_content == doc.page_content][0]
-                    provenance_scores.append(reranked_score)
-            # See if we need to do similarity-base provenance
-            elif os.getenv("provenance_method") == "similarity":
-                pass
-                # provenance_scores = self.attributor.compute_similarity(user_query, context, answer)
-            # See if we need to use LLM-based provenance
-            elif os.getenv("provenance_method") == "llm":
-                pass
-                # provenance_scores = compute_llm_provenance_cloud(self.llm, user_query, context, answer)
-
-            # Add the provenance scores
-            for i, score in enumerate(provenance_scores):
-                reply['docs'][i].metadata['provenance'] = score
-
-        return (thread, reply)
-
-    def addDocument(self, filename):
-        filename = os.path.join(os.getenv("data_directory"), filename)
-        if filename.lower().endswith('pdf'):
-            docs = PyPDFLoader(filename).load()
-        if filename.lower().endswith('json'):
-            docs = JSONLoader(
-                file_path=filename,
-                jq_schema=os.getenv("json_schema"),
-                text_content=os.getenv("json_text_content") == "True",
-            ).load()
-        if filename.lower().endswith('csv'):
-            docs = CSVLoader(filename).load()
-        if filename.lower().endswith('docx'):
-            docs = Docx2txtLoader(filename).load()
-        if filename.lower().endswith('xlsx'):
-            docs = UnstructuredExcelLoader(filename).load()
-        if filename.lower().endswith('pptx'):
-            docs = UnstructuredPowerPointLoader(filename).load()
-        if filename.lower().endswith('md'):
-            docs = UnstructuredMarkdownLoader(filename).load()
-
-        new_docs = docs
-
-        if os.getenv('splitter') == 'RecursiveCharacterTextSplitter':
-            self.text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=int(os.getenv('chunk_size')),
-                chunk_overlap=int(os.getenv('chunk_overlap')),
-                length_function=len,
-                keep_separator=True,
-                is_separator_regex=True,
-                separators=[
-                    r'\n\s*\n',
-                    "\n \n",
-                    "\n\n",
-                    "\n",
-                    ".",
-                    "!",
-                    "?",
-                    " ",
-                    ",",
-                    "\u200b",  # Zero-width space
-                    "\uff0c",  # Fullwidth comma
-                    "\u3001",  # Ideographic comma
-                    "\uff0e",  # Fullwidth full stop
-                    "\u3002",  # Ideographic full stop
-                    "",
-                ],
-            )
-        elif os.getenv('splitter') == 'SemanticChunker':
-            breakpoint_threshold_amount = None
-            number_of_chunks = None
-            if os.getenv('breakpoint_threshold_amount') != 'None':
-                breakpoint_threshold_amount = float(os.getenv('breakpoint_threshold_amount'))
-            if os.getenv('number_of_chunks') != 'None':
-                number_of_chunks = int(os.getenv('number_of_chunks'))
-            self.text_splitter = SemanticChunker(
-                self.embeddings,
-                breakpoint_threshold_type=os.getenv('breakpoint_threshold_type'),
-                breakpoint_threshold_amount=breakpoint_threshold_amount,
-                number_of_chunks=number_of_chunks
-            )
-
-        new_chunks = self.text_splitter.split_documents(new_docs)
-
-        self.chunked_documents = self.chunked_documents + new_chunks
-
-        invalid_chars = r'<>:"/\|?*'
-        valid_filename = re.sub(f"[{re.escape(invalid_chars)}]", "_",
-                                os.getenv('vector_store'))
-        # Store these too, for our sparse DB
-        with open(f"{valid_filename}_sparse.pickle", 'wb') as f:
-            pickle.dump(self.chunked_documents, f)
+            # Provenance by reranking is at least as slow as the reranking it would follow
+            if "provenance" in degraded or "rerank" in skipped or "llm" in skipped:
+                skipped.append("provenance")
+            else:
+                self.addProvenance(user_query, reply, generation.compressor)
 
-        # Add to vector DB
-        self.db.add_documents(new_chunks)
+        reply["mode"] = "extractive" if "llm" in skipped else "degraded" if skipped else "full"
+        with self.modes_lock:
+            self.modes[reply["mode"]] += 1
+            self.skipped_stages.update(skipped)
+        if skipped:
+            self.logger.info(f"Answered in {reply['mode']} mode, skipped {', '.join(skipped)} "
+                             f"after {time.perf_counter() - start:.1f} s")
 
-        # Add to BM25
-        bm25_retriever = BM25Retriever.from_texts(
-            [x.page_content for x in self.chunked_documents],
-            metadatas=[x.metadata for x in self.chunked_documents]
-        )
+        # Only complete answers are worth reusing
+        if query_vector is not None and reply["mode"] == "full":
+            self.answer_cache.add(query_vector, generation.number, reply, time.perf_counter() - start)
 
-        # Update full retriever too
-        retriever = self.db.as_retriever(search_type="mmr", search_kwargs={'k': int(os.getenv('vector_store_k'))})
-        self.ensemble_retriever = EnsembleRetriever(
-            retrievers=[bm25_retriever, retriever], weights=[0.5, 0.5]
-        )
+        return (thread, reply)
 
-        if os.getenv("rerank") == "True":
-            if os.getenv("rerank_model") == "flashrank":
-                self.compressor = FlashrankRerank(top_n=int(os.getenv("rerank_k")),
-                                                  model=os.getenv("flashrank_model", None))
-            else:
-                self.compressor = ScoredCrossEncoderReranker(
-                    model=HuggingFaceCrossEncoder(model_name=os.getenv("rerank_model")),
-                    top_n=int(os.getenv("rerank_k"))
-                )
+    def addProvenance(self, user_query, reply, compressor):
+        # Add the user question and the answer to our thread for provenance computation
+        check_deadline("provenance")
+        answer = reply['answer']
+        context = reply['docs']
+
+        # Use the reranker but now on the answer (and potentially query too)
+        if os.getenv("provenance_method") == "rerank":
+            if not (os.getenv("rerank") == "True"):
+                raise ValueError(
+                    "Provenance attribution is set to rerank but reranking is not enabled. Please choose another provenance method or turn on reranking.")
+            reranked_docs = compute_rerank_provenance(compressor, user_query, reply['docs'], answer)
+
+            # This is a bit of a hassle because reranked_docs is now reordered and we have no definitive key to use because of hybrid search.
+            # Note that we can't just return reranked_docs because the LLM may refer to "doc #1" in the order of the original scoring.
+            provenance_scores = []
+            for doc in context:
+                # Find the document in reranked_docs
+                reranked_score = \
+                    [d.metadata['relevance_score'] for d in reranked_docs if d.page_content == doc.page_content][0]
+                provenance_scores.append(reranked_score)
+        # See if we need to do similarity-base provenance
+        elif os.getenv("provenance_method") == "similarity":
+            pass
+            # provenance_scores = self.attributor.compute_similarity(user_query, context, answer)
+        # See if we need to use LLM-based provenance
+        elif os.getenv("provenance_method") == "llm":
+            pass
+            # provenance_scores = compute_llm_provenance_cloud(self.llm, user_query, context, answer)
+
+        # Add the provenance scores
+        for i, score in enumerate(provenance_scores):
+            reply['docs'][i].metadata['provenance'] = score
+
+    def degradationStats(self):
+        with self.modes_lock:
+            return {"modes": dict(self.modes), "skipped_stages": dict(self.skipped_stages)}
+
+    def afterFork(self):
+        super().afterFork()
+        self.llm_executor = ThreadPoolExecutor(max_workers=int(os.getenv("llm_threads", 16)),
+                                               thread_name_prefix="llm")
+        self.modes_lock = threading.Lock()
+        if isinstance(self.llm, LLMRouter):
+            self.llm.after_fork()
+
+    def addDocuments(self, filenames, progress=None):
+        """
+        Add files from the data directory in one index update: the new paragraphs of all files are embedded and
+        stored together, and the next index generation is built once and then published, requests keep searching
+        the current one until then. A file that cannot be loaded is skipped.
+        progress is called with the name of every phase (loading, embedding, indexing). Returns the error per
+        skipped file and the seconds spent per phase.
+        """
+        progress = progress or (lambda phase: None)
+        timings, failures = {}, {}
+
+        # One writer at a time, each builds on the generation the previous one published
+        with self.generation_lock:
+            current = self.generation
+
+            # Same splitter, IDs and source prefix as the initial load, so new chunks can be found from a compact
+            # history
+            progress("loading")
+            start = time.perf_counter()
+            splitter = self.buildSplitter()
+            new_chunks, licenses = [], {}
+            # Seen in the order of the loaded labels, as the initial load saw them, so a new file with the license
+            # number of a loaded label is told apart from it
+            for doc in current.chunked_documents:
+                licenses.setdefault(license_number(doc.metadata['source']), doc.metadata['source'])
+            for filename in filenames:
+                try:
+                    docs = load_file(os.path.join(os.getenv("data_directory"), filename))
+                    new_chunks.extend(identify_chunks(splitter.split_documents(docs), licenses))
+                except Exception as e:
+                    self.logger.warning(f"Could not load {filename}: {e!r}")
+                    failures[filename] = repr(e)
+            timings["load"] = time.perf_counter() - start
+            if len(new_chunks) == 0:
+                return {"failures": failures, "timings": timings}
+
+            # Only paragraphs that no label contains yet need to be embedded. The current generation does not
+            # know the new paragraphs, so its searches skip them
+            progress("embedding")
+            start = time.perf_counter()
+            new_contents = [doc for doc in self.contentDocuments(new_chunks)
+                            if doc.metadata['id'] not in current.content_index]
+            if len(new_contents) > 0:
+                self.addToVectorStore(new_contents)
+            timings["embed"] = time.perf_counter() - start
+
+            # A label that is added again replaces its earlier version
+            progress("indexing")
+            start = time.perf_counter()
+            sources = {doc.metadata['source'] for doc in new_chunks}
+            chunks = [doc for doc in current.chunked_documents if doc.metadata['source'] not in sources] + new_chunks
+            generation = self.buildGeneration(current.number + 1, chunks, refresh=True)
+            # Saved before it is published, so a restart serves the documents the workers already answer from
+            self.saveGeneration(generation)
+            self.publishGeneration(generation)
+            timings["index"] = time.perf_counter() - start
+        return {"failures": failures, "timings": timings}
 
-            self.rerank_retriever = ContextualCompressionRetriever(
-                base_compressor=self.compressor, base_retriever=self.ensemble_retriever
-            )
+    def addDocument(self, filename):
+        return self.addDocuments([filename])
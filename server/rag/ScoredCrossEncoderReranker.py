@@ -8,6 +8,8 @@ from langchain_core.documents import BaseDocumentCompressor, Document
 
 from langchain.retrievers.document_compressors.cross_encoder import BaseCrossEncoder
 
+from .deadline import check_deadline
+
 
 class ScoredCrossEncoderReranker(BaseDocumentCompressor):
     """Document compressor that uses CrossEncoder for reranking."""
@@ -42,4 +44,25 @@ class ScoredCrossEncoderReranker(BaseDocumentCompressor):
         scores = self.model.score([(query, doc.page_content) for doc in documents])
         docs_with_scores = list(zip(documents, scores))
         result = sorted(docs_with_scores, key=operator.itemgetter(1), reverse=True)
-        return [doc.copy(update={"metadata": {**doc.metadata, "relevance_score": score}}) for doc, score in result[:self.top_n]]
\ No newline at end of file
+        return [doc.copy(update={"metadata": {**doc.metadata, "relevance_score": score}}) for doc, score in result[:self.top_n]]
+
+
+class DeadlineCompressor(BaseDocumentCompressor):
+    """Document compressor that checks the request deadline before running the wrapped one (e.g. a reranker)."""
+
+    compressor: BaseDocumentCompressor
+    """Compressor to run."""
+    stage: str = "rerank"
+    """Stage name reported when the deadline has passed."""
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def compress_documents(
+        self,
+        documents: Sequence[Document],
+        query: str,
+        callbacks: Optional[Callbacks] = None,
+    ) -> Sequence[Document]:
+        check_deadline(self.stage)
+        return self.compressor.compress_documents(documents, query, callbacks=callbacks)
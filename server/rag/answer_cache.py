@@ -0,0 +1,99 @@
+import threading
+import time
+
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """
+    Cache of first-turn answers, looked up by the similarity of the question embedding.
+
+    The question vectors live in one preallocated, normalized matrix, so a lookup is a single matrix-vector
+    product; at a few thousand entries that is faster than maintaining a graph-based ANN index. Every entry is
+    tagged with the index generation it was answered from and is dropped once new documents are ingested.
+    When the cache is full the least recently used entry is evicted.
+    """
+
+    def __init__(self, threshold=0.95, capacity=1024):
+        self.threshold = threshold
+        self.capacity = capacity
+        self.vectors = None
+        self.entries = [None] * capacity
+        self.last_used = np.zeros(capacity)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _drop(self, slot):
+        self.entries[slot] = None
+        self.vectors[slot] = 0
+        self.last_used[slot] = 0
+
+    @staticmethod
+    def _copy(reply):
+        # Requests answered from the same entry must not share the documents or their metadata
+        reply = dict(reply)
+        if "docs" in reply:
+            reply["docs"] = [doc.copy(update={"metadata": dict(doc.metadata)}) for doc in reply["docs"]]
+        return reply
+
+    def lookup(self, query_vector, generation):
+        """Return a copy of the cached reply for the most similar question above the threshold, or None."""
+        query_vector = self._normalize(query_vector)
+        with self.lock:
+            if self.vectors is None:
+                self.misses += 1
+                return None
+            scores = self.vectors @ query_vector
+            for slot in np.argsort(-scores):
+                entry = self.entries[slot]
+                if scores[slot] < self.threshold or entry is None:
+                    break
+                if entry["generation"] != generation:
+                    self._drop(slot)
+                    self.invalidations += 1
+                    continue
+                self.last_used[slot] = time.monotonic()
+                self.hits += 1
+                self.saved_seconds += entry["latency"]
+                return self._copy(entry["reply"])
+            self.misses += 1
+            return None
+
+    def add(self, query_vector, generation, reply, latency):
+        """Store the reply to a question along with how long it took to produce."""
+        query_vector = self._normalize(query_vector)
+        with self.lock:
+            if self.vectors is None:
+                self.vectors = np.zeros((self.capacity, len(query_vector)), dtype=np.float32)
+            free = [slot for slot, entry in enumerate(self.entries) if entry is None]
+            if free:
+                slot = free[0]
+            else:
+                slot = int(np.argmin(self.last_used))
+                self.evictions += 1
+            self.vectors[slot] = query_vector
+            self.entries[slot] = {"generation": generation, "reply": reply, "latency": latency}
+            self.last_used[slot] = time.monotonic()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": sum(entry is not None for entry in self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_seconds": self.saved_seconds,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,142 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from langchain_core.embeddings import Embeddings
+from langchain.retrievers.document_compressors.cross_encoder import BaseCrossEncoder
+
+
+class MicroBatcher:
+    """
+    Collects items submitted by concurrent callers and hands them to process as one batch.
+
+    A worker thread takes the first waiting item, then keeps collecting for at most max_wait seconds or until
+    max_batch_size items are gathered. process gets the list of items and must return one result per item,
+    in order; every caller gets its own result (or the exception) back through a future. With more than one
+    worker, several batches can be in flight at once.
+    """
+
+    def __init__(self, process, max_batch_size=32, max_wait=0.005, workers=1, name="micro-batcher"):
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.workers = workers
+        self.name = name
+        self._start()
+
+    def _start(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.threads = [threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                        for i in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def after_fork(self):
+        # Only the forking thread exists in a forked process, start new worker threads with a fresh queue
+        self._start()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def submit_many(self, items):
+        return [self.submit(item) for item in items]
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            try:
+                results = list(self.process(items))
+                if len(results) != len(items):
+                    raise ValueError(f"{self.name} got {len(results)} results for a batch of {len(items)} items")
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            with self.lock:
+                self.batches += 1
+                self.items += len(items)
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+        }
+
+
+def query_batch_function(embeddings):
+    """
+    A function embedding a batch of queries into the vectors embed_query gives: the provider's embed_queries,
+    embed_documents for providers that embed a query like a document, else embed_query per text (Ollama's query
+    instruction differs from its document one, and it sends one request per text anyway).
+    """
+    if hasattr(embeddings, "embed_queries"):
+        return embeddings.embed_queries
+    from langchain_community.embeddings import HuggingFaceEmbeddings, JinaEmbeddings
+    # Not subclasses, they may embed queries their own way
+    if type(embeddings) in (HuggingFaceEmbeddings, JinaEmbeddings):
+        return embeddings.embed_documents
+    return lambda texts: [embeddings.embed_query(text) for text in texts]
+
+
+class BatchedEmbeddings(Embeddings):
+    """Embeddings whose embed_query calls from concurrent requests are sent to the provider as one batch."""
+
+    def __init__(self, embeddings, max_batch_size=32, max_wait=0.005, workers=1):
+        self.embeddings = embeddings
+        self.batcher = MicroBatcher(query_batch_function(embeddings), max_batch_size=max_batch_size,
+                                    max_wait=max_wait, workers=workers, name="embedding-batcher")
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.batcher.submit(text).result()
+
+
+class BatchedCrossEncoder(BaseCrossEncoder):
+    """
+    Cross-encoder shared by all requests: pending (query, document) pairs of concurrent requests are merged
+    and scored by one warm model on a worker thread. Pairs are sorted by length and scored batch_size at a
+    time, so each model batch pads to about the same length.
+    """
+
+    def __init__(self, model, batch_size=32, max_wait=0.005, max_pairs=256):
+        self.model = model
+        self.batch_size = batch_size
+        self.batcher = MicroBatcher(self._score_pairs, max_batch_size=max_pairs, max_wait=max_wait,
+                                    name="rerank-batcher")
+
+    def _score_pairs(self, pairs):
+        order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0]) + len(pairs[i][1]))
+        scores = [0.0] * len(pairs)
+        for start in range(0, len(order), self.batch_size):
+            bucket = order[start:start + self.batch_size]
+            for i, score in zip(bucket, self.model.score([pairs[i] for i in bucket])):
+                scores[i] = score
+        return scores
+
+    def score(self, text_pairs):
+        return [future.result() for future in self.batcher.submit_many(text_pairs)]
@@ -0,0 +1,49 @@
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Optional
+
+# time.monotonic() by which the current request has to be answered, set by middleware.TimeoutMiddleware. Worker
+# threads started through anyio and LangChain's executors run in a copy of the request's context, so they see it too.
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+_lock = threading.Lock()
+# Stages skipped because their request had already timed out
+skipped = Counter()
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage):
+        super().__init__(f"Request deadline exceeded before {stage}")
+        self.stage = stage
+
+
+def set_deadline(seconds):
+    """Give the current context seconds from now, return the token to reset it with."""
+    return _deadline.set(time.monotonic() + seconds)
+
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left for the current request, or None without a deadline."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def check_deadline(stage):
+    """Raise DeadlineExceeded if the current request has timed out, instead of running stage for nobody."""
+    left = remaining()
+    if left is not None and left <= 0:
+        with _lock:
+            skipped[stage] += 1
+        raise DeadlineExceeded(stage)
+
+
+def stats():
+    with _lock:
+        return {"skipped_stages": dict(skipped)}
+
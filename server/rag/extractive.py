@@ -0,0 +1,42 @@
+import re
+
+# Sentence ends in Chinese and English text, and line breaks (the labels are extracted from PDFs)
+SENTENCE_END = re.compile(r"(?<=[。！？；!?;])|\n+")
+LATIN_WORD = re.compile(r"[A-Za-z0-9]+(?:[.-][A-Za-z0-9]+)*")
+CJK = re.compile(r"[㐀-鿿]+")
+
+
+def terms(text):
+    """Lower-cased Latin words and numbers, and the character bigrams of Chinese runs (single characters if alone)."""
+    found = {word.lower() for word in LATIN_WORD.findall(text)}
+    for run in CJK.findall(text):
+        found.update(run[i:i + 2] for i in range(max(1, len(run) - 1)))
+    return found
+
+
+def highlight(query, text, n=2, max_length=200):
+    """The n sentences of text that share the most terms with query, in their original order."""
+    wanted = terms(query)
+    sentences = [s.strip() for s in SENTENCE_END.split(text) if s and s.strip()]
+    scored = []
+    for i, sentence in enumerate(sentences):
+        score = len(wanted & terms(sentence))
+        if score:
+            scored.append((score, -i, sentence))
+    best = sorted(scored, reverse=True)[:n]
+    return [sentence[:max_length] for _, _, sentence in sorted(best, key=lambda entry: -entry[1])]
+
+
+def extractive_answer(query, docs, intro, n=2):
+    """
+    An answer without the LLM: intro, then the highlights of each document. Returns the answer and copies of
+    the documents with their highlights in the metadata (the retrieved documents may be the chunk store's own).
+    Documents without a matching sentence show their beginning.
+    """
+    lines, highlighted = [intro], []
+    for i, doc in enumerate(docs, start=1):
+        highlights = highlight(query, doc.page_content, n=n) or [" ".join(doc.page_content.split())[:200]]
+        highlighted.append(doc.copy(update={"metadata": {**doc.metadata, "highlights": highlights}}))
+        source = re.split(r"[\\/]", doc.metadata.get("source", ""))[-1].rsplit(".", 1)[0]
+        lines.append(f"{i}. {source}: " + " … ".join(highlights))
+    return "\n".join(lines), highlighted
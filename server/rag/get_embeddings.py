@@ -1,5 +1,6 @@
 from langchain_community.embeddings import JinaEmbeddings, OllamaEmbeddings
-# from langchain_community.embeddings import HuggingFaceEmbeddings
+from .batching import BatchedEmbeddings
+from .query_vectors import RememberedQueryEmbeddings
 import os
 import dotenv
 
@@ -23,13 +24,38 @@ def get_embedding_function():
         )
     elif os.getenv('embedding_provider') == 'ollama':
         embeddings = OllamaEmbeddings(
+            model=os.getenv('embedding_model'),
+        )
+    elif os.getenv('embedding_provider') == 'onnx':
+        # Only needed on nodes that embed locally, so onnxruntime stays an optional dependency
+        from .onnx_embeddings import OnnxEmbeddings
+        embeddings = OnnxEmbeddings(
+            model_path=os.getenv('embedding_model'),
+            quantize=os.getenv('onnx_quantize', "True") == "True",
+            threads=int(os.getenv('onnx_threads', 0)),
+            batch_size=int(os.getenv('onnx_batch_size', 32)),
+            max_length=int(os.getenv('onnx_max_length', 512)),
+            query_prefix=os.getenv('onnx_query_prefix', ""),
+            document_prefix=os.getenv('onnx_document_prefix', ""),
+        )
+    elif os.getenv('embedding_provider') == 'huggingface':
+        # Needs the torch requirements
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+        embeddings = HuggingFaceEmbeddings(
             model_name=os.getenv('embedding_model'),
+            model_kwargs=model_kwargs
         )
     else:
-        pass
-        # embeddings = HuggingFaceEmbeddings(
-        #     model_name=os.getenv('embedding_model'),
-        #     model_kwargs=model_kwargs
-        # )
+        raise ValueError(
+            f"Unknown embedding_provider {os.getenv('embedding_provider')}, choose jina, ollama, onnx or huggingface.")
+
+    # Send the query embeddings of concurrent requests to the provider together
+    if os.getenv('embedding_batching') == "True":
+        embeddings = BatchedEmbeddings(
+            embeddings,
+            max_batch_size=int(os.getenv('embedding_batch_size', 32)),
+            max_wait=float(os.getenv('embedding_batch_max_wait_ms', 5)) / 1000,
+            workers=int(os.getenv('embedding_batch_workers', 1)),
+        )
 
-    return embeddings
+    return RememberedQueryEmbeddings(embeddings)
@@ -0,0 +1,123 @@
+"""
+Prebuilt index bundle, so a worker starts serving without tokenizing the corpus for BM25 again. A bundle is a
+directory with:
+    manifest.json     format, the chunk pickle it was built from (size and modification time) and part sizes
+    chunks.pickle     the chunk store
+    sparse_*.npy      the BM25 postings, document lengths and idf (sparse_terms.json: the row of every term)
+    indexes.pickle    the field indexes: chunk IDs by content ID
+The pickles are memory-mapped and unpickled from the mapping. The BM25 arrays stay memory-mapped, so every worker
+on the machine reads the same pages. A bundle that does not match the chunk pickle is
+ignored; loadData then builds the index as before and writes a fresh bundle.
+
+Build it ahead of deployment (e.g. in the image build), from the server folder:
+    python -m rag.index_bundle
+"""
+import gc
+import json
+import mmap
+import os
+import pickle
+import time
+
+from .sparse_index import BM25Index
+
+FORMAT = 3
+PARTS = ["chunks", "indexes"]
+
+
+def fingerprint(chunks_file):
+    stat = os.stat(chunks_file)
+    return {"path": os.path.abspath(chunks_file), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _load_part(directory, name):
+    with open(os.path.join(directory, f"{name}.pickle"), "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+        return pickle.loads(mapping)
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, "manifest.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_current(directory, chunks_file):
+    manifest = read_manifest(directory)
+    return manifest is not None and manifest["format"] == FORMAT and \
+        manifest["source"] == fingerprint(chunks_file)
+
+
+def write_bundle(directory, chunks_file, generation):
+    """Write the chunks, BM25 postings and field indexes of an index generation built from chunks_file."""
+    os.makedirs(directory, exist_ok=True)
+    parts = {
+        "chunks": generation.chunked_documents,
+        "indexes": {"content_index": generation.content_index},
+    }
+    sizes = {}
+    # Parts first and the manifest last, each written next to the old file and renamed, so workers starting
+    # meanwhile either see a complete bundle or one that no longer matches the chunk pickle
+    for name, value in parts.items():
+        path = os.path.join(directory, f"{name}.pickle")
+        with open(path + f".{os.getpid()}.tmp", "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + f".{os.getpid()}.tmp", path)
+        sizes[name] = os.path.getsize(path)
+    # The retriever's documents are the chunks themselves, only the scoring model is stored
+    sizes["sparse"] = generation.sparse_retriever.vectorizer.save(directory, prefix="sparse")
+    manifest = {
+        "format": FORMAT,
+        "created": time.time(),
+        "source": fingerprint(chunks_file),
+        "chunks": len(generation.chunked_documents),
+        "paragraphs": len(generation.content_index),
+        "sizes": sizes,
+    }
+    path = os.path.join(directory, "manifest.json")
+    with open(path + f".{os.getpid()}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + f".{os.getpid()}.tmp", path)
+    return manifest
+
+
+def load_bundle(directory):
+    """Return the chunks, BM25 model and content index of a bundle, or None if it is incomplete."""
+    manifest = read_manifest(directory)
+    # Unpickling creates millions of objects, garbage collection passes meanwhile only slow it down
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        chunks, indexes = (_load_part(directory, name) for name in PARTS)
+        vectorizer = BM25Index.load(directory, prefix="sparse")
+    except (OSError, ValueError, KeyError, pickle.UnpicklingError, EOFError):
+        return None
+    finally:
+        if enabled:
+            gc.enable()
+    if manifest is None or len(chunks) != manifest["chunks"] or \
+            len(indexes["content_index"]) != manifest["paragraphs"] or \
+            vectorizer.corpus_size != len(chunks):
+        return None
+    return chunks, vectorizer, indexes["content_index"]
+
+
+def main():
+    import logging
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path="rag/.env")
+    logging.basicConfig(level=logging.INFO)
+
+    from .RAGHelper import RAGHelper, load_chunks
+    chunks_file = os.getenv("document_chunks_pickle")
+    start = time.perf_counter()
+    generation = RAGHelper().buildSparseGeneration(load_chunks(chunks_file))
+    manifest = write_bundle(os.getenv("index_bundle_directory"), chunks_file, generation)
+    print(f"{manifest['chunks']} chunks, {manifest['paragraphs']} paragraphs, "
+          f"{sum(manifest['sizes'].values()) / 2 ** 20:.1f} MiB in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
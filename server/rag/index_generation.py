@@ -0,0 +1,46 @@
+class IndexGeneration:
+    """
+    One version of the searchable index: the label chunks, their lookup tables and the retrievers over them.
+
+    A generation is never changed after it is built. Writers build the next one from the current one and
+    publish it by replacing a single reference (RAGHelper.publishGeneration), so a request that took a
+    generation keeps searching the same chunks and retrievers until it finishes, while the next requests
+    already see the new one. The reranker model is shared by the generations of a process; compressor is the one
+    this generation's rerank retriever uses.
+    """
+
+    def __init__(self, number, chunked_documents, content_index=None):
+        # Bumped whenever documents are added, so caches can tell their entries are stale
+        self.number = number
+        self.chunked_documents = chunked_documents
+        # Look up chunks by ID, so compact chat histories can be rehydrated, and the label chunks of every paragraph
+        self.chunk_index = {doc.metadata['id']: doc for doc in chunked_documents}
+        self.content_index = content_index
+        if content_index is None:
+            self.content_index = {}
+            for doc in chunked_documents:
+                self.content_index.setdefault(doc.metadata['content_id'], []).append(doc.metadata['id'])
+        # Set by RAGHelper.buildSparseGeneration and completeGeneration
+        self.sparse_retriever = None
+        self.ensemble_retriever = None
+        self.rerank_retriever = None
+        self.context_retriever = None
+        self.compressor = None
+
+    # Fetch chunks by their ID, silently skipping IDs that are not in this generation
+    def get_chunks(self, chunk_ids):
+        chunks = []
+        for chunk_id in chunk_ids:
+            if chunk_id in self.chunk_index:
+                chunks.append(self.chunk_index[chunk_id])
+            elif chunk_id in self.content_index:
+                # Histories from before stable chunk IDs refer to chunks by the hash of their text
+                chunks.append(self.chunk_index[self.content_index[chunk_id][0]])
+        return chunks
+
+    # The label chunks of paragraphs found in the vector store, which may already hold paragraphs of newer
+    # generations; those are skipped
+    def get_content_chunks(self, content_ids):
+        return self.get_chunks([
+            chunk_id for content_id in content_ids for chunk_id in self.content_index.get(content_id, [])
+        ])
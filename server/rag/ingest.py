@@ -0,0 +1,146 @@
+"""
+Loading of the files in the data directory for ingestion, and the ingest command, which builds the chunk
+pickle and vectorizes it offline, loading and splitting the files in a pool of worker processes.
+
+Run from the server folder:
+    python -m rag.ingest --workers 8              # resumes an interrupted run, --restart starts over
+    python -m rag.ingest --workers 8 --dry-run    # only load and split, and print the throughput
+"""
+import argparse
+import importlib
+import logging
+import os
+import pickle
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from langchain_core.documents.base import Document
+
+
+def loader(name):
+    # Loader modules, and the parsers behind them, are only imported for the file types that occur
+    return getattr(importlib.import_module("langchain_community.document_loaders"), name)
+
+
+def load_xml(path):
+    from lxml import etree
+    # Every element matching xml_xpath becomes a document
+    doc = loader("TextLoader")(path).load()[0]
+    xmltree = etree.fromstring(doc.page_content.encode('utf-8'))
+    elements = xmltree.xpath(os.getenv("xml_xpath"))
+    return [
+        Document(page_content=etree.tostring(element, pretty_print=True).decode(),
+                 metadata={**doc.metadata, 'index': index})
+        for index, element in enumerate(elements)
+    ]
+
+
+LOADERS = {
+    "pdf": lambda path: loader("PyPDFLoader")(path).load(),
+    "json": lambda path: loader("JSONLoader")(
+        file_path=path,
+        jq_schema=os.getenv("json_schema"),
+        text_content=os.getenv("json_text_content").lower() != 'false',
+    ).load(),
+    "txt": lambda path: loader("TextLoader")(path).load(),
+    "csv": lambda path: loader("CSVLoader")(path).load(),
+    "docx": lambda path: loader("Docx2txtLoader")(path).load(),
+    "xlsx": lambda path: loader("UnstructuredExcelLoader")(path).load(),
+    "md": lambda path: loader("UnstructuredMarkdownLoader")(path).load(),
+    "pptx": lambda path: loader("UnstructuredPowerPointLoader")(path).load(),
+    "xml": load_xml,
+}
+
+
+def discover(data_dir, file_types):
+    """Yield the files under data_dir with one of the given extensions, in a stable order."""
+    for root, dirs, names in os.walk(data_dir):
+        dirs.sort()
+        for name in sorted(names):
+            extension = name.rsplit(".", 1)[-1].lower()
+            if extension in file_types and extension in LOADERS and not name.startswith("."):
+                yield os.path.join(root, name)
+
+
+def load_file(path):
+    return LOADERS[path.rsplit(".", 1)[-1].lower()](path)
+
+
+def read_chunks(path):
+    """Read a chunk pickle: a sequence of pickled lists of chunks, written one file at a time."""
+    chunks = []
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                chunks.extend(pickle.load(f))
+            except EOFError:
+                return chunks
+
+
+# The splitter of a worker process
+splitter = None
+
+
+def init_worker():
+    global splitter
+    from .RAGHelper import RAGHelper
+    helper = RAGHelper()
+    if os.getenv('splitter') == 'SemanticChunker':
+        from .get_embeddings import get_embedding_function
+        helper.embeddings = get_embedding_function()
+    splitter = helper.buildSplitter()
+
+
+def load_and_split(path):
+    try:
+        docs = splitter.split_documents(load_file(path))
+    except Exception as e:
+        # Not every exception can be sent back to the main process
+        raise RuntimeError(f"Could not load {path}: {e!r}") from None
+    # Plain (text, metadata) pairs are cheaper to send back to the main process than documents
+    return [(doc.page_content, doc.metadata) for doc in docs]
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path="rag/.env")
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Worker processes for loading and splitting")
+    parser.add_argument("--dry-run", action="store_true", help="Only load and split, and print the throughput")
+    parser.add_argument("--restart", action="store_true", help="Start over instead of resuming an interrupted run")
+    parser.add_argument("--no-vectorize", action="store_true", help="Only write the chunk pickle")
+    args = parser.parse_args()
+
+    paths = list(discover(os.getenv('data_directory'), os.getenv("file_types").split(",")))
+    if args.dry_run:
+        files, chunks, size = 0, 0, 0
+        start = time.perf_counter()
+        with ProcessPoolExecutor(args.workers, initializer=init_worker) as pool:
+            for path, records in zip(paths, pool.map(load_and_split, paths, chunksize=4)):
+                files, chunks, size = files + 1, chunks + len(records), size + os.path.getsize(path)
+        seconds = time.perf_counter() - start
+        print(f"{files} files ({size / 2 ** 20:.1f} MiB) into {chunks} chunks in {seconds:.1f} s "
+              f"on {args.workers} workers: {files / seconds:.1f} files/s, {chunks / seconds:.1f} chunks/s, "
+              f"{size / 2 ** 20 / seconds:.2f} MiB/s")
+        return
+
+    if platform.system() == "Linux":
+        __import__('pysqlite3')
+        sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+
+    from .RAGHelper import RAGHelper
+    from .get_embeddings import get_embedding_function
+    helper = RAGHelper()
+    helper.embeddings = get_embedding_function()
+    helper.text_splitter = helper.buildSplitter()
+    helper.openVectorStore()
+    helper.ingest(paths, chunks_file=os.getenv('document_chunks_pickle'), vectorize=not args.no_vectorize,
+                  processes=args.workers, resume=not args.restart)
+
+
+if __name__ == "__main__":
+    main()
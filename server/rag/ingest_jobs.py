@@ -0,0 +1,88 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from .batching import MicroBatcher
+
+logger = logging.getLogger(__name__)
+
+STATUSES = ["queued", "loading", "embedding", "indexing", "done", "failed"]
+
+
+class IngestionJobs:
+    """
+    Background queue for documents to add to the index, so requests only have to enqueue them.
+
+    One worker takes the waiting jobs, collecting for at most max_wait seconds after the first one or until
+    max_batch_size jobs are gathered, and adds the files of all of them in one index update through
+    add_documents(filenames, progress). The last max_jobs jobs are kept for status queries.
+    """
+
+    def __init__(self, add_documents, max_batch_size=16, max_wait=2.0, max_jobs=1000):
+        self.add_documents = add_documents
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.batcher = MicroBatcher(self._process, max_batch_size=max_batch_size, max_wait=max_wait,
+                                    name="ingestion-worker")
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.batcher.after_fork()
+
+    def submit(self, filenames):
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "files": list(filenames),
+            "submitted": time.time(),
+            "started": None,
+            "finished": None,
+            "batch_files": None,
+            "timings": {},
+            "failures": {},
+            "error": None,
+        }
+        with self.lock:
+            self.jobs[job["id"]] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        self.batcher.submit(job)
+        return dict(job)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _update(self, jobs, **fields):
+        with self.lock:
+            for job in jobs:
+                job.update(fields)
+
+    def _process(self, jobs):
+        filenames = [filename for job in jobs for filename in job["files"]]
+        self._update(jobs, status="loading", started=time.time(), batch_files=len(filenames))
+        try:
+            result = self.add_documents(filenames, progress=lambda phase: self._update(jobs, status=phase))
+        except Exception as e:
+            logger.exception(f"Adding {filenames} failed")
+            self._update(jobs, status="failed", error=repr(e), finished=time.time())
+            return [None] * len(jobs)
+
+        with self.lock:
+            for job in jobs:
+                failures = {f: result["failures"][f] for f in job["files"] if f in result["failures"]}
+                job.update(status="failed" if len(failures) == len(job["files"]) else "done", failures=failures,
+                           timings=result["timings"], finished=time.time())
+        return [None] * len(jobs)
+
+    def stats(self):
+        with self.lock:
+            statuses = [job["status"] for job in self.jobs.values()]
+        return {
+            **{status: statuses.count(status) for status in STATUSES},
+            **self.batcher.stats(),
+        }
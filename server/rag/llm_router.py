@@ -0,0 +1,271 @@
+import contextvars
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.runnables import Runnable
+
+PROVIDERS = ["openai", "gemini", "azure", "ollama"]
+
+
+class LLMUnavailable(RuntimeError):
+    """No provider answered: they all failed or their circuits are open."""
+
+
+def build_llm(kind, base_url=None, max_retries=2):
+    """
+    The LLM of one provider (openai, gemini, azure or ollama), configured by the provider's settings in the
+    environment; base_url points openai at another OpenAI-compatible server (Ollama's is at /v1, the ollama
+    provider itself only takes OLLAMA_HOST). Only the SDK of the provider is imported. Each model keeps one HTTP
+    client, so connections are reused.
+    """
+    if kind == "openai":
+        import httpx
+        from langchain_openai import ChatOpenAI
+        threads = int(os.getenv("llm_threads", 16))
+        return ChatOpenAI(
+            model=os.getenv("openai_model_name"),
+            temperature=0,
+            max_tokens=None,
+            timeout=None,
+            max_retries=max_retries,
+            base_url=base_url,
+            http_client=httpx.Client(limits=httpx.Limits(max_connections=threads,
+                                                         max_keepalive_connections=threads)),
+        )
+    if base_url:
+        raise ValueError(f"Only openai providers take a base URL, not {kind}")
+    if kind == "gemini":
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        return ChatGoogleGenerativeAI(model=os.getenv("gemini_model_name"), convert_system_message_to_human=True)
+    if kind == "azure":
+        from langchain_openai import AzureChatOpenAI
+        return AzureChatOpenAI(
+            openai_api_version=os.environ["AZURE_OPENAI_API_VERSION"],
+            azure_deployment=os.environ["AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"],
+            max_retries=max_retries,
+        )
+    if kind == "ollama":
+        from langchain_ollama.llms import OllamaLLM
+        return OllamaLLM(model=os.getenv("ollama_model"))
+    raise ValueError(f"Unknown LLM provider {kind}, expected one of {', '.join(PROVIDERS)}")
+
+
+class Provider:
+    """
+    One LLM behind a circuit breaker. A call that fails or takes longer than slow seconds counts as a failure;
+    after failures of them in a row the circuit opens and the provider gets no calls for cooldown seconds, then
+    a single trial call decides whether it closes again. Keeps the latencies of its last window answers.
+    """
+
+    def __init__(self, name, llm, failures=3, slow=30, cooldown=30, window=200):
+        self.name = name
+        self.llm = llm
+        self.failures = failures
+        self.slow = slow
+        self.cooldown = cooldown
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failed = 0
+        self.opened = 0.0
+        self.trial = False
+        self.calls = 0
+        self.errors = 0
+        self.slow_calls = 0
+        self.wins = 0
+        self.trips = 0
+
+    def acquire(self):
+        """Whether the provider takes a call now. Past the cooldown, the first caller gets the trial call."""
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if not self.trial and time.monotonic() - self.opened >= self.cooldown:
+                self.state = "half-open"
+                self.trial = True
+                return True
+            return False
+
+    def percentile(self, q):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else None
+
+    def _record(self, seconds, error):
+        with self.lock:
+            self.calls += 1
+            if error:
+                self.errors += 1
+            elif seconds > self.slow:
+                self.slow_calls += 1
+            else:
+                self.latencies.append(seconds)
+            if error or seconds > self.slow:
+                self.failed += 1
+                if self.state == "half-open" or self.failed >= self.failures:
+                    if self.state != "open":
+                        self.trips += 1
+                    self.state = "open"
+                    self.opened = time.monotonic()
+            else:
+                self.failed = 0
+                self.state = "closed"
+            self.trial = False
+
+    def invoke(self, input, config=None, **kwargs):
+        start = time.monotonic()
+        try:
+            result = self.llm.invoke(input, config, **kwargs)
+        except Exception:
+            self._record(time.monotonic() - start, True)
+            raise
+        self._record(time.monotonic() - start, False)
+        return result
+
+    def stats(self):
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        with self.lock:
+            return {
+                "state": self.state,
+                "calls": self.calls,
+                "errors": self.errors,
+                "slow": self.slow_calls,
+                "wins": self.wins,
+                "trips": self.trips,
+                "p50_ms": None if p50 is None else 1000 * p50,
+                "p95_ms": None if p95 is None else 1000 * p95,
+            }
+
+
+class LLMRouter(Runnable):
+    """
+    Sends each call to the first provider whose circuit is closed. If it has not answered by the provider's p95
+    latency (hedge_delay seconds until it has answered min_samples times, never less than min_delay), the same
+    call is sent to the next provider (or again to the only one) up to max_hedges times; a provider that fails
+    hands the call on at once. The first answer wins, the slower calls run on in the background and only count
+    for their provider's latencies and circuit. Raises LLMUnavailable when no provider answered.
+    """
+
+    def __init__(self, providers, hedge_delay=2.0, min_delay=0.05, min_samples=20, max_hedges=1, threads=16):
+        self.providers = providers
+        self.hedge_delay = hedge_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.max_hedges = max_hedges
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        self.failover_wins = 0
+        self.unavailable = 0
+        self.after_fork()
+
+    def after_fork(self):
+        # Calls run on their own threads so the first answer can be taken while the others are still waiting
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="llm-router")
+
+    def delay(self, provider):
+        if len(provider.latencies) < self.min_samples:
+            return self.hedge_delay
+        return max(self.min_delay, provider.percentile(0.95))
+
+    def _next(self, tried, hedge):
+        for provider in self.providers:
+            if provider not in tried and provider.acquire():
+                return provider
+        # With no other provider to hedge with, ask the same one again
+        if hedge and len(self.providers) == 1 and self.providers[0].state == "closed":
+            return self.providers[0]
+        return None
+
+    def invoke(self, input, config=None, **kwargs):
+        with self.lock:
+            self.requests += 1
+        done = queue.Queue()
+        launched = []
+
+        # kind is first, hedge or failover, so wins are credited to what launched the call
+        def launch(provider, kind):
+            launched.append(provider)
+            future = self.executor.submit(contextvars.copy_context().run, provider.invoke, input, config, **kwargs)
+            future.add_done_callback(lambda future: done.put((provider, kind, future)))
+
+        provider = self._next(launched, hedge=False)
+        if provider is None:
+            with self.lock:
+                self.unavailable += 1
+            raise LLMUnavailable("The circuits of all LLM providers are open")
+        launch(provider, "first")
+        pending, hedges, error = 1, 0, None
+        while pending:
+            timeout = self.delay(launched[-1]) if hedges < self.max_hedges else None
+            try:
+                provider, kind, future = done.get(timeout=timeout)
+            except queue.Empty:
+                provider = self._next(launched, hedge=True)
+                hedges += 1
+                if provider is not None:
+                    launch(provider, "hedge")
+                    pending += 1
+                    with self.lock:
+                        self.hedged += 1
+                continue
+            pending -= 1
+            error = future.exception()
+            if error is None:
+                with provider.lock:
+                    provider.wins += 1
+                with self.lock:
+                    if kind == "hedge":
+                        self.hedge_wins += 1
+                    elif kind == "failover":
+                        self.failover_wins += 1
+                return future.result()
+            # Hand a failed call on to the next provider right away
+            provider = self._next(launched, hedge=False)
+            if provider is not None:
+                launch(provider, "failover")
+                pending += 1
+                with self.lock:
+                    self.failovers += 1
+        with self.lock:
+            self.unavailable += 1
+        raise LLMUnavailable(f"No LLM provider answered: {error}") from error
+
+    def stats(self):
+        with self.lock:
+            stats = {"requests": self.requests, "hedged": self.hedged, "hedge_wins": self.hedge_wins,
+                     "failovers": self.failovers, "failover_wins": self.failover_wins,
+                     "unavailable": self.unavailable}
+        stats["providers"] = {provider.name: provider.stats() for provider in self.providers}
+        return stats
+
+
+def router_from_env():
+    """
+    The LLMRouter of llm_providers, a comma separated list of providers, each a kind of build_llm optionally
+    followed by =base_url (for example "openai,openai=http://localhost:8001/v1,gemini"). Providers retry
+    nothing themselves, failing over is the router's job.
+    """
+    providers = []
+    for i, spec in enumerate(s.strip() for s in os.getenv("llm_providers", "").split(",") if s.strip()):
+        kind, _, base_url = spec.partition("=")
+        providers.append(Provider(
+            f"{i}:{kind}", build_llm(kind.strip(), base_url.strip() or None, max_retries=0),
+            failures=int(os.getenv("llm_breaker_failures", 3)),
+            slow=float(os.getenv("llm_breaker_slow_seconds", 30)),
+            cooldown=float(os.getenv("llm_breaker_cooldown", 30)),
+        ))
+    return LLMRouter(
+        providers,
+        hedge_delay=float(os.getenv("llm_hedge_delay_ms", 2000)) / 1000,
+        min_delay=float(os.getenv("llm_hedge_min_delay_ms", 50)) / 1000,
+        max_hedges=int(os.getenv("llm_max_hedges", 1)),
+        threads=int(os.getenv("llm_threads", 16)),
+    )
@@ -0,0 +1,169 @@
+import json
+import os
+
+import numpy as np
+
+MAGIC = b"RAGIVF01"
+ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _kmeans(vectors, nlist, iterations=10, sample_size=65536, seed=0):
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False))])
+    nlist = min(nlist, len(sample))
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        for cluster in range(nlist):
+            members = sample[assignment == cluster]
+            if len(members) > 0:
+                centroids[cluster] = members.mean(axis=0)
+        centroids /= np.clip(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12, None)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file index over normalized vectors, stored as one file that every worker memory-maps read-only.
+
+    The vectors are clustered around nlist centroids and stored grouped by cluster; a search scores the
+    centroids and then exactly scores the vectors of the nprobe closest clusters. More probes find more of the
+    true neighbours at the cost of scanning more vectors, like ef in HNSW.
+
+    File layout: magic, header length and a JSON header (sizes and the chunk ID of every row), followed by the
+    centroids, the cluster offsets and the vectors, each aligned to 64 bytes.
+    """
+
+    def __init__(self, path, nprobe=16):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a local vector index")
+            header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_length))
+        self.ids = header["ids"]
+        self.nprobe = nprobe
+        n, dims, nlist = len(self.ids), header["dims"], header["nlist"]
+        # How well the clusters fit: the vectors clustered and their mean similarity to their centroid, and the
+        # same for the vectors added to the lists since (files written before these were kept have neither)
+        self.clustered = header.get("clustered", n)
+        self.fit = header.get("fit")
+        self.added = header.get("added", 0)
+        self.added_fit = header.get("added_fit", 0.0)
+        offset = _aligned(len(MAGIC) + 8 + header_length)
+        self.centroids = np.memmap(path, dtype=np.float32, mode="r", offset=offset, shape=(nlist, dims))
+        offset = _aligned(offset + self.centroids.nbytes)
+        self.offsets = np.memmap(path, dtype=np.int64, mode="r", offset=offset, shape=(nlist + 1,))
+        offset = _aligned(offset + self.offsets.nbytes)
+        self.vectors = np.memmap(path, dtype=np.float32, mode="r", offset=offset, shape=(n, dims))
+
+    @staticmethod
+    def _write(path, header, centroids, offsets, blocks):
+        header = json.dumps(header).encode()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(MAGIC)
+            f.write(np.uint64(len(header)).tobytes())
+            f.write(header)
+            for array in [centroids, offsets]:
+                f.write(b"\0" * (_aligned(f.tell()) - f.tell()))
+                f.write(np.ascontiguousarray(array).tobytes())
+            f.write(b"\0" * (_aligned(f.tell()) - f.tell()))
+            for block in blocks:
+                f.write(np.ascontiguousarray(block, dtype=np.float32).tobytes())
+        # Workers that still have the old file mapped keep reading it until they reload
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def _assign(vectors, centroids):
+        assignment, scores = [], []
+        for start in range(0, len(vectors), 65536):
+            similarity = vectors[start:start + 65536] @ centroids.T
+            assignment.append(np.argmax(similarity, axis=1))
+            scores.append(similarity.max(axis=1))
+        return np.concatenate(assignment), np.concatenate(scores)
+
+    @staticmethod
+    def build(ids, vectors, path, nlist=None):
+        """Cluster the vectors and write the index to path, replacing any previous index atomically."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            # Nothing to cluster: an index without clusters that finds nothing until vectors are added
+            vectors = vectors.reshape(0, vectors.shape[1] if vectors.ndim == 2 else 0)
+            centroids = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+            assignment, scores = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        else:
+            vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+            centroids = _kmeans(vectors, min(nlist or max(1, int(4 * np.sqrt(len(vectors)))), len(vectors)))
+            assignment, scores = IVFIndex._assign(vectors, centroids)
+        nlist = len(centroids)
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.searchsorted(assignment[order], np.arange(nlist + 1)).astype(np.int64)
+        header = {"dims": vectors.shape[1], "nlist": nlist, "ids": [ids[i] for i in order],
+                  "clustered": len(vectors), "fit": float(scores.mean()) if len(scores) else None}
+        IVFIndex._write(path, header, centroids, offsets, [vectors[order]])
+
+    @staticmethod
+    def add(ids, vectors, path, growth=0.5, drift=0.05):
+        """
+        Add vectors to the index at path without clustering again: each goes to the list of its nearest centroid
+        and the stored lists are copied over as they are. Once more than growth times the clustered vectors have
+        been added this way, or the added vectors are on average drift less similar to their centroids than the
+        clustered ones were, the clusters no longer fit and the whole index is built again.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not os.path.exists(path):
+            IVFIndex.build(ids, vectors, path)
+            return
+        index = IVFIndex(path)
+        if len(vectors) == 0:
+            return
+        if len(index.ids) == 0:
+            # An empty index has no clusters to add to, and may not know the dimensions yet
+            IVFIndex.build(ids, vectors, path)
+            return
+        vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        assignment, scores = IVFIndex._assign(vectors, np.asarray(index.centroids))
+        added = index.added + len(vectors)
+        added_fit = (index.added_fit * index.added + float(scores.sum())) / added
+        if added > growth * index.clustered or (index.fit is not None and index.fit - added_fit > drift):
+            IVFIndex.build(index.ids + list(ids), np.concatenate([np.asarray(index.vectors), vectors]), path)
+            return
+
+        nlist = len(index.centroids)
+        order = np.argsort(assignment, kind="stable")
+        new_offsets = np.searchsorted(assignment[order], np.arange(nlist + 1))
+        offsets = index.offsets + new_offsets
+        header_ids, blocks = [], []
+        for cluster in range(nlist):
+            new_rows = order[new_offsets[cluster]:new_offsets[cluster + 1]]
+            header_ids += index.ids[index.offsets[cluster]:index.offsets[cluster + 1]] + [ids[i] for i in new_rows]
+            blocks += [index.vectors[index.offsets[cluster]:index.offsets[cluster + 1]], vectors[new_rows]]
+        header = {"dims": index.vectors.shape[1], "nlist": nlist, "ids": header_ids, "clustered": index.clustered,
+                  "fit": index.fit, "added": added, "added_fit": added_fit}
+        IVFIndex._write(path, header, index.centroids, offsets.astype(np.int64), blocks)
+
+    @property
+    def nbytes(self):
+        return self.centroids.nbytes + self.offsets.nbytes + self.vectors.nbytes
+
+    def search(self, query, fetch_k):
+        """Return the rows of the fetch_k nearest vectors among the probed clusters with their scores, best first."""
+        if len(self.centroids) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        query = np.asarray(query, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        probes = np.argsort(-(self.centroids @ query))[:self.nprobe]
+        rows = np.concatenate([np.arange(self.offsets[p], self.offsets[p + 1]) for p in np.sort(probes)])
+        if len(rows) == 0:
+            return rows, np.zeros(0, dtype=np.float32)
+        scores = np.concatenate([
+            self.vectors[self.offsets[p]:self.offsets[p + 1]] @ query for p in np.sort(probes)
+        ])
+        fetch_k = min(fetch_k, len(rows))
+        best = np.argpartition(-scores, fetch_k - 1)[:fetch_k]
+        best = best[np.argsort(-scores[best])]
+        return rows[best], scores[best]
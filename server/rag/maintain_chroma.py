@@ -0,0 +1,158 @@
+"""
+Maintenance of the Chroma collection: copies it into a fresh collection created with the HNSW settings from
+rag/.env, keyed by content ID, and replaces the old one. Rows of paragraphs that no chunk in the chunk pickle
+contains (orphans) and extra copies of a paragraph are dropped, the HNSW graph is rebuilt without its deleted
+entries and the SQLite file is vacuumed. Reports the size and search latency before and after.
+
+The old collection is renamed aside before the copy takes its name and only deleted after that, so a run that is
+interrupted loses nothing: the next run puts the old collection back if the copy did not take over yet, and
+finishes the swap otherwise.
+
+Stop the server first, then run from the server folder:
+    python -m rag.maintain_chroma              # compact
+    python -m rag.maintain_chroma --dry-run    # only report
+"""
+import argparse
+import os
+import pickle
+import platform
+import re
+import sys
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+if platform.system() == "Linux":
+    __import__('pysqlite3')
+    sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+
+import sqlite3
+
+import chromadb
+
+from .RAGHelper import chromaMetadata
+from .ingest import read_chunks
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def search_latency(collection, queries, k):
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        collection.query(query_embeddings=[query], n_results=k,
+                         include=["metadatas", "documents", "distances", "embeddings"])
+        timings.append(time.perf_counter() - start)
+    return np.mean(timings) * 1000, np.percentile(timings, 95) * 1000
+
+
+def report(label, path, collection, queries, k):
+    mean, p95 = search_latency(collection, queries, k)
+    print(f"{label}: {collection.count()} vectors, {directory_size(path) / 2 ** 20:.1f} MiB on disk, "
+          f"search {mean:.1f} ms mean / {p95:.1f} ms p95, HNSW settings {hnsw_settings(collection)}")
+
+
+def hnsw_settings(collection):
+    return {key: value for key, value in (collection.metadata or {}).items() if key.startswith("hnsw:")} or "default"
+
+
+def recover(client, name):
+    """Finish or undo the swap of an interrupted run."""
+    names = {collection.name for collection in client.list_collections()}
+    if f"{name}_replaced" in names:
+        if name in names:
+            client.delete_collection(f"{name}_replaced")
+        else:
+            client.get_collection(f"{name}_replaced").modify(name=name)
+            print(f"Restored collection {name} from an interrupted run")
+    if f"{name}_compacted" in names:
+        client.delete_collection(f"{name}_compacted")
+
+
+def main():
+    load_dotenv(dotenv_path="rag/.env")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true", help="Only report, leave the collection as it is")
+    parser.add_argument("--queries", type=int, default=100, help="Number of searches to time")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    path = os.getenv("persist_directory")
+    name = os.getenv("vector_store_collection")
+    # 20 results with their embeddings, like the MMR retriever fetches
+    k = int(os.getenv("vector_store_fetch_k") or 20)
+    # The collection holds one row per paragraph, keyed by content ID (chunk ID before stable chunk IDs). Labels
+    # uploaded before they were saved to the chunk pickle are only in the sparse pickle of their vector store
+    chunks = read_chunks(os.getenv("document_chunks_pickle"))
+    legacy = re.sub(r'[<>:"/\\|?*]', "_", os.getenv("vector_store")) + "_sparse.pickle"
+    if os.path.exists(legacy):
+        with open(legacy, "rb") as f:
+            chunks += pickle.load(f)
+    known = {doc.metadata.get('content_id', doc.metadata['id']) for doc in chunks}
+
+    client = chromadb.PersistentClient(path=path)
+    recover(client, name)
+    source = client.get_collection(name)
+    if source.count() == 0:
+        print(f"Collection {name} holds no vectors, nothing to maintain")
+        return
+
+    # Read everything once, keeping the first row of every paragraph that still exists
+    rows, orphans, duplicates = {}, 0, 0
+    offset = 0
+    while True:
+        batch = source.get(include=["embeddings", "metadatas", "documents"], limit=args.batch_size, offset=offset)
+        if len(batch["ids"]) == 0:
+            break
+        for chroma_id, embedding, metadata, document in zip(batch["ids"], batch["embeddings"], batch["metadatas"],
+                                                            batch["documents"]):
+            chunk_id = (metadata or {}).get("id", chroma_id)
+            if chunk_id not in known:
+                orphans += 1
+            elif chunk_id in rows:
+                duplicates += 1
+            else:
+                rows[chunk_id] = (embedding, metadata, document)
+        offset += args.batch_size
+
+    if not rows:
+        print(f"None of the {orphans} rows of collection {name} belong to a current paragraph, ingest the documents "
+              f"again instead")
+        return
+
+    rng = np.random.default_rng(0)
+    embeddings = [row[0] for row in rows.values()]
+    queries = [embeddings[i] for i in rng.choice(len(embeddings), min(args.queries, len(embeddings)), replace=False)]
+    report("before", path, source, queries, k)
+    print(f"{len(rows)} paragraphs, {orphans} orphaned rows, {duplicates} duplicate rows, "
+          f"{len(known) - len(rows)} paragraphs missing from the collection")
+    if args.dry_run:
+        return
+
+    # Keep the distance function, changing it would change the scores
+    metadata = {key: value for key, value in (source.metadata or {}).items()
+                if not key.startswith("hnsw:") or key == "hnsw:space"}
+    metadata.update(chromaMetadata() or {})
+    target = client.create_collection(f"{name}_compacted", metadata=metadata or None)
+    items = list(rows.items())
+    for start in range(0, len(items), args.batch_size):
+        batch = items[start:start + args.batch_size]
+        target.add(ids=[chunk_id for chunk_id, _ in batch],
+                   embeddings=[row[0] for _, row in batch],
+                   metadatas=[row[1] for _, row in batch],
+                   documents=[row[2] for _, row in batch])
+    # Each rename is one transaction, in between the old collection is still there under its new name
+    source.modify(name=f"{name}_replaced")
+    target.modify(name=name)
+    client.delete_collection(f"{name}_replaced")
+
+    with sqlite3.connect(os.path.join(path, "chroma.sqlite3")) as connection:
+        connection.execute("VACUUM")
+    report("after", path, client.get_collection(name), queries, k)
+
+
+if __name__ == "__main__":
+    main()
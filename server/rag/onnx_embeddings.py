@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import onnxruntime as ort
+from langchain_core.embeddings import Embeddings
+from tokenizers import Tokenizer
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Sentence embeddings computed in-process on the CPU with ONNX Runtime, mean-pooled and normalized.
+
+    model_path is a directory holding an exported encoder as model.onnx next to its tokenizer.json, for example
+    `optimum-cli export onnx --model intfloat/multilingual-e5-small <dir>`. With quantize set, an int8 copy
+    (model_int8.onnx) is made with dynamic quantization on first use and loaded instead.
+    """
+
+    def __init__(self, model_path, quantize=True, threads=0, batch_size=32, max_length=512,
+                 query_prefix="", document_prefix=""):
+        model_file = os.path.join(model_path, "model.onnx")
+        if quantize:
+            quantized_file = os.path.join(model_path, "model_int8.onnx")
+            if not os.path.exists(quantized_file):
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+                quantize_dynamic(model_file, quantized_file, weight_type=QuantType.QInt8)
+            model_file = quantized_file
+
+        self.model_file = model_file
+        self.options = ort.SessionOptions()
+        # 0 lets ONNX Runtime use every core
+        self.options.intra_op_num_threads = threads
+        self.options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(model_file, self.options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_path, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.enable_padding()
+        self.batch_size = batch_size
+        self.query_prefix = query_prefix
+        self.document_prefix = document_prefix
+
+    def after_fork(self):
+        # The session's thread pool does not exist in a forked process
+        self.session = ort.InferenceSession(self.model_file, self.options, providers=["CPUExecutionProvider"])
+
+    def _embed_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+
+        output = self.session.run(None, inputs)[0]
+        if output.ndim == 3:
+            # Token embeddings, average the ones that aren't padding
+            mask = attention_mask[..., None].astype(output.dtype)
+            output = (output * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return output / np.clip(np.linalg.norm(output, axis=1, keepdims=True), 1e-9, None)
+
+    def _embed(self, texts):
+        # Batch texts of similar length together to keep padding down
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        embeddings = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            for i, embedding in zip(batch, self._embed_batch([texts[i] for i in batch])):
+                embeddings[i] = embedding.tolist()
+        return embeddings
+
+    def embed_documents(self, texts):
+        return self._embed([self.document_prefix + text for text in texts])
+
+    def embed_queries(self, texts):
+        return self._embed([self.query_prefix + text for text in texts])
+
+    def embed_query(self, text):
+        return self.embed_queries([text])[0]
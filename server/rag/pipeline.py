@@ -0,0 +1,129 @@
+import queue
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Marks the end of the stream in a queue
+DONE = object()
+
+
+def peak_rss_mib():
+    if resource is None:
+        return None
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Pipeline:
+    """
+    Streams items from a source through a chain of stages that run on their own threads, connected by bounded
+    queues. The stages overlap, and a slow stage holds back the ones before it instead of letting their output
+    pile up in memory, so memory use depends on the queue sizes and not on the number of items.
+
+    A stage is a function from one item to an iterable of output items (empty to drop the item, several to
+    fan out) with its own number of worker threads. The first exception in any stage stops the pipeline and is
+    raised from run.
+    """
+
+    def __init__(self, queue_size=8):
+        self.queue_size = queue_size
+        self.stages = []
+
+    def add(self, name, function, workers=1):
+        self.stages.append({"name": name, "function": function, "workers": workers})
+        return self
+
+    def _put(self, q, item):
+        while not self.failed.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, q):
+        while not self.failed.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return DONE
+
+    def _fail(self, error):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self.failed.set()
+
+    def _feed(self, source, outputs):
+        try:
+            for item in source:
+                if self.failed.is_set():
+                    return
+                self._put(outputs, item)
+            self._put(outputs, DONE)
+        except BaseException as e:
+            self._fail(e)
+
+    def _work(self, stage, inputs, outputs):
+        try:
+            while True:
+                item = self._get(inputs)
+                if item is DONE:
+                    # Leave the marker for the other workers of this stage
+                    self._put(inputs, DONE)
+                    break
+                start, waiting = time.perf_counter(), 0.0
+                for output in stage["function"](item) or ():
+                    put_start = time.perf_counter()
+                    self._put(outputs, output)
+                    waiting += time.perf_counter() - put_start
+                with self.lock:
+                    stage["items"] += 1
+                    stage["busy"] += time.perf_counter() - start - waiting
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            with self.lock:
+                stage["running"] -= 1
+                last = stage["running"] == 0
+            if last:
+                self._put(outputs, DONE)
+
+    def run(self, source):
+        """Run all items of source through the stages and return statistics per stage."""
+        self.lock = threading.Lock()
+        self.failed = threading.Event()
+        self.error = None
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        for stage in self.stages:
+            stage.update(items=0, busy=0.0, running=stage["workers"])
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self._feed, args=(source, queues[0]), name="pipeline-source", daemon=True)]
+        for index, stage in enumerate(self.stages):
+            threads += [
+                threading.Thread(target=self._work, args=(stage, queues[index], queues[index + 1]),
+                                 name=f"pipeline-{stage['name']}-{worker}", daemon=True)
+                for worker in range(stage["workers"])
+            ]
+        for thread in threads:
+            thread.start()
+        # Whatever the last stage yields is dropped
+        while self._get(queues[-1]) is not DONE:
+            pass
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+        return {
+            "seconds": time.perf_counter() - start,
+            "peak_rss_mib": peak_rss_mib(),
+            "stages": {stage["name"]: {"items": stage["items"], "busy": stage["busy"], "workers": stage["workers"]}
+                       for stage in self.stages},
+        }
@@ -0,0 +1,42 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from langchain_core.embeddings import Embeddings
+
+# Vectors of the query texts embedded so far by the current request, set by remember_query_vectors
+_vectors: ContextVar[Optional[dict]] = ContextVar("query_vectors", default=None)
+
+
+@contextmanager
+def remember_query_vectors():
+    """Within the block (or the decorated function), a query text is embedded once, later calls reuse its vector."""
+    token = _vectors.set({})
+    try:
+        yield
+    finally:
+        _vectors.reset(token)
+
+
+class RememberedQueryEmbeddings(Embeddings):
+    """
+    Embeddings that look query texts up in the vectors of the current request first, so the answer cache lookup
+    and the dense search of one question embed it once. Other attributes (e.g. batcher) are the wrapped ones.
+    """
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def __getattr__(self, name):
+        return getattr(self.embeddings, name)
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        vectors = _vectors.get()
+        if vectors is None:
+            return self.embeddings.embed_query(text)
+        if text not in vectors:
+            vectors[text] = self.embeddings.embed_query(text)
+        return vectors[text]
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+
+def normalize_query(query):
+    """NFKC-fold the query (full-width letters, digits and spaces become their ASCII forms) and collapse whitespace."""
+    return " ".join(unicodedata.normalize("NFKC", query).split())
+
+
+def _document_size(doc):
+    return len(doc.page_content.encode()) + len(repr(doc.metadata))
+
+
+class RetrievalCache:
+    """
+    Thread-safe LRU cache of retrieval results with a time-to-live, bounded by the approximate size of the
+    cached documents rather than by the number of entries.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, docs):
+        size = sum(_document_size(doc) for doc in docs)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic(), docs, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key)[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class CachedRetriever(BaseRetriever):
+    """Retriever that answers identical normalized queries against the same index generation from a cache."""
+
+    retriever: BaseRetriever
+    """Retriever to fetch documents from on a cache miss."""
+    cache: RetrievalCache
+    """Cache shared by all requests of this worker."""
+    generation: int = 0
+    """Index generation the wrapped retriever searches."""
+    filters: Tuple = ()
+    """Filters applied by the wrapped retriever, as hashable key/value pairs."""
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        query = normalize_query(query)
+        key = (query, self.filters, self.generation)
+        docs: Optional[List[Document]] = self.cache.get(key)
+        if docs is None:
+            docs = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+            self.cache.put(key, docs)
+        # Downstream steps annotate document metadata, so never hand out the cached objects themselves
+        return [doc.copy(update={"metadata": dict(doc.metadata)}) for doc in docs]
@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationSession:
+    def __init__(self):
+        # Running summary of the turns that no longer fit in the verbatim window
+        self.summary = ""
+        # Most recent messages, in the compact history format
+        self.messages = []
+        # Messages that dropped out of the window and still have to be folded into the summary
+        self.unsummarized = []
+        self.summarizing = False
+        self.last_access = time.monotonic()
+
+
+class SessionStore:
+    """
+    In-memory conversation store keyed by user and conversation ID.
+
+    The last max_turns turns (a human and an assistant message each) are kept verbatim, older ones are folded
+    into a running summary on a background thread so the prompt size stays bounded however long a conversation
+    gets. Sessions expire ttl seconds after their last access, and the least recently used are dropped once
+    there are more than max_sessions.
+    """
+
+    def __init__(self, summarize, max_turns=4, ttl=3600, max_sessions=1000):
+        self.summarize = summarize
+        self.max_messages = 2 * max_turns
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-summary")
+
+    def _evict(self, now):
+        while self.sessions:
+            key, session = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_sessions and now - session.last_access < self.ttl:
+                break
+            del self.sessions[key]
+
+    def _session(self, key):
+        now = time.monotonic()
+        self._evict(now)
+        session = self.sessions.get(key)
+        if session is None:
+            session = self.sessions[key] = ConversationSession()
+        self.sessions.move_to_end(key)
+        session.last_access = now
+        return session
+
+    def get(self, user_id, conversation_id):
+        """Return the running summary and the verbatim history of a conversation."""
+        with self.lock:
+            session = self._session((str(user_id), conversation_id))
+            return session.summary, list(session.messages)
+
+    def append(self, user_id, conversation_id, messages):
+        """Add messages to a conversation and schedule summarization of anything that left the window."""
+        with self.lock:
+            session = self._session((str(user_id), conversation_id))
+            session.messages.extend(messages)
+            overflow = len(session.messages) - self.max_messages
+            if overflow > 0:
+                session.unsummarized.extend(session.messages[:overflow])
+                del session.messages[:overflow]
+            if session.unsummarized and not session.summarizing:
+                session.summarizing = True
+                self.executor.submit(self._fold, session)
+            return list(session.messages)
+
+    def _fold(self, session):
+        with self.lock:
+            summary = session.summary
+            messages = list(session.unsummarized)
+        try:
+            summary = self.summarize(summary, messages)
+        except Exception:
+            logger.exception("Summarizing conversation failed, keeping the previous summary")
+            with self.lock:
+                session.summarizing = False
+            return
+
+        with self.lock:
+            session.summary = summary
+            del session.unsummarized[:len(messages)]
+            # More turns may have dropped out of the window while we were summarizing
+            if session.unsummarized:
+                self.executor.submit(self._fold, session)
+            else:
+                session.summarizing = False
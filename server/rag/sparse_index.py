@@ -0,0 +1,99 @@
+import json
+import math
+import os
+from collections import Counter
+
+import numpy as np
+
+ARRAYS = ["indptr", "doc_ids", "freqs", "doc_len", "idf"]
+
+
+class BM25Index:
+    """
+    Okapi BM25 over postings lists kept in numpy arrays, a drop-in replacement for the rank_bm25.BM25Okapi
+    model of BM25Retriever with the same scores.
+
+    BM25Okapi keeps one dict of term frequencies per document and scans all of them for every query term, which
+    is slow and, in workers forked from a process that loaded the index, writes to every page holding them
+    (reference counts), so each worker ends up with its own copy. Here a query term only reads its postings,
+    and the arrays can be memory-mapped, so all workers share them.
+    """
+
+    def __init__(self, terms, indptr, doc_ids, freqs, doc_len, idf, k1=1.5, b=0.75):
+        # Row of every term in the postings (indptr) and idf arrays
+        self.terms = terms
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.freqs = freqs
+        self.doc_len = doc_len
+        self.idf = idf
+        self.k1 = k1
+        self.b = b
+        self.corpus_size = len(doc_len)
+        self.avgdl = float(doc_len.sum()) / self.corpus_size
+
+    @classmethod
+    def from_corpus(cls, corpus, k1=1.5, b=0.75, epsilon=0.25):
+        """Index tokenized documents, with the idf floor of BM25Okapi for terms in more than half of them."""
+        terms, rows, freqs, lengths = {}, [], [], []
+        for document in corpus:
+            frequencies = Counter(document)
+            rows.extend(terms.setdefault(word, len(terms)) for word in frequencies)
+            freqs.extend(frequencies.values())
+            lengths.append(len(frequencies))
+        doc_len = np.fromiter(map(len, corpus), dtype=np.int32, count=len(corpus))
+
+        # Group the (term, document) pairs by term, documents stay in order within a term
+        rows = np.array(rows, dtype=np.int64)
+        order = np.argsort(rows, kind="stable")
+        doc_ids = np.repeat(np.arange(len(corpus), dtype=np.int32), lengths)[order]
+        freqs = np.array(freqs, dtype=np.int32)[order]
+        counts = np.bincount(rows, minlength=len(terms))
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+
+        corpus_size = len(corpus)
+        idf = np.array([math.log(corpus_size - n + 0.5) - math.log(n + 0.5) for n in counts.tolist()])
+        # Summed in order like BM25Okapi, for the same floor
+        idf[idf < 0] = epsilon * (sum(idf.tolist()) / len(idf))
+        return cls(terms, indptr, doc_ids, freqs, doc_len, idf, k1=k1, b=b)
+
+    def get_scores(self, query):
+        score = np.zeros(self.corpus_size)
+        for q in query:
+            row = self.terms.get(q)
+            if row is None:
+                continue
+            start, end = self.indptr[row], self.indptr[row + 1]
+            docs = self.doc_ids[start:end]
+            q_freq = self.freqs[start:end].astype(np.float64)
+            score[docs] += self.idf[row] * (q_freq * (self.k1 + 1) /
+                                            (q_freq + self.k1 * (1 - self.b + self.b * self.doc_len[docs] / self.avgdl)))
+        return score
+
+    def get_top_n(self, query, documents, n=5):
+        assert self.corpus_size == len(documents), "The documents given don't match the index corpus!"
+        top_n = np.argsort(self.get_scores(query))[::-1][:n]
+        return [documents[i] for i in top_n]
+
+    def save(self, directory, prefix="bm25"):
+        """Write the index as prefix_*.npy arrays and prefix_terms.json, return the bytes written."""
+        size = 0
+        for name in ARRAYS:
+            path = os.path.join(directory, f"{prefix}_{name}.npy")
+            np.save(path + ".tmp.npy", getattr(self, name))
+            os.replace(path + ".tmp.npy", path)
+            size += os.path.getsize(path)
+        path = os.path.join(directory, f"{prefix}_terms.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump({"terms": self.terms, "k1": self.k1, "b": self.b}, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+        return size + os.path.getsize(path)
+
+    @classmethod
+    def load(cls, directory, prefix="bm25"):
+        """Load an index written by save, with the arrays memory-mapped read-only."""
+        with open(os.path.join(directory, f"{prefix}_terms.json")) as f:
+            settings = json.load(f)
+        arrays = {name: np.load(os.path.join(directory, f"{prefix}_{name}.npy"), mmap_mode="r") for name in ARRAYS}
+        return cls(settings["terms"], k1=settings["k1"], b=settings["b"], **arrays)
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import json
+import os
+from typing import Any, Callable, List
+
+import numpy as np
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+# Number of set bits in every byte value, for Hamming distances on packed binary codes
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+# Rows scored at once in the first stage, small enough for an upcast block of int8 codes to stay in cache
+BLOCK_ROWS = 4096
+
+
+def _normalize(vectors):
+    return vectors / np.clip(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12, None)
+
+
+def export_vectors(db, directory, batch_size=5000):
+    """
+    Write the embeddings of a Chroma collection to directory as normalized float32 (vectors.npy), together with
+    the chunk ID of every row (ids.json). Chunks stored more than once are only exported once.
+    """
+    os.makedirs(directory, exist_ok=True)
+    ids, vectors, seen = [], [], set()
+    offset = 0
+    while True:
+        batch = db._collection.get(include=["embeddings", "metadatas"], limit=batch_size, offset=offset)
+        if len(batch["ids"]) == 0:
+            break
+        for chroma_id, metadata, embedding in zip(batch["ids"], batch["metadatas"], batch["embeddings"]):
+            chunk_id = (metadata or {}).get("id", chroma_id)
+            if chunk_id not in seen:
+                seen.add(chunk_id)
+                ids.append(chunk_id)
+                vectors.append(embedding)
+        offset += batch_size
+
+    if len(vectors) == 0:
+        raise ValueError("The vector store is empty, load it with vector_store_initial_load=True first.")
+
+    # Write next to the old files and rename, readers may still have the old vectors memory-mapped
+    with open(os.path.join(directory, "vectors.npy.tmp"), "wb") as f:
+        np.save(f, _normalize(np.asarray(vectors, dtype=np.float32)))
+    with open(os.path.join(directory, "ids.json.tmp"), "w") as f:
+        json.dump(ids, f)
+    os.replace(os.path.join(directory, "vectors.npy.tmp"), os.path.join(directory, "vectors.npy"))
+    os.replace(os.path.join(directory, "ids.json.tmp"), os.path.join(directory, "ids.json"))
+
+
+def load_vectors(directory):
+    """Memory-map the full-precision vectors written by export_vectors and return them with their chunk IDs."""
+    with open(os.path.join(directory, "ids.json")) as f:
+        ids = json.load(f)
+    return ids, np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+
+
+class CompressedVectorIndex:
+    """
+    Two-stage dense search: the first stage scans compact in-memory codes, the fetch_k best candidates are then
+    re-scored against the full-precision vectors, which stay memory-mapped on disk.
+
+    The codes are the vectors truncated to their first dims components (Matryoshka embeddings keep most of
+    their quality that way) and then optionally quantized: int8 with one scale per dimension, or binary (the
+    sign of every component, compared by Hamming distance).
+    """
+
+    def __init__(self, vectors, dims=None, quantization="none"):
+        self.vectors = vectors
+        self.dims = dims or vectors.shape[1]
+        self.quantization = quantization
+
+        truncated = np.empty((vectors.shape[0], self.dims), dtype=np.float32)
+        for start in range(0, vectors.shape[0], BLOCK_ROWS):
+            truncated[start:start + BLOCK_ROWS] = _normalize(np.asarray(vectors[start:start + BLOCK_ROWS, :self.dims]))
+        if quantization == "int8":
+            self.scale = np.clip(np.abs(truncated).max(axis=0), 1e-12, None) / 127
+            self.codes = np.round(truncated / self.scale).astype(np.int8)
+        elif quantization == "binary":
+            self.codes = np.packbits(truncated > 0, axis=1)
+        elif quantization == "none":
+            self.codes = truncated
+        else:
+            raise ValueError(f"Unknown vector quantization {quantization}, choose none, int8 or binary.")
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def _first_stage(self, query):
+        query = _normalize(query[:self.dims])
+        if self.quantization == "binary":
+            query_bits = np.packbits(query > 0)
+            return np.concatenate([
+                -POPCOUNT[np.bitwise_xor(self.codes[start:start + BLOCK_ROWS], query_bits)].sum(axis=1, dtype=np.int32)
+                for start in range(0, len(self.codes), BLOCK_ROWS)
+            ])
+        if self.quantization == "int8":
+            query = query * self.scale
+        return np.concatenate([
+            self.codes[start:start + BLOCK_ROWS].astype(np.float32, copy=False) @ query
+            for start in range(0, len(self.codes), BLOCK_ROWS)
+        ])
+
+    def search(self, query, fetch_k):
+        """Return the rows of the fetch_k nearest vectors with their full-precision scores, best first."""
+        query = _normalize(np.asarray(query, dtype=np.float32))
+        scores = self._first_stage(query)
+        fetch_k = min(fetch_k, len(scores))
+        candidates = np.argpartition(-scores, fetch_k - 1)[:fetch_k]
+        # Sorted rows keep the reads from the memory-mapped file sequential
+        candidates.sort()
+        exact = np.asarray(self.vectors[candidates]) @ query
+        order = np.argsort(-exact)
+        return candidates[order], exact[order]
+
+
+class VectorIndexRetriever(BaseRetriever):
+    """Dense retriever over an in-process vector index, with the same MMR selection as the Chroma retriever."""
+
+    index: Any
+    """Index with a search(query_vector, fetch_k) method returning rows and scores."""
+    ids: List[str]
+    """ID of every row of the index."""
+    embeddings: Embeddings
+    """Embeddings to embed the query with."""
+    lookup: Callable[[List[str]], List[Document]]
+    """Returns the documents for a list of row IDs."""
+    k: int = 4
+    fetch_k: int = 20
+    lambda_mult: float = 0.5
+    search_type: str = "mmr"
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        rows, _ = self.index.search(query_vector, max(self.fetch_k, self.k))
+        if self.search_type == "mmr":
+            selected = maximal_marginal_relevance(
+                query_vector, np.asarray(self.index.vectors[rows]), lambda_mult=self.lambda_mult, k=self.k
+            )
+            rows = rows[selected]
+        else:
+            rows = rows[:self.k]
+        return self.lookup([self.ids[row] for row in rows])
@@ -0,0 +1,142 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import admission
+from admission import AdmissionController, Rejected, TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=0.0)
+    clock.monotonic = lambda: clock.now
+    monkeypatch.setattr(admission, "time", clock)
+    return clock
+
+
+def test_token_bucket_refills(clock):
+    bucket = TokenBucket(rate=0.5, burst=2)
+    assert bucket.take() == 0 and bucket.take() == 0
+    assert bucket.take() == 2.0
+    clock.now = 1.0
+    assert bucket.take() == 1.0
+    clock.now = 2.0
+    assert bucket.take() == 0
+
+
+def test_user_rate_and_retry_after(clock):
+    controller = AdmissionController(user_rate=0.5, user_burst=1)
+
+    async def requests():
+        async with controller.admit("a"):
+            pass
+        with pytest.raises(Rejected) as rejected:
+            async with controller.admit("a"):
+                pass
+        assert (rejected.value.status_code, rejected.value.reason, rejected.value.retry_after) == (429, "user_rate", 2)
+        # Other users have their own bucket
+        async with controller.admit("b"):
+            pass
+
+    asyncio.run(requests())
+    assert controller.stats()["rejected"] == {"user_rate": 1}
+    assert controller.stats()["admitted"] == 2
+
+
+def test_user_concurrency():
+    controller = AdmissionController(user_concurrency=1)
+
+    async def requests():
+        async with controller.admit("a"):
+            with pytest.raises(Rejected) as rejected:
+                async with controller.admit("a"):
+                    pass
+            assert (rejected.value.status_code, rejected.value.reason) == (429, "user_concurrency")
+        async with controller.admit("a"):
+            pass
+
+    asyncio.run(requests())
+    assert controller.user_requests == {}
+
+
+def test_queue_full_does_not_take_a_token():
+    controller = AdmissionController(max_concurrent=1, max_queue=0, user_burst=1)
+
+    async def requests():
+        async with controller.admit("a"):
+            with pytest.raises(Rejected) as rejected:
+                async with controller.admit("b"):
+                    pass
+            assert (rejected.value.status_code, rejected.value.reason) == (503, "queue_full")
+        # b's token was not spent on the rejected request
+        async with controller.admit("b"):
+            pass
+
+    asyncio.run(requests())
+    assert controller.stats()["rejected"] == {"queue_full": 1}
+
+
+def test_queue_hands_slots_over_in_order():
+    controller = AdmissionController(max_concurrent=1, max_queue=2, user_concurrency=3)
+    order = []
+
+    async def request(name):
+        async with controller.admit(name):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def requests():
+        await asyncio.gather(request("a"), request("b"), request("c"))
+
+    asyncio.run(requests())
+    stats = controller.stats()
+    assert order == ["a", "b", "c"]
+    assert (stats["active"], stats["queue_depth"], stats["max_queue_depth"], stats["admitted"]) == (0, 0, 2, 3)
+    assert stats["max_wait_ms"] > 0
+
+
+def test_queue_timeout():
+    controller = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=0.05)
+
+    async def requests():
+        running = asyncio.Event()
+
+        async def slow():
+            async with controller.admit("a"):
+                running.set()
+                await asyncio.sleep(0.2)
+
+        task = asyncio.create_task(slow())
+        await running.wait()
+        with pytest.raises(Rejected) as rejected:
+            async with controller.admit("b"):
+                pass
+        assert (rejected.value.status_code, rejected.value.reason) == (503, "queue_timeout")
+        assert controller.stats()["queue_depth"] == 0
+        await task
+
+    asyncio.run(requests())
+    assert controller.stats()["active"] == 0
+    assert controller.user_requests == {}
+
+
+def test_cancelled_run_keeps_its_slot():
+    controller = AdmissionController(max_concurrent=1, max_queue=0)
+
+    async def requests():
+        request = asyncio.create_task(controller.run_sync("a", time.sleep, 0.2))
+        await asyncio.sleep(0.05)
+        request.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await request
+        # The thread still runs, so the slot is still taken
+        assert controller.stats()["active"] == 1
+        with pytest.raises(Rejected):
+            await controller.run_sync("b", sum, [1])
+        await asyncio.sleep(0.3)
+        assert controller.stats()["active"] == 0
+        assert await controller.run_sync("b", sum, [1, 2]) == 3
+
+    asyncio.run(requests())
@@ -0,0 +1,24 @@
+from langchain_core.documents import Document
+
+from rag.answer_cache import SemanticAnswerCache
+
+
+def test_hits_do_not_share_documents():
+    cache = SemanticAnswerCache(threshold=0.9, capacity=4)
+    reply = {"answer": "a", "question": "q", "docs": [Document(page_content="d", metadata={"id": "x"})]}
+    cache.add([1.0, 0.0], 0, reply, latency=1.0)
+
+    first = cache.lookup([1.0, 0.01], 0)
+    first["docs"][0].metadata["provenance"] = 3
+    second = cache.lookup([1.0, 0.0], 0)
+    assert "provenance" not in second["docs"][0].metadata
+    assert "provenance" not in reply["docs"][0].metadata
+    assert cache.stats()["hits"] == 2
+
+
+def test_other_generation_is_a_miss():
+    cache = SemanticAnswerCache(threshold=0.9, capacity=4)
+    cache.add([1.0, 0.0], 0, {"answer": "a"}, latency=1.0)
+    assert cache.lookup([1.0, 0.0], 1) is None
+    assert cache.stats()["invalidations"] == 1
+    assert cache.lookup([0.0, 1.0], 0) is None
@@ -0,0 +1,18 @@
+import pytest
+
+from rag.batching import MicroBatcher
+
+
+def test_results_in_order():
+    batcher = MicroBatcher(lambda items: [item * 2 for item in items], max_batch_size=8, max_wait=0.05)
+    futures = batcher.submit_many(range(5))
+    assert [future.result(timeout=5) for future in futures] == [0, 2, 4, 6, 8]
+
+
+def test_missing_results_fail_every_item():
+    # E.g. a backend that drops empty strings, one result short of every batch
+    batcher = MicroBatcher(lambda items: items[:-1], max_batch_size=8, max_wait=0.05)
+    futures = batcher.submit_many(["a", "", "b"])
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
@@ -0,0 +1,66 @@
+import logging
+import threading
+from types import SimpleNamespace
+
+from langchain_core.documents import Document
+
+from rag import RAGHelper_cloud
+from rag.RAGHelper import identify_chunks
+from rag.index_generation import IndexGeneration
+
+SOURCE = "rag/data/衛署藥製字第050432號_泰克胃通 膠囊 30 毫克.md"
+
+# Chunks as the splitter cuts a label: headings start chunks or appear within them, dose tables have numbered
+# lines that are not headings, and section 14 is left out
+CHUNKS = [
+    "1 性狀\n\n1.1\n有效成分及含量\n每顆膠囊含 lansoprazole 30 mg。",
+    "1.2\n賦形劑\nSugar spheres, Sucrose, Starch。",
+    "2 適應症\n\n胃潰瘍、十二指腸潰瘍、胃食道逆流性疾病。",
+    "3 用法及用量\n\n3.1\n用法用量\n十二指腸潰瘍：",
+    "30 mg 每天一次\n共 4 週\n15 mg 一天兩次\n30 mg/day (2 週)",
+    "13 包裝及儲存\n\n13.1\n包裝\n2-1000 膠囊或錠鋁箔盒裝。\n\n15 其他",
+    "15.1\n請置於孩童無法取得之處。",
+]
+
+
+def test_label_sections():
+    chunks = identify_chunks([Document(page_content=text, metadata={"source": SOURCE}) for text in CHUNKS])
+    assert [doc.metadata["id"] for doc in chunks] == [
+        "衛署藥製字第050432號/1/0",
+        "衛署藥製字第050432號/1/1",
+        "衛署藥製字第050432號/2/0",
+        "衛署藥製字第050432號/3/0",
+        "衛署藥製字第050432號/3/1",
+        "衛署藥製字第050432號/13/0",
+        "衛署藥製字第050432號/15/0",
+    ]
+
+
+def test_upload_with_a_loaded_license(monkeypatch, tmp_path):
+    loaded = identify_chunks([Document(page_content=text, metadata={"source": SOURCE}) for text in CHUNKS[:3]])
+    upload = "衛署藥製字第050432號_泰克胃通 錠 15 毫克.md"
+    monkeypatch.setenv("data_directory", str(tmp_path))
+    monkeypatch.setattr(RAGHelper_cloud, "load_file", lambda path: [
+        Document(page_content=text, metadata={"source": path}) for text in CHUNKS[:2]])
+
+    helper = RAGHelper_cloud.RAGHelperCloud.__new__(RAGHelper_cloud.RAGHelperCloud)
+    helper.logger = logging.getLogger(__name__)
+    helper.generation_lock = threading.Lock()
+    helper.retrieval_cache = None
+    helper.generation = IndexGeneration(0, loaded)
+    helper.buildSplitter = lambda: SimpleNamespace(split_documents=lambda docs: docs)
+    helper.addToVectorStore = lambda contents: None
+    helper.buildGeneration = lambda number, chunks, refresh=False: IndexGeneration(number, chunks)
+    helper.saveGeneration = lambda generation: None
+    helper.addDocuments([upload])
+
+    ids = [doc.metadata["id"] for doc in helper.generation.chunked_documents]
+    assert ids == [
+        "衛署藥製字第050432號/1/0",
+        "衛署藥製字第050432號/1/1",
+        "衛署藥製字第050432號/2/0",
+        "衛署藥製字第050432號_泰克胃通 錠 15 毫克/1/0",
+        "衛署藥製字第050432號_泰克胃通 錠 15 毫克/1/1",
+    ]
+    # Every chunk can still be found by its ID
+    assert len(helper.generation.chunk_index) == 5
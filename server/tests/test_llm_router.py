@@ -0,0 +1,92 @@
+import time
+
+import pytest
+
+from rag.llm_router import LLMRouter, LLMUnavailable, Provider
+
+
+class FakeLLM:
+    def __init__(self, answer="answer", delay=0.0, fail=False):
+        self.answer = answer
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+
+    def invoke(self, input, config=None, **kwargs):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise ConnectionError("provider down")
+        return self.answer
+
+
+def test_circuit_opens_and_closes_after_a_trial():
+    llm = FakeLLM(fail=True)
+    provider = Provider("p", llm, failures=2, cooldown=0.05)
+    for _ in range(2):
+        assert provider.acquire()
+        with pytest.raises(ConnectionError):
+            provider.invoke("q")
+    assert provider.state == "open" and not provider.acquire()
+
+    time.sleep(0.06)
+    # Only one caller gets the trial call, and a failed trial opens the circuit again
+    assert provider.acquire() and provider.state == "half-open"
+    assert not provider.acquire()
+    with pytest.raises(ConnectionError):
+        provider.invoke("q")
+    assert provider.state == "open"
+
+    time.sleep(0.06)
+    llm.fail = False
+    assert provider.acquire()
+    assert provider.invoke("q") == "answer"
+    assert provider.stats()["state"] == "closed"
+    assert provider.stats()["trips"] == 2 and provider.stats()["errors"] == 3
+
+
+def test_slow_calls_count_as_failures():
+    provider = Provider("p", FakeLLM(delay=0.02), failures=1, slow=0.01)
+    assert provider.invoke("q") == "answer"
+    assert provider.state == "open"
+    assert provider.stats()["slow"] == 1 and provider.stats()["p50_ms"] is None
+
+
+def test_failover_is_not_a_hedge():
+    router = LLMRouter([Provider("down", FakeLLM(fail=True)), Provider("up", FakeLLM("second"))], hedge_delay=5)
+    assert router.invoke("q") == "second"
+    stats = router.stats()
+    assert (stats["hedged"], stats["hedge_wins"], stats["failovers"], stats["failover_wins"]) == (0, 0, 1, 1)
+    assert stats["providers"]["up"]["wins"] == 1
+
+
+def test_hedge_wins_over_a_slow_provider():
+    slow, fast = FakeLLM("slow", delay=0.5), FakeLLM("fast")
+    router = LLMRouter([Provider("slow", slow), Provider("fast", fast)], hedge_delay=0.02)
+    start = time.monotonic()
+    assert router.invoke("q") == "fast"
+    assert time.monotonic() - start < 0.4
+    stats = router.stats()
+    assert (stats["hedged"], stats["hedge_wins"], stats["failovers"], stats["failover_wins"]) == (1, 1, 0, 0)
+
+
+def test_single_provider_hedges_with_itself():
+    llm = FakeLLM(delay=0.05)
+    router = LLMRouter([Provider("only", llm)], hedge_delay=0.01)
+    assert router.invoke("q") == "answer"
+    assert router.stats()["hedged"] == 1
+    time.sleep(0.1)
+    assert llm.calls == 2
+
+
+def test_unavailable_when_all_fail_or_are_open():
+    providers = [Provider("a", FakeLLM(fail=True), failures=1, cooldown=60),
+                 Provider("b", FakeLLM(fail=True), failures=1, cooldown=60)]
+    router = LLMRouter(providers, hedge_delay=5)
+    with pytest.raises(LLMUnavailable):
+        router.invoke("q")
+    # Both circuits are open now, the next call is refused without calling them
+    with pytest.raises(LLMUnavailable):
+        router.invoke("q")
+    assert router.stats()["unavailable"] == 2
+    assert [provider.llm.calls for provider in providers] == [1, 1]
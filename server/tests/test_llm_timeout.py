@@ -0,0 +1,63 @@
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import TimeoutError as FutureTimeout
+from types import SimpleNamespace
+
+from langchain_core.documents import Document
+from langchain_core.language_models.fake import FakeListLLM
+from langchain_core.runnables import RunnableLambda
+
+from rag.RAGHelper_cloud import RAGHelperCloud
+
+DOCS = [Document(page_content="胃潰瘍、十二指腸潰瘍、胃食道逆流性疾病。",
+                 metadata={"source": "rag/data/衛署藥製字第050432號_泰克胃通 膠囊 30 毫克.md"})]
+
+
+class TimedOutFuture:
+    # What Future.result(timeout=...) raises, which is not the builtin TimeoutError before Python 3.11
+    def result(self, timeout=None):
+        raise FutureTimeout()
+
+    def cancel(self):
+        return False
+
+
+class SlowExecutor:
+    def submit(self, function, *args, **kwargs):
+        return TimedOutFuture()
+
+
+def test_llm_timeout_answers_extractively(monkeypatch):
+    for name, value in {"use_rewrite_loop": "False", "use_re2": "False", "provenance_method": "none",
+                        "rag_instruction": "{context}", "rag_question_initial": "{question}"}.items():
+        monkeypatch.setenv(name, value)
+    retriever = RunnableLambda(lambda query: DOCS)
+    helper = RAGHelperCloud.__new__(RAGHelperCloud)
+    helper.logger = logging.getLogger(__name__)
+    helper.llm = FakeListLLM(responses=["never asked"])
+    helper.latency_budget = 30
+    helper.llm_executor = SlowExecutor()
+    helper.answer_cache = None
+    helper.modes, helper.skipped_stages, helper.modes_lock = Counter(), Counter(), threading.Lock()
+    helper.generation = SimpleNamespace(number=0, rerank_retriever=None, context_retriever=retriever,
+                                        ensemble_retriever=retriever)
+
+    _, reply = helper.handle_user_interaction("胃潰瘍可以吃嗎？", [])
+    assert reply["mode"] == "extractive"
+    assert helper.skipped_stages["llm"] == 1
+    assert "泰克胃通" in reply["answer"]
+
+
+def test_ladder_gives_up_stages_in_order(monkeypatch):
+    for name, value in {"degrade_provenance_below": "20", "degrade_rewrite_below": "10", "degrade_llm_below": "4"}.items():
+        monkeypatch.setenv(name, value)
+    helper = RAGHelperCloud.__new__(RAGHelperCloud)
+    for left, stages in [(None, set()), (25, set()), (15, {"provenance"}), (5, {"provenance", "rewrite", "rerank"}),
+                         (3, {"provenance", "rewrite", "rerank", "llm"})]:
+        helper.timeLeft = lambda start: left
+        assert helper.degradedStages(0) == stages
+    # Out of order settings still skip provenance before reranking
+    monkeypatch.setenv("degrade_provenance_below", "5")
+    helper.timeLeft = lambda start: 8
+    assert helper.degradedStages(0) == {"provenance", "rewrite", "rerank"}
@@ -0,0 +1,68 @@
+import numpy as np
+
+from rag.local_index import IVFIndex
+
+
+def clustered(n, centers, seed):
+    rng = np.random.default_rng(seed)
+    return (centers[rng.integers(len(centers), size=n)] + 0.05 * rng.normal(size=(n, centers.shape[1]))).astype(
+        np.float32)
+
+
+CENTERS = np.random.default_rng(0).normal(size=(8, 32))
+
+
+def nearest(index, vector):
+    rows, _ = index.search(vector, 1)
+    return index.ids[rows[0]]
+
+
+def test_build_and_search(tmp_path):
+    vectors = clustered(400, CENTERS, 1)
+    path = str(tmp_path / "index.ivf")
+    IVFIndex.build([f"v{i}" for i in range(len(vectors))], vectors, path, nlist=8)
+    index = IVFIndex(path, nprobe=8)
+    assert sorted(index.ids) == sorted(f"v{i}" for i in range(len(vectors)))
+    assert nearest(index, vectors[123]) == "v123"
+
+
+def test_empty_and_tiny(tmp_path):
+    path = str(tmp_path / "index.ivf")
+    IVFIndex.build([], np.zeros((0, 32), np.float32), path)
+    assert len(IVFIndex(path).search(np.ones(32), 5)[0]) == 0
+    IVFIndex.build(["a", "b"], np.eye(2, 32, dtype=np.float32), path, nlist=16)
+    assert len(IVFIndex(path).centroids) == 2
+    IVFIndex.add(["c"], np.eye(1, 32, 2, dtype=np.float32), path)
+    assert sorted(IVFIndex(path).ids) == ["a", "b", "c"]
+
+
+def test_add_keeps_the_clusters(tmp_path):
+    path = str(tmp_path / "index.ivf")
+    vectors = clustered(400, CENTERS, 1)
+    IVFIndex.build([f"v{i}" for i in range(len(vectors))], vectors, path, nlist=8)
+    centroids = np.array(IVFIndex(path).centroids)
+
+    added = clustered(50, CENTERS, 2)
+    IVFIndex.add([f"w{i}" for i in range(len(added))], added, path)
+    index = IVFIndex(path, nprobe=8)
+    assert np.array_equal(index.centroids, centroids)
+    assert (index.clustered, index.added) == (400, 50)
+    assert len(index.ids) == 450 and index.offsets[-1] == 450
+    assert nearest(index, added[7]) == "w7"
+    assert nearest(index, vectors[5]) == "v5"
+    # Every row sits in the list of its nearest centroid
+    for cluster in range(len(index.centroids)):
+        rows = np.asarray(index.vectors[index.offsets[cluster]:index.offsets[cluster + 1]])
+        assert (np.argmax(rows @ centroids.T, axis=1) == cluster).all()
+
+
+def test_reclusters_past_thresholds(tmp_path):
+    path = str(tmp_path / "index.ivf")
+    vectors = clustered(400, CENTERS, 1)
+    IVFIndex.build([f"v{i}" for i in range(len(vectors))], vectors, path, nlist=8)
+    # Vectors far from every cluster
+    IVFIndex.add(["far"], np.random.default_rng(3).normal(size=(1, 32)), path, drift=0.05)
+    assert IVFIndex(path).added == 0 and IVFIndex(path).clustered == 401
+    # More than growth times the clustered vectors
+    IVFIndex.add([f"w{i}" for i in range(250)], clustered(250, CENTERS, 4), path, growth=0.5)
+    assert IVFIndex(path).clustered == 651
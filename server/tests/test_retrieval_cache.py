@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+from typing import List
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from rag import retrieval_cache
+from rag.retrieval_cache import CachedRetriever, RetrievalCache, normalize_query
+
+
+def documents(text, n=1):
+    return [Document(page_content=text, metadata={"id": f"{text}/{i}"}) for i in range(n)]
+
+
+class CountingRetriever(BaseRetriever):
+    queries: List[str] = []
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        self.queries.append(query)
+        return documents(query)
+
+
+def test_normalize_query():
+    assert normalize_query("  ＡＢＣ　１２３\n藥 ") == "ABC 123 藥"
+
+
+def test_ttl(monkeypatch):
+    clock = SimpleNamespace(monotonic=lambda: 0.0)
+    monkeypatch.setattr(retrieval_cache, "time", clock)
+    cache = RetrievalCache(ttl=10)
+    cache.put("q", documents("q"))
+    clock.monotonic = lambda: 10.0
+    assert cache.get("q") is not None
+    clock.monotonic = lambda: 10.5
+    assert cache.get("q") is None
+    assert cache.stats() == {"entries": 0, "bytes": 0, "hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_evicts_least_recently_used_by_size():
+    size = sum(retrieval_cache._document_size(doc) for doc in documents("a", 2))
+    cache = RetrievalCache(max_bytes=2 * size)
+    cache.put("a", documents("a", 2))
+    cache.put("b", documents("b", 2))
+    assert cache.get("a") is not None
+    cache.put("c", documents("c", 2))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["bytes"] == 2 * size
+    # Results larger than the whole cache are not kept
+    cache.put("d", documents("d", 5))
+    assert cache.get("d") is None and cache.stats()["entries"] == 2
+
+
+def test_cached_retriever():
+    base = CountingRetriever(queries=[])
+    cache = RetrievalCache()
+    retriever = CachedRetriever(retriever=base, cache=cache, generation=1)
+    first = retriever.invoke("副作用 ")
+    first[0].metadata["provenance"] = 5
+    second = retriever.invoke("副作用")
+    assert base.queries == ["副作用"]
+    assert "provenance" not in second[0].metadata
+    # A new index generation does not see the results of the old one
+    CachedRetriever(retriever=base, cache=cache, generation=2).invoke("副作用")
+    assert base.queries == ["副作用", "副作用"]
@@ -0,0 +1,32 @@
+import random
+
+import numpy as np
+from rank_bm25 import BM25Okapi
+
+from rag.sparse_index import BM25Index
+
+WORDS = ["胃潰瘍", "劑量", "副作用", "孕婦", "兒童", "肝功能", "每天", "一次", "mg", "膠囊", "錠", "保存"]
+
+
+def corpus(n, seed=0):
+    rng = random.Random(seed)
+    # Some words in most documents, so the idf floor of BM25Okapi applies too
+    return [rng.choices(WORDS, weights=range(len(WORDS), 0, -1), k=rng.randint(1, 30)) for _ in range(n)]
+
+
+def test_scores_match_bm25okapi():
+    documents = corpus(300)
+    reference, index = BM25Okapi(documents), BM25Index.from_corpus(documents)
+    for query in [["胃潰瘍"], ["劑量", "孕婦", "劑量"], ["保存", "不在語料"], WORDS]:
+        assert np.allclose(index.get_scores(query), reference.get_scores(query))
+    assert index.get_top_n(["孕婦", "mg"], documents, n=5) == reference.get_top_n(["孕婦", "mg"], documents, n=5)
+
+
+def test_save_and_load(tmp_path):
+    documents = corpus(50, seed=1)
+    index = BM25Index.from_corpus(documents)
+    assert index.save(str(tmp_path), prefix="sparse") > 0
+    loaded = BM25Index.load(str(tmp_path), prefix="sparse")
+    assert isinstance(loaded.doc_ids, np.memmap)
+    assert loaded.corpus_size == 50
+    assert np.array_equal(loaded.get_scores(["劑量", "兒童"]), index.get_scores(["劑量", "兒童"]))
@@ -0,0 +1,31 @@
+import asyncio
+import threading
+
+from fastapi_users.password import PasswordHelper
+
+from accounts.users import ThreadedPasswordHelper
+
+
+def test_password_work_runs_ahead_on_a_thread(monkeypatch):
+    threads = []
+    hash_password = PasswordHelper.hash
+
+    def recording_hash(self, password):
+        threads.append(threading.current_thread())
+        return hash_password(self, password)
+
+    monkeypatch.setattr(PasswordHelper, "hash", recording_hash)
+    helper = ThreadedPasswordHelper()
+
+    async def register_and_login():
+        await helper.hash_ahead("secret")
+        hashed = helper.hash("secret")
+        await helper.verify_ahead("secret", hashed)
+        return hashed, helper.verify_and_update("secret", hashed)
+
+    hashed, (verified, _) = asyncio.run(register_and_login())
+    assert verified
+    assert threads and threading.main_thread() not in threads
+    # Without a result computed ahead, the helper hashes in place
+    assert helper.verify_and_update("secret", helper.hash("other"))[0] is False
+    assert threads[-1] is threading.main_thread()
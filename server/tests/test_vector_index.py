@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from rag.vector_index import CompressedVectorIndex, VectorIndexRetriever, _normalize
+
+VECTORS = _normalize(np.random.default_rng(0).normal(size=(500, 64)).astype(np.float32))
+
+
+def exact_top(query, k):
+    return set(np.argsort(-(VECTORS @ _normalize(query)))[:k])
+
+
+@pytest.mark.parametrize("quantization,dims", [("none", None), ("int8", None), ("binary", None), ("none", 32)])
+def test_rescored_at_full_precision(quantization, dims):
+    index = CompressedVectorIndex(VECTORS, dims=dims, quantization=quantization)
+    query = VECTORS[7] + 0.1 * VECTORS[8]
+    rows, scores = index.search(query, fetch_k=50)
+    assert rows[0] == 7
+    # The candidates keep their exact scores, best first
+    assert np.allclose(scores, VECTORS[rows] @ _normalize(query), atol=1e-5)
+    assert list(scores) == sorted(scores, reverse=True)
+    assert len(exact_top(query, 5) & set(rows[:5])) >= 4
+
+
+def test_codes_are_smaller():
+    full = CompressedVectorIndex(VECTORS)
+    assert CompressedVectorIndex(VECTORS, quantization="int8").nbytes * 4 == full.nbytes
+    assert CompressedVectorIndex(VECTORS, quantization="binary").nbytes * 32 == full.nbytes
+    assert CompressedVectorIndex(VECTORS, dims=16).nbytes * 4 == full.nbytes
+    with pytest.raises(ValueError):
+        CompressedVectorIndex(VECTORS, quantization="int4")
+
+
+class RowEmbeddings(Embeddings):
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return VECTORS[int(text)].tolist()
+
+
+def test_retriever_looks_up_rows():
+    ids = [f"content-{row}" for row in range(len(VECTORS))]
+    retriever = VectorIndexRetriever(
+        index=CompressedVectorIndex(VECTORS, quantization="int8"), ids=ids, embeddings=RowEmbeddings(),
+        lookup=lambda found: [Document(page_content=content_id) for content_id in found], k=3, fetch_k=20,
+        search_type="similarity")
+    docs = retriever.invoke("42")
+    assert len(docs) == 3
+    assert docs[0].page_content == "content-42"